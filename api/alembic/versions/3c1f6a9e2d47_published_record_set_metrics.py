@@ -0,0 +1,73 @@
+"""Published record set metrics
+
+Revision ID: 3c1f6a9e2d47
+Revises: 5dc17a275a5d
+Create Date: 2026-10-18 09:12:41.337204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import fastapi_users
+
+
+# revision identifiers, used by Alembic.
+revision = "3c1f6a9e2d47"
+down_revision = "5dc17a275a5d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "published_record_set_metric",
+        sa.Column("id", fastapi_users.db.sqlalchemy.GUID(), nullable=False),
+        sa.Column(
+            "published_record_set_id",
+            fastapi_users.db.sqlalchemy.GUID(),
+            nullable=False,
+        ),
+        sa.Column("segmented", sa.Boolean(), nullable=False),
+        sa.Column("segment", sa.String(length=255), nullable=False),
+        sa.Column("category", sa.String(length=255), nullable=False),
+        sa.Column("target_member_percent", sa.Float(), nullable=False),
+        sa.Column("non_target_member_percent", sa.Float(), nullable=False),
+        sa.Column("target", sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["published_record_set_id"],
+            ["published_record_set.id"],
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "published_record_set_id",
+            "segmented",
+            "segment",
+            "category",
+            name="uix_published_record_set_metric",
+        ),
+    )
+    op.create_index(
+        op.f("ix_published_record_set_metric_published_record_set_id"),
+        "published_record_set_metric",
+        ["published_record_set_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_published_record_set_metric_category",
+        "published_record_set_metric",
+        ["category", "segmented", "segment"],
+        unique=False,
+    )
+    # Existing record sets are backfilled with `python stats.py`.
+
+
+def downgrade():
+    op.drop_index(
+        "ix_published_record_set_metric_category",
+        table_name="published_record_set_metric",
+    )
+    op.drop_index(
+        op.f("ix_published_record_set_metric_published_record_set_id"),
+        table_name="published_record_set_metric",
+    )
+    op.drop_table("published_record_set_metric")
@@ -0,0 +1,50 @@
+"""Cache generations
+
+Revision ID: 8f2b4d1c6e90
+Revises: 3c1f6a9e2d47
+Create Date: 2026-10-18 10:03:27.581902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8f2b4d1c6e90"
+down_revision = "3c1f6a9e2d47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "cache_generation",
+        sa.Column("id", sa.String(length=255), nullable=False),
+        sa.Column("generation", sa.Integer(), nullable=False),
+        sa.Column(
+            "updated", sa.TIMESTAMP(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.execute("INSERT INTO cache_generation (id, generation) VALUES ('default', 0)")
+
+    op.add_column("cache", sa.Column("key", sa.String(length=255), nullable=True))
+    op.add_column("cache", sa.Column("generation", sa.Integer(), nullable=True))
+    op.add_column(
+        "cache",
+        sa.Column(
+            "created", sa.TIMESTAMP(), server_default=sa.text("now()"), nullable=True
+        ),
+    )
+    op.create_index(op.f("ix_cache_key"), "cache", ["key"], unique=False)
+    op.create_index(op.f("ix_cache_generation"), "cache", ["generation"], unique=False)
+    # The old date-keyed rows have no generation and are evicted by the sweeper.
+
+
+def downgrade():
+    op.drop_index(op.f("ix_cache_generation"), table_name="cache")
+    op.drop_index(op.f("ix_cache_key"), table_name="cache")
+    op.drop_column("cache", "created")
+    op.drop_column("cache", "generation")
+    op.drop_column("cache", "key")
+    op.drop_table("cache_generation")
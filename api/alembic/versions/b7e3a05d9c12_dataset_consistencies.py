@@ -0,0 +1,54 @@
+"""Dataset consistencies
+
+Revision ID: b7e3a05d9c12
+Revises: 8f2b4d1c6e90
+Create Date: 2026-10-18 11:46:09.214538
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import fastapi_users
+
+
+# revision identifiers, used by Alembic.
+revision = "b7e3a05d9c12"
+down_revision = "8f2b4d1c6e90"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "dataset_consistency",
+        sa.Column("id", fastapi_users.db.sqlalchemy.GUID(), nullable=False),
+        sa.Column("dataset_id", fastapi_users.db.sqlalchemy.GUID(), nullable=False),
+        sa.Column("year", sa.Integer(), nullable=False),
+        sa.Column("category", sa.String(length=255), nullable=False),
+        sa.Column("consistent", sa.Boolean(), nullable=False),
+        sa.ForeignKeyConstraint(["dataset_id"], ["dataset.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "dataset_id", "year", "category", name="uix_dataset_consistency"
+        ),
+    )
+    op.create_index(
+        op.f("ix_dataset_consistency_dataset_id"),
+        "dataset_consistency",
+        ["dataset_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_dataset_consistency_category",
+        "dataset_consistency",
+        ["category", "year"],
+        unique=False,
+    )
+    # Existing record sets are backfilled with `python stats.py`.
+
+
+def downgrade():
+    op.drop_index("ix_dataset_consistency_category", table_name="dataset_consistency")
+    op.drop_index(
+        op.f("ix_dataset_consistency_dataset_id"), table_name="dataset_consistency"
+    )
+    op.drop_table("dataset_consistency")
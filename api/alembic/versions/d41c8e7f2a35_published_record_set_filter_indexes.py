@@ -0,0 +1,58 @@
+"""Published record set filter indexes
+
+Revision ID: d41c8e7f2a35
+Revises: b7e3a05d9c12
+Create Date: 2026-10-18 13:21:55.903118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d41c8e7f2a35"
+down_revision = "b7e3a05d9c12"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f("ix_published_record_set_end"),
+        "published_record_set",
+        ["end"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_published_record_set_team_name",
+        "published_record_set",
+        [sa.text("(document ->> 'teamName')")],
+        unique=False,
+    )
+    op.create_index(
+        "ix_published_record_set_dataset_group",
+        "published_record_set",
+        [sa.text("(document ->> 'datasetGroup')")],
+        unique=False,
+    )
+    op.create_index(
+        "ix_published_record_set_dataset_group_tags",
+        "published_record_set",
+        [sa.text("(document -> 'datasetGroupTags')")],
+        unique=False,
+        postgresql_using="gin",
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_published_record_set_dataset_group_tags",
+        table_name="published_record_set",
+    )
+    op.drop_index(
+        "ix_published_record_set_dataset_group", table_name="published_record_set"
+    )
+    op.drop_index(
+        "ix_published_record_set_team_name", table_name="published_record_set"
+    )
+    op.drop_index(op.f("ix_published_record_set_end"), table_name="published_record_set")
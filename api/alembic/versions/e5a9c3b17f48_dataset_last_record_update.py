@@ -0,0 +1,36 @@
+"""Dataset last record update
+
+Revision ID: e5a9c3b17f48
+Revises: d41c8e7f2a35
+Create Date: 2026-10-18 15:12:46.207419
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e5a9c3b17f48"
+down_revision = "d41c8e7f2a35"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "dataset", sa.Column("last_record_update", sa.TIMESTAMP(), nullable=True)
+    )
+    op.execute(
+        """
+        UPDATE dataset
+        SET last_record_update = (
+            SELECT max(record.updated)
+            FROM record
+            WHERE record.dataset_id = dataset.id AND record.deleted IS NULL
+        )
+        """
+    )
+
+
+def downgrade():
+    op.drop_column("dataset", "last_record_update")
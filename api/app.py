@@ -1,11 +1,17 @@
-from typing import cast
+from typing import Optional, Union, cast
+import asyncio
 import logging
 import datetime
 import urllib
 import os
 from uuid import uuid4
 
-from starlette.responses import RedirectResponse, HTMLResponse
+from starlette.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+)
 from starlette.staticfiles import StaticFiles
 from fastapi import FastAPI, Request, Depends, HTTPException, Response, status
 from fastapi_users.router.reset import RESET_PASSWORD_TOKEN_AUDIENCE
@@ -14,12 +20,16 @@ from sqlalchemy.orm import Session
 import uvicorn
 import dateutil.parser
 from ariadne import (
+    graphql,
     load_schema_from_path,
     make_executable_schema,
     snake_case_fallback_resolvers,
     ScalarType,
 )
 from ariadne.asgi import GraphQL
+from ariadne.exceptions import HttpError
+from lazy_object_proxy import Proxy
+from graphql import FieldNode, OperationType, get_operation_ast, parse
 
 from saml import get_saml_auth, dev_saml_idp, get_saml_userdata
 from templates import templates
@@ -27,12 +37,16 @@ from connection import connection
 from seed import is_blank_slate
 from database import Organization, User, Role
 from queries import queries
+from loaders import Loaders
 from mutations import mutation
 from settings import settings
+from executor import password_executor, resolver_executor
 import mailer
 import user
 import directives
 import monitoring
+import cache
+import precompute
 
 
 
@@ -45,6 +59,32 @@ app = FastAPI(
 )
 
 
+@app.on_event("startup")
+async def start_cache_sweeper():
+    """Periodically evict stale cached statistics in the background."""
+    asyncio.create_task(
+        cache.sweep_cached_objects_periodically(
+            app.extra["get_db_session"],
+            settings.cache_sweep_interval,
+            settings.cache_max_age,
+        )
+    )
+
+
+@app.on_event("startup")
+async def start_precompute():
+    """Keep the dashboard statistics precomputed in the background."""
+    if not settings.precompute_in_process:
+        return
+    asyncio.create_task(
+        precompute.refresh_precomputed_objects_periodically(
+            app.extra["get_db_session"],
+            settings.precompute_interval,
+            settings.precompute_poll_interval,
+        )
+    )
+
+
 async def blank_slate(request: Request):
     """Check if the app is configured correctly.
 
@@ -87,12 +127,12 @@ async def after_verify(user: user.UserDBModel, request: Request):
     await mailer.send_verify_confirm_email(user)
 
 
-def admin_user(request: Request):
+async def admin_user(request: Request):
     """Dependency to verify that a user is an admin."""
-    user = request.scope.get("dbuser")
+    user = await get_request_user(request)
     if not user:
         raise HTTPException(status_code=401, detail="You are not authenticated")
-    if not any(r.name == "admin" for r in user.roles):
+    if "admin" not in request.scope["dbuser_roles"]:
         raise HTTPException(
             status_code=403, detail="You do not have permission for this action"
         )
@@ -112,7 +152,7 @@ app.include_router(
     tags=["auth"],
 )
 app.include_router(
-    user.fastapi_users.get_reset_password_router(
+    user.get_reset_password_router(
         settings.app_secret, after_forgot_password=on_after_forgot_password
     ),
     prefix="/auth",
@@ -261,6 +301,16 @@ async def acs(request: Request, auth=Depends(get_saml_auth), status_code=200):
             raise HTTPException(status_code=500, detail="Unknown error occurred")
 
 
+@app.get("/metrics")
+def get_metrics():
+    """Return in-process performance counters of this worker."""
+    return {
+        "cache": cache.local_cache.stats(),
+        "resolver_pool": resolver_executor.stats(),
+        "password_pool": password_executor.stats(),
+    }
+
+
 @app.get("/health")
 def get_health(request: Request):
     try:
@@ -315,7 +365,10 @@ datetime_scalar = ScalarType("DateTime")
 
 
 @datetime_scalar.serializer
-def serialize_datetime(value: datetime.datetime) -> str:
+def serialize_datetime(value: Union[datetime.datetime, str]) -> str:
+    # Cached objects store datetimes already serialized.
+    if isinstance(value, str):
+        return value
     return value.isoformat()
 
 
@@ -336,8 +389,11 @@ schema = make_executable_schema(
 )
 
 
-@app.middleware("http")
-async def add_user(request: Request, call_next):
+async def load_request_user(request: Request):
+    """Look up the user making a request and their roles.
+
+    :param request: Request, with the database session in its scope
+    """
     dbsession = request.scope["dbsession"]
 
     # allow for manual specification of user in request header by email
@@ -351,36 +407,139 @@ async def add_user(request: Request, call_next):
             cookie=request.cookies.get("rtauth")
         )
         # The permissions checks use the ORM object, not the Pydantic model.
-        dbuser = dbsession.query(User).get(user_db.id) if user_db else None
+        dbuser = (
+            await user.user_db.get_orm_user(dbsession, user_db.id) if user_db else None
+        )
 
     request.scope["dbuser"] = dbuser
-    return await call_next(request)
+    # Roles are loaded once here and checked against this set for the rest of
+    # the request.
+    request.scope["dbuser_roles"] = dbuser.get_role_names() if dbuser else frozenset()
 
 
-@app.middleware("http")
-async def add_db_session(request: Request, call_next):
-    session = app.extra["get_db_session"]()
-    request.scope["dbsession"] = session
+async def get_request_user(request: Request) -> Optional[User]:
+    """Get the user making a request, looking them up on first use.
 
-    response = await call_next(request)
+    Requests that don't need the user (e.g. static files) don't decode the
+    auth cookie or query the database.
 
-    session.close()
+    :param request: Request
+    :returns: User object, or None if the request isn't authenticated
+    """
+    if "dbuser" not in request.scope:
+        if settings.db_async:
+            # The lookup doesn't block the event loop with the async connection.
+            await load_request_user(request)
+        else:
+            await resolver_executor.run(asyncio.run, load_request_user(request))
+    return request.scope["dbuser"]
 
-    return response
+
+@app.middleware("http")
+async def add_db_session(request: Request, call_next):
+    # The session is only created when something uses it, so requests that
+    # don't need the database don't take a connection from the pool.
+    session = Proxy(app.extra["get_db_session"])
+    request.scope["dbsession"] = session
+    # The user database (e.g. logins) also uses this session.
+    token = user.request_session.set(session)
+    try:
+        return await call_next(request)
+    finally:
+        user.request_session.reset(token)
+        if session.__resolved__:
+            session.close()
 
 
 async def get_context(request: Request):
     dbsession = request.scope["dbsession"]
-    dbuser = request.scope["dbuser"]
+    dbuser = await get_request_user(request)
     return {
         "dbsession": dbsession,
         "request": request,
         "current_user": dbuser,
+        "current_user_roles": request.scope["dbuser_roles"],
+        "loaders": Loaders(dbsession),
     }
 
 
+# Root fields whose resolvers await work tied to the app's event loop.
+EVENT_LOOP_FIELDS = {"configureApp"}
+
+
+def needs_event_loop(data) -> bool:
+    """Check whether a GraphQL request has to run on the app's event loop.
+
+    That's the case for mutations selecting a field of `EVENT_LOOP_FIELDS`,
+    or selecting fields through fragments, which aren't looked into.
+
+    :param data: GraphQL request data
+    :returns: True if the operation to execute needs the app's event loop
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("query"), str):
+        return False
+    try:
+        document = parse(data["query"])
+    except Exception:
+        # Let the execution report the error.
+        return False
+    operation = get_operation_ast(document, data.get("operationName"))
+    if operation is None or operation.operation != OperationType.MUTATION:
+        return False
+    return any(
+        not isinstance(selection, FieldNode)
+        or selection.name.value in EVENT_LOOP_FIELDS
+        for selection in operation.selection_set.selections
+    )
+
+
+class ThreadPoolGraphQL(GraphQL):
+    """GraphQL app that executes operations on the resolver thread pool.
+
+    Each operation runs on its own event loop in a pool thread, so the
+    resolvers' blocking database queries don't stall other requests, the data
+    loaders still batch their loads, and the request's session is only used by
+    one thread. Only mutations that await work tied to the app's event loop
+    (e.g. `configureApp` creating a user) run on it.
+    """
+
+    async def graphql_http_server(self, request: Request) -> Response:
+        # Same as the base method, except for where `graphql` runs.
+        try:
+            data = await self.extract_data_from_request(request)
+        except HttpError as error:
+            return PlainTextResponse(error.message or error.status, status_code=400)
+
+        context_value = await self.get_context_for_request(request)
+        extensions = await self.get_extensions_for_request(request, context_value)
+        middleware = await self.get_middleware_for_request(request, context_value)
+
+        execution = graphql(
+            self.schema,
+            data,
+            context_value=context_value,
+            root_value=self.root_value,
+            validation_rules=self.validation_rules,
+            debug=self.debug,
+            introspection=self.introspection,
+            logger=self.logger,
+            error_formatter=self.error_formatter,
+            extensions=extensions,
+            middleware=middleware,
+        )
+        if needs_event_loop(data):
+            success, response = await execution
+        else:
+            success, response = await resolver_executor.run(asyncio.run, execution)
+        status_code = 200 if success else 400
+        return JSONResponse(response, status_code=status_code)
+
+
 # Mount ariadne to fastapi
-app.mount("/graphql", GraphQL(schema, debug=settings.debug, context_value=get_context))
+app.mount(
+    "/graphql",
+    ThreadPoolGraphQL(schema, debug=settings.debug, context_value=get_context),
+)
 
 # Mount static files
 app.mount("/static", StaticFiles(directory=os.getenv("RT_STATIC_DIR", "./static")), name="static")
@@ -1,4 +1,8 @@
+import asyncio
+import tempfile
+import threading
 import unittest
+from concurrent.futures import Future
 import sqlalchemy
 from unittest.mock import Mock, patch
 
@@ -6,29 +10,53 @@ from fastapi_users.utils import generate_jwt, JWT_ALGORITHM
 from fastapi_users.password import verify_and_update_password
 from fastapi.testclient import TestClient
 from ariadne import graphql_sync, graphql
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.pool import StaticPool
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from datetime import datetime
 
-from app import schema, app
+from app import schema, app, needs_event_loop
 from user import user_db, cookie_authentication, get_valid_token
+from seed import clear_cached_state, create_tables, create_dummy_data
 from database import (
-    clear_cached_state,
     Base,
-    create_tables,
     Organization,
-    create_dummy_data,
+    PublishedRecordSet,
+    PublishedRecordSetMetric,
+    ReportingPeriod,
+    Role,
     Record,
     Entry,
     Dataset,
+    DatasetConsistency,
     Category,
     CategoryValue,
     User,
     Team,
+    TeamMembership,
     Program,
     Target,
+    advisory_xact_lock,
 )
-from uuid import UUID
+from uuid import UUID, uuid4
+import stats
+import cache
+import directives
+import executor
+import loaders
+import mutations
+import precompute
+import queries
+import user
+
+
+@compiles(JSONB, "sqlite")
+def compile_jsonb_sqlite(type_, compiler, **kw):
+    # SQLite stores the JSON documents as text.
+    return "JSON"
 
 
 class BaseAppTest(unittest.IsolatedAsyncioTestCase):
@@ -3614,5 +3642,1209 @@ class TestGraphQL(BaseAppTest):
         assert orgs["data"]["organizations"] == [{"name": "My Org"}]
 
 
+class BaseDatabaseTest(unittest.IsolatedAsyncioTestCase):
+    """Base test runner with an in-memory database holding a small team.
+
+    The team has one program with two datasets, and a member besides an
+    admin and a user outside of the team.
+    """
+
+    def setUp(self):
+        self.engine = create_engine(
+            "sqlite:///:memory:",
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = self.Session()
+        cache.local_cache.clear()
+        user.user_cache.clear()
+
+        self.admin_role = Role(name="admin", description="Admin")
+        self.org = Organization(name="Org")
+        self.team = Team(name="Team", organization=self.org)
+        self.program = Program(
+            name="Program",
+            description="Program",
+            team=self.team,
+            reporting_period_type="monthly",
+        )
+        self.datasets = [
+            Dataset(name=f"Dataset {i}", description="Dataset", program=self.program)
+            for i in range(2)
+        ]
+        self.admin = self.make_user("admin", roles=[self.admin_role])
+        self.member = self.make_user("member", teams=[self.team])
+        self.outsider = self.make_user("outsider")
+        self.session.add_all([self.program, *self.datasets])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        Base.metadata.drop_all(self.engine)
+        self.engine.dispose()
+
+    def count_queries(self):
+        """Collect the statements run from now on.
+
+        :returns: List the statements get appended to
+        """
+        statements = []
+        event.listen(
+            self.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        return statements
+
+    def make_user(self, name, **kwargs):
+        user = User(
+            id=uuid4(),
+            email=f"{name}@notrealemail.info",
+            username=name,
+            hashed_password="x",
+            first_name=name,
+            last_name=name,
+            **kwargs,
+        )
+        self.session.add(user)
+        return user
+
+    def make_record_set(self, dataset, end, document):
+        period = ReportingPeriod(
+            program=self.program, begin=end.replace(day=1), end=end
+        )
+        record_set = PublishedRecordSet(
+            dataset=dataset,
+            reporting_period=period,
+            begin=period.begin,
+            end=end,
+            document=document,
+        )
+        record_set.refresh_metrics(self.session)
+        self.session.add(record_set)
+        self.session.commit()
+        return record_set
+
+
+def make_document(women, men, target=50, team="Team", program="Program", tags=()):
+    """Get a published record set document with a single gender category."""
+    return {
+        "teamName": team,
+        "datasetGroup": program,
+        "datasetGroupTags": [{"name": tag} for tag in tags],
+        "targets": [{"category": "Gender", "target": target}],
+        "record": {
+            "Everyone": {
+                "Gender": {
+                    "entries": {
+                        "Women": {"percent": women, "targetMember": True},
+                        "Men": {"percent": men, "targetMember": False},
+                    }
+                }
+            }
+        },
+        "segmentedRecord": {
+            "Cast": {
+                "Gender": {
+                    "entries": {
+                        "Women": {"percent": women, "targetMember": True},
+                        "Men": {"percent": men, "targetMember": False},
+                    }
+                }
+            }
+        },
+    }
+
+
+class TestPublishedRecordSetMetrics(BaseDatabaseTest):
+    """Test the metrics extracted from published record sets."""
+
+    def test_from_document(self):
+        [metric, segmented_metric] = PublishedRecordSetMetric.from_document(
+            make_document(60, 40)
+        )
+        assert segmented_metric.segmented
+        assert segmented_metric.segment == "Cast"
+        assert metric.segment == "Everyone"
+        assert metric.category == "Gender"
+        assert metric.target_member_percent == 60
+        assert metric.non_target_member_percent == 40
+        assert metric.target == 50
+        assert not metric.segmented
+
+    def test_from_document_ignores_invalid_entries(self):
+        document = make_document(60, -1)
+        document["record"]["Everyone"]["Gender"]["entries"]["Other"] = {"percent": 10}
+        [metric, _] = PublishedRecordSetMetric.from_document(document)
+        assert metric.target_member_percent == 60
+        assert metric.non_target_member_percent == 0
+
+    def test_refresh_metrics_again(self):
+        self.make_record_set(
+            self.datasets[0], datetime(2021, 1, 31), make_document(60, 40)
+        )
+        record_set = self.session.query(PublishedRecordSet).one()
+        record_set.document = make_document(30, 70)
+        record_set.refresh_metrics(self.session)
+        self.session.commit()
+
+        metrics = self.session.query(PublishedRecordSetMetric).all()
+        assert [m.target_member_percent for m in metrics] == [30, 30]
+
+    def test_rebuild_metrics(self):
+        self.make_record_set(
+            self.datasets[0], datetime(2021, 1, 31), make_document(60, 40)
+        )
+        generation = cache.get_cache_generation(self.session)
+
+        stats.rebuild_published_record_set_metrics(self.session)
+        # Running the backfill again is fine.
+        stats.rebuild_published_record_set_metrics(self.session)
+
+        assert self.session.query(PublishedRecordSetMetric).count() == 2
+        assert cache.get_cache_generation(self.session) > generation
+
+
+class TestDatasetConsistency(BaseDatabaseTest):
+    """Test the consistencies of datasets, by year."""
+
+    def publish(self, month, women):
+        record_set = self.make_record_set(
+            self.datasets[0], datetime(2021, month, 28), make_document(women, 0)
+        )
+        stats.refresh_dataset_consistency(self.session, self.datasets[0].id, 2021)
+        self.session.commit()
+        return record_set
+
+    def get_consistencies(self):
+        return [
+            (consistency.year, consistency.consistent)
+            for consistency in self.session.query(DatasetConsistency)
+        ]
+
+    def test_refresh(self):
+        for month in [1, 2]:
+            self.publish(month, 60)
+        assert self.get_consistencies() == [(2021, False)]
+
+        # Met the target at least 3 times, and came close to it otherwise.
+        self.publish(3, 60)
+        self.publish(4, 46)
+        assert self.get_consistencies() == [(2021, True)]
+
+        self.publish(5, 10)
+        assert self.get_consistencies() == [(2021, False)]
+
+    def test_refresh_without_record_sets(self):
+        record_set = self.publish(1, 60)
+        self.session.delete(record_set)
+        self.session.flush()
+        stats.refresh_dataset_consistency(self.session, self.datasets[0].id, 2021)
+        self.session.commit()
+        assert self.get_consistencies() == []
+
+    def test_rebuild(self):
+        for month in [1, 2, 3]:
+            self.publish(month, 60)
+        self.session.query(DatasetConsistency).delete()
+
+        stats.rebuild_dataset_consistencies(self.session)
+        assert self.get_consistencies() == [(2021, True)]
+
+
+class TestPublishedRecordSetQueries(BaseDatabaseTest):
+    """Test the filters of the published record set queries."""
+
+    def setUp(self):
+        super().setUp()
+        self.info = Mock(context={"dbsession": self.session})
+        self.record_sets = [
+            self.make_record_set(
+                self.datasets[0],
+                datetime(2020, 12, 31),
+                make_document(40, 60, tags=["News"]),
+            ),
+            self.make_record_set(
+                self.datasets[0], datetime(2021, 1, 31), make_document(60, 40)
+            ),
+            self.make_record_set(
+                self.datasets[1],
+                datetime(2021, 2, 28),
+                make_document(50, 50, team="Renamed", program="Other"),
+            ),
+        ]
+        self.ids = [record_set.id for record_set in self.record_sets]
+
+    def query(self, **kwargs):
+        return [
+            record_set.id
+            for record_set in queries.resolve_published_record_sets(
+                None, self.info, **kwargs
+            )
+        ]
+
+    def test_filter_year(self):
+        assert self.query(input={"year": 2021}) == self.ids[1:]
+        assert self.query(input={"year": 0}) == self.ids
+
+    def test_filter_snapshot(self):
+        # Renaming the team doesn't change what the record sets were
+        # published with.
+        self.team.name = "New name"
+        self.session.commit()
+
+        assert self.query(input={"teams": ["Team"]}) == self.ids[:2]
+        assert self.query(input={"teams": ["New name"]}) == []
+        assert self.query(input={"dataset_groups": ["Other"]}) == self.ids[2:]
+
+    def test_filter_categories(self):
+        assert self.query(input={"categories": ["Gender"]}) == self.ids
+        assert self.query(input={"categories": ["Age"]}) == []
+
+    def test_pagination(self):
+        assert self.query(first=2) == self.ids[:2]
+        assert self.query(first=2, after=self.ids[1]) == self.ids[2:]
+
+    def test_first_of_each_dataset(self):
+        assert self.query(first_of_each_dataset=True) == [self.ids[0], self.ids[2]]
+        assert self.query(input={"year": 2021}, first_of_each_dataset=True) == (
+            self.ids[1:]
+        )
+
+    def test_filter_options(self):
+        options = queries.resolve_published_record_sets_filter_options(None, self.info)
+        assert options == {
+            "categories": ["Gender"],
+            "teams": ["Renamed", "Team"],
+            "dataset_groups": ["Other", "Program"],
+            "tags": ["News"],
+        }
+
+    def test_filter_options_cached(self):
+        document = make_document(50, 50)
+        del document["teamName"]
+        self.make_record_set(self.datasets[1], datetime(2021, 3, 31), document)
+
+        with patch(
+            "queries.get_published_record_set_filter_options",
+            wraps=stats.get_published_record_set_filter_options,
+        ) as compute:
+            options = queries.resolve_published_record_sets_filter_options(
+                None, self.info
+            )
+            queries.resolve_published_record_sets_filter_options(None, self.info)
+        compute.assert_called_once()
+        # Record sets without a team don't add an option.
+        assert options["teams"] == ["Renamed", "Team"]
+
+    def test_chart_data(self):
+        points = queries.resolve_published_record_sets_chart_data(
+            None, self.info, input={"year": 2021}, period="YEAR"
+        )
+        [point] = [point for point in points if point["target_member"]]
+        assert point["date"] == datetime(2021, 1, 1)
+        assert point["category"] == "Gender"
+        assert point["percent"] == 55
+        assert point["count"] == 2
+
+    def test_chart_data_by_month(self):
+        points = queries.resolve_published_record_sets_chart_data(
+            None, self.info, input={"year": 0, "categories": ["Gender"]}
+        )
+        assert [
+            (point["date"], point["target_member"], point["percent"], point["count"])
+            for point in points
+        ] == [
+            (datetime(2020, 12, 1), True, 40, 1),
+            (datetime(2020, 12, 1), False, 60, 1),
+            (datetime(2021, 1, 1), True, 60, 1),
+            (datetime(2021, 1, 1), False, 40, 1),
+            (datetime(2021, 2, 1), True, 50, 1),
+            (datetime(2021, 2, 1), False, 50, 1),
+        ]
+        assert (
+            queries.resolve_published_record_sets_chart_data(
+                None, self.info, input={"categories": ["Age"]}
+            )
+            == []
+        )
+
+
+class TestStats(BaseDatabaseTest):
+    """Test the stats computed over the published record sets."""
+
+    def setUp(self):
+        super().setUp()
+        self.make_record_set(
+            self.datasets[0], datetime(2021, 1, 31), make_document(60, 40)
+        )
+        self.make_record_set(
+            self.datasets[0], datetime(2021, 2, 28), make_document(30, 70)
+        )
+        self.make_record_set(
+            self.datasets[1], datetime(2021, 1, 31), make_document(47, 53)
+        )
+
+    def test_overviews(self):
+        overviews = {
+            (overview["date"], overview["target_state"]): overview["value"]
+            for overview in stats.get_overviews(self.session)
+            if overview["category"] == "Gender"
+        }
+        assert overviews == {
+            ("min", "exceeds"): 1,
+            ("min", "lt5"): 1,
+            ("min", "lt10"): 0,
+            ("min", "gt10"): 0,
+            ("max", "exceeds"): 0,
+            ("max", "lt5"): 1,
+            ("max", "lt10"): 0,
+            ("max", "gt10"): 1,
+        }
+
+    def test_headline_totals(self):
+        # Only the latest record set of each dataset counts.
+        assert stats.get_headline_totals(self.session) == {
+            "gender": {"percent": 38.5, "no_of_datasets": 2}
+        }
+
+
+class TestAdminStats(BaseDatabaseTest):
+    """Test the admin stats."""
+
+    def setUp(self):
+        super().setUp()
+        # The first dataset misses its target in each of the last 3 periods,
+        # and the second one publishes nothing.
+        for month in range(1, 4):
+            period = ReportingPeriod(
+                program=self.program,
+                begin=datetime(2021, month, 1),
+                end=datetime(2021, month, 28),
+                description=f"2021-0{month}",
+            )
+            record_set = PublishedRecordSet(
+                dataset=self.datasets[0],
+                reporting_period=period,
+                begin=period.begin,
+                end=period.end,
+                document=make_document(30, 70),
+            )
+            record_set.refresh_metrics(self.session)
+            self.session.add(record_set)
+        self.session.commit()
+
+    def test_needs_attention(self):
+        admin_stats = {}
+        stats.get_admin_needs_attention(admin_stats, self.session)
+        needs_attention = {
+            dataset["name"]: dataset for dataset in admin_stats["needs_attention"]
+        }
+        assert needs_attention["Dataset 0"]["reporting_period_name"] == "2021-03"
+        assert sorted(needs_attention["Dataset 0"]["needs_attention_types"]) == [
+            "MissedATargetInAllLast3Periods",
+            "MoreThan10PercentBelowATargetLastPeriod",
+        ]
+        assert needs_attention["Dataset 1"]["needs_attention_types"] == [
+            "NothingPublishedLast3Periods"
+        ]
+
+    def test_resolver_cached_by_duration(self):
+        info = Mock(context={"dbsession": self.session})
+        with patch("queries.get_admin_stats", wraps=stats.get_admin_stats) as compute:
+            admin_stats = queries.resolve_admin_stats(None, info, {"duration": 31})
+            queries.resolve_admin_stats(None, info, {"duration": 31})
+            queries.resolve_admin_stats(None, info, {"duration": 62})
+        assert [call.args[1] for call in compute.call_args_list] == [31, 62]
+        assert set(admin_stats) == {"target_states", "overdue", "needs_attention"}
+        assert len(admin_stats["needs_attention"]) == 2
+        assert stats.get_admin_stats_key(31) != stats.get_admin_stats_key(62)
+
+    def test_resolver_rejects_duration(self):
+        info = Mock(context={"dbsession": self.session})
+        with self.assertRaisesRegex(Exception, "Duration must be one of 31, 62, 93"):
+            queries.resolve_admin_stats(None, info, {"duration": 100000})
+
+    def test_busy_pool(self):
+        pooled = stats.get_admin_stats(self.session, 31)
+        # Parts the pool hasn't started are computed in the given session.
+        with patch.object(
+            executor.resolver_executor, "submit", side_effect=lambda *args: Future()
+        ) as submit:
+            admin_stats = stats.get_admin_stats(self.session, 31)
+        assert submit.call_count == 2
+        assert admin_stats == pooled
+
+
+class TestDataLoader(BaseDatabaseTest):
+    """Test batching loads with the data loaders."""
+
+    async def test_batches_keys_loaded_together(self):
+        batch_load = Mock(side_effect=lambda keys: {key: key * 2 for key in keys})
+        loader = loaders.DataLoader(batch_load)
+
+        values = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1))
+        assert values == [2, 4, 2]
+        assert await loader.load(3) == 6
+        assert [call.args[0] for call in batch_load.call_args_list] == [[1, 2], [3]]
+
+    async def test_failed_keys_load_again(self):
+        batch_load = Mock(side_effect=[ValueError("failed"), {1: "one"}])
+        loader = loaders.DataLoader(batch_load)
+
+        with self.assertRaises(ValueError):
+            await loader.load(1)
+        assert await loader.load(1) == "one"
+
+    def test_loads_right_away_outside_event_loop(self):
+        batch_load = Mock(return_value={})
+        loader = loaders.DataLoader(batch_load, default=list)
+        assert loader.load(1) == []
+        assert loader.load(1) == []
+        batch_load.assert_called_once_with([1])
+
+    async def test_loaders_run_one_query(self):
+        registry = loaders.Loaders(self.session)
+        ids = [dataset.id for dataset in self.datasets]
+        self.session.expire_all()
+
+        statements = self.count_queries()
+        datasets = await asyncio.gather(
+            *[registry.not_deleted_dataset.load(id) for id in ids]
+        )
+        assert [dataset.id for dataset in datasets] == ids
+        assert len(statements) == 1
+
+
+class TestDatasetRecords(BaseDatabaseTest):
+    """Test loading the records of datasets."""
+
+    def setUp(self):
+        super().setUp()
+        self.info = Mock(context={"dbsession": self.session})
+        self.records = [
+            Record(dataset=self.datasets[0], publication_date=datetime(2021, 1, day))
+            for day in range(1, 5)
+        ]
+        deleted = Record(
+            dataset=self.datasets[0],
+            publication_date=datetime(2021, 1, 5),
+            deleted=datetime(2021, 1, 6),
+        )
+        other = Record(dataset=self.datasets[1], publication_date=datetime(2021, 1, 1))
+        self.session.add_all([*self.records, deleted, other])
+        self.session.commit()
+        self.ids = [record.id for record in self.records]
+
+    def test_get_not_deleted_skips_records(self):
+        id = self.datasets[0].id
+        self.session.expire_all()
+        statements = self.count_queries()
+        dataset = Dataset.get_not_deleted(self.session, id)
+        assert dataset.name == "Dataset 0"
+        assert len(statements) == 1
+
+    async def test_records_batched(self):
+        # Load the datasets first, since committing expired them.
+        self.session.refresh(self.datasets[0])
+        self.session.refresh(self.datasets[1])
+        statements = self.count_queries()
+        records = await asyncio.gather(
+            *[
+                queries.resolve_dataset_records(dataset, self.info)
+                for dataset in self.datasets
+            ]
+        )
+        assert [record.id for record in records[0]] == self.ids
+        assert len(records[1]) == 1
+        assert len(statements) == 1
+
+    def query(self, **kwargs):
+        return [
+            record.id
+            for record in queries.resolve_dataset_records(
+                self.datasets[0], self.info, **kwargs
+            )
+        ]
+
+    def test_records_window(self):
+        assert self.query(from_date=datetime(2021, 1, 2)) == self.ids[1:]
+        assert self.query(to_date=datetime(2021, 1, 2)) == self.ids[:2]
+        assert (
+            self.query(from_date=datetime(2021, 1, 2), to_date=datetime(2021, 1, 3))
+            == self.ids[1:3]
+        )
+
+    def test_records_pagination(self):
+        assert self.query(first=2) == self.ids[:2]
+        assert self.query(first=2, after=self.ids[1]) == self.ids[2:]
+        assert self.query(after=self.ids[3]) == []
+        with self.assertRaises(Exception):
+            self.query(after=uuid4())
+
+
+class TestPermissions(BaseDatabaseTest):
+    """Test the permission checks of the GraphQL schema."""
+
+    def run_graphql_query(self, query, variables, user):
+        return graphql_sync(
+            schema,
+            {"query": query, "variables": variables},
+            context_value={"dbsession": self.session, "current_user": user},
+            debug=True,
+        )
+
+    def query_dataset(self, user):
+        return self.run_graphql_query(
+            """
+            query GetDataset($id: ID!) {
+                dataset(id: $id) {
+                    id
+                    name
+                    description
+                }
+            }
+            """,
+            {"id": str(self.datasets[0].id)},
+            user,
+        )
+
+    def test_decisions_memoized(self):
+        with patch(
+            "directives.user_has_permission", wraps=directives.user_has_permission
+        ) as check:
+            success, result = self.query_dataset(self.member)
+        assert success
+        assert "errors" not in result
+        assert result["data"]["dataset"]["name"] == "Dataset 0"
+        # Once for the root field, and once for all fields of the dataset.
+        assert check.call_count == 2
+
+    def test_decisions_per_user(self):
+        success, result = self.query_dataset(self.outsider)
+        assert result["errors"][0]["message"].startswith("Lacking permission")
+
+        info = Mock(context={"current_user": self.member})
+        other_info = Mock(context={"current_user": self.outsider})
+        permissions = frozenset(["TEAM_MEMBER"])
+        dataset = self.datasets[0]
+        assert directives._permission_decision_key(permissions, None, info) is None
+        assert directives._permission_decision_key(
+            permissions, dataset, info
+        ) != directives._permission_decision_key(permissions, dataset, other_info)
+
+    def test_team_membership(self):
+        member_id, outsider_id = self.member.id, self.outsider.id
+        record = Record(dataset=self.datasets[0], publication_date=datetime(2021, 1, 1))
+        self.session.add(record)
+        self.session.commit()
+        self.session.expire_all()
+
+        member = self.session.get(User, member_id)
+        statements = self.count_queries()
+        membership = TeamMembership.for_user(self.session, member)
+        assert len(statements) == 1
+        assert membership.team_ids == {self.team.id}
+        assert membership.program_ids == {self.program.id}
+        assert membership.dataset_ids == {dataset.id for dataset in self.datasets}
+
+        outsider = self.session.get(User, outsider_id)
+        outsider_membership = TeamMembership.for_user(self.session, outsider)
+        assert not outsider_membership.dataset_ids
+        assert not TeamMembership.for_user(self.session, None).team_ids
+
+        for obj in [self.team, self.program, *self.datasets, record]:
+            assert obj.in_team_membership(membership)
+            assert obj.user_is_team_member(member)
+            assert not obj.in_team_membership(outsider_membership)
+            assert not obj.user_is_team_member(outsider)
+
+    def test_entry_team_membership(self):
+        records = [
+            Record(dataset=self.datasets[0], publication_date=datetime(2021, 1, i))
+            for i in range(1, 4)
+        ]
+        self.session.add_all([Entry(record=record, count=1) for record in records])
+        self.session.commit()
+        member_id, outsider_id = self.member.id, self.outsider.id
+
+        session = self.Session()
+        membership = TeamMembership.for_user(session, session.get(User, member_id))
+        outsider_membership = TeamMembership.for_user(
+            session, session.get(User, outsider_id)
+        )
+        entries = session.query(Entry).all()
+        statements = self.count_queries()
+        assert all(entry.in_team_membership(membership) for entry in entries)
+        assert not any(
+            entry.in_team_membership(outsider_membership) for entry in entries
+        )
+        # The records of all the entries are looked up at once.
+        assert len(statements) == 2
+        session.close()
+
+    def test_roles_loaded_once(self):
+        assert self.admin.get_role_names() == {"admin"}
+        assert self.member.get_role_names() == frozenset()
+
+        self.session.expire_all()
+        statements = self.count_queries()
+        result = self.run_graphql_query(
+            """
+            query GetDatasets {
+                datasets(onlyUnassigned: false) {
+                    id
+                    name
+                }
+                teams {
+                    id
+                }
+            }
+            """,
+            {},
+            self.admin,
+        )[1]
+        assert len(result["data"]["datasets"]) == 2
+        assert len([s for s in statements if "FROM role" in s]) == 1
+
+
+class TestCache(BaseDatabaseTest):
+    """Test the cached objects and their generations."""
+
+    def test_get_or_create(self):
+        new_func = Mock(return_value={"value": 1})
+        assert cache.get_or_create_cached_object(self.session, "key", new_func) == {
+            "value": 1
+        }
+        assert cache.get_or_create_cached_object(self.session, "key", new_func) == {
+            "value": 1
+        }
+        new_func.assert_called_once()
+
+    def test_invalidate(self):
+        cache.get_or_create_cached_object(self.session, "key", lambda s: {"value": 1})
+        generation = cache.get_cache_generation(self.session)
+
+        cache.invalidate_cached_objects(self.session)
+        # Objects stay in memory until the new generation is committed.
+        assert cache.local_cache.get("key") == {"value": 1}
+        self.session.commit()
+        assert cache.local_cache.get("key") is None
+        assert cache.get_cache_generation(self.session) == generation + 1
+
+        document = cache.get_or_create_cached_object(
+            self.session, "key", lambda s: {"value": 2}
+        )
+        assert document == {"value": 2}
+
+    def test_invalidate_rolled_back(self):
+        cache.get_or_create_cached_object(self.session, "key", lambda s: {"value": 1})
+        generation = cache.get_cache_generation(self.session)
+
+        cache.invalidate_cached_objects(self.session)
+        self.session.rollback()
+        assert cache.local_cache.get("key") == {"value": 1}
+        assert cache.get_cache_generation(self.session) == generation
+
+        # A later commit doesn't clear the objects either.
+        self.team.name = "New name"
+        self.session.commit()
+        assert cache.local_cache.get("key") == {"value": 1}
+
+    def test_leaves_caller_session_alone(self):
+        team = self.session.get(Team, self.team.id)
+        self.session.add(Organization(name="Pending"))
+
+        cache.get_or_create_cached_object(self.session, "key", lambda s: {"value": 1})
+        # The caller's objects aren't expired and its pending work is kept,
+        # even if computing an object fails.
+        cache.get_or_create_cached_object(self.session, "other", lambda s: 1 / 0)
+        statements = self.count_queries()
+        assert team.name == "Team"
+        assert statements == []
+        assert len(self.session.new) == 1
+
+    def test_previous_generation_served_while_locked(self):
+        cache.get_or_create_cached_object(self.session, "key", lambda s: {"value": 1})
+        cache.invalidate_cached_objects(self.session)
+        self.session.commit()
+
+        # Another worker is computing the object of the new generation.
+        with patch("cache._lock", return_value=False):
+            document = cache.get_or_create_cached_object(
+                self.session, "key", lambda s: {"value": 2}
+            )
+        assert document == {"value": 1}
+        # The stale object isn't kept in memory.
+        assert cache.local_cache.get("key") is None
+
+    def test_waits_for_lock_without_previous_generation(self):
+        new_func = Mock(return_value={"value": 1})
+        with patch("cache._lock", side_effect=[False, True]) as lock:
+            document = cache.get_or_create_cached_object(self.session, "key", new_func)
+        assert document == {"value": 1}
+        assert [call.kwargs["wait"] for call in lock.call_args_list] == [False, True]
+        new_func.assert_called_once()
+
+    def test_advisory_xact_lock(self):
+        # SQLite has no advisory locks, so they are always granted.
+        assert advisory_xact_lock(self.session, "name", wait=False)
+
+        session = Mock()
+        session.get_bind().dialect.name = "postgresql"
+        session.scalar.return_value = False
+        assert not advisory_xact_lock(session, "name", wait=False)
+        assert "pg_try_advisory_xact_lock" in str(session.scalar.call_args.args[0])
+        assert advisory_xact_lock(session, "name")
+        assert "pg_advisory_xact_lock" in str(session.execute.call_args.args[0])
+
+
+class TestPrecompute(BaseDatabaseTest):
+    """Test precomputing the dashboard statistics."""
+
+    def test_refresh(self):
+        keys = list(precompute.PRECOMPUTED)
+        assert precompute.refresh_precomputed_objects(self.Session, 60) == keys
+        assert precompute.refresh_precomputed_objects(self.Session, 60) == []
+
+        cache.invalidate_cached_objects(self.session)
+        self.session.commit()
+        assert precompute.refresh_precomputed_objects(self.Session, 60) == keys
+
+    def test_resolver_reads_precomputed(self):
+        precompute.refresh_precomputed_objects(self.Session, 60)
+        info = Mock(context={"dbsession": self.session})
+        with patch("queries.get_basic_stats") as get_basic_stats:
+            basic_stats = queries.resolve_basic_stats(None, info)
+        get_basic_stats.assert_not_called()
+        assert basic_stats == {"teams": 1, "datasets": 2, "tags": 0}
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test the in-memory tier of the cache."""
+
+    def test_get_set(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        assert lru.get("key") is None
+        assert lru.get("key", {}) == {}
+        lru.set("key", {"value": 1})
+        assert lru.get("key") == {"value": 1}
+        lru.delete("key")
+        assert lru.get("key") is None
+        assert lru.stats() == {
+            "size": 0,
+            "maxsize": 2,
+            "ttl": 60,
+            "hits": 1,
+            "misses": 3,
+        }
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        assert lru.get("a") == 1
+        assert lru.get("b") is None
+        assert lru.get("c") == 3
+
+    def test_expires(self):
+        lru = cache.LRUCache(maxsize=2, ttl=60)
+        with patch("cache.time.monotonic", return_value=1000):
+            lru.set("key", 1)
+        with patch("cache.time.monotonic", return_value=1060):
+            assert lru.get("key") == 1
+        with patch("cache.time.monotonic", return_value=1061):
+            assert lru.get("key") is None
+        assert lru.stats()["size"] == 0
+
+    def test_disabled(self):
+        lru = cache.LRUCache(maxsize=0, ttl=60)
+        lru.set("key", 1)
+        assert lru.get("key") is None
+
+
+class TestDatasetLastRecordUpdate(BaseDatabaseTest):
+    """Test the denormalized date of the last record update of datasets."""
+
+    def setUp(self):
+        super().setUp()
+        dataset = self.datasets[0]
+        self.session.add(Record(dataset=dataset, publication_date=datetime(2021, 1, 1)))
+        self.session.flush()
+        Dataset.refresh_last_record_update(self.session, dataset.id)
+        self.session.commit()
+
+    def test_refresh(self):
+        assert self.datasets[0].last_record_update is not None
+        assert self.datasets[1].last_record_update is None
+
+    def test_soft_delete_program(self):
+        self.program.soft_delete(self.session)
+        self.session.commit()
+        assert self.datasets[0].last_record_update is None
+
+        info = Mock(context={"dbsession": self.session})
+        mutations.resolve_restore_program(None, info, self.program.id)
+        assert self.datasets[0].last_record_update is not None
+
+
+class TestUserCache(BaseDatabaseTest):
+    """Test the per-process cache of authenticated users."""
+
+    def setUp(self):
+        super().setUp()
+        self.user_db = user.SQLAlchemyORMUserDatabase(self.Session)
+
+    async def test_get_cached(self):
+        first = await self.user_db.get(self.member.id)
+        queries = self.count_queries()
+        second = await self.user_db.get(self.member.id)
+
+        assert queries == []
+        assert second == first
+        assert [team.name for team in second.teams] == ["Team"]
+
+    async def test_get_returns_copies(self):
+        first = await self.user_db.get(self.member.id)
+        first.email = "changed@notrealemail.info"
+
+        second = await self.user_db.get(self.member.id)
+        assert second.email == "member@notrealemail.info"
+        assert second is not first
+
+    async def test_get_orm_user_cached(self):
+        await self.user_db.get(self.member.id)
+        queries = self.count_queries()
+
+        session = self.Session()
+        dbuser = await self.user_db.get_orm_user(session, self.member.id)
+        assert dbuser.get_role_names() == frozenset()
+        assert [team.name for team in dbuser.teams] == ["Team"]
+        assert queries == []
+        session.close()
+
+    async def test_update_invalidates(self):
+        member = await self.user_db.get(self.member.id)
+        member.first_name = "Changed"
+        await self.user_db.update(member)
+
+        assert user.user_cache.get(self.member.id) is None
+        member = await self.user_db.get(self.member.id)
+        assert member.first_name == "Changed"
+
+    async def test_get_in_request_session(self):
+        session = self.Session()
+        token = user.request_session.set(session)
+        try:
+            dbuser = await self.user_db.get_orm_user(session, self.member.id)
+            await self.user_db.get(self.member.id)
+        finally:
+            user.request_session.reset(token)
+
+        # The request's user is still attached to its session.
+        assert dbuser in session
+        assert [team.name for team in dbuser.teams] == ["Team"]
+        cached_user = user.user_cache.get(self.member.id)
+        assert cached_user.orm_user not in session
+        session.close()
+
+    async def test_invalidate_by_string_id(self):
+        await self.user_db.get(self.member.id)
+        user.invalidate_cached_users(str(self.member.id))
+        assert user.user_cache.get(self.member.id) is None
+
+
+class TestBoundedExecutor(unittest.IsolatedAsyncioTestCase):
+    """Test the thread pool running blocking work."""
+
+    async def test_run(self):
+        pool = executor.BoundedExecutor(2, "test")
+
+        def run():
+            return pool.stats()
+
+        stats_while_running = await pool.run(run)
+        assert stats_while_running["active"] == 1
+        assert stats_while_running["queued"] == 0
+
+        assert await pool.run(lambda a, b: a + b, 1, 2) == 3
+        with self.assertRaises(ValueError):
+            await pool.run(int, "not a number")
+
+        pool_stats = pool.stats()
+        assert pool_stats["size"] == 2
+        assert pool_stats["active"] == 0
+        assert pool_stats["queued"] == 0
+        assert pool_stats["completed"] == 3
+        assert pool_stats["run_seconds"] >= 0
+
+    async def test_bounded(self):
+        pool = executor.BoundedExecutor(1, "test")
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        blocked = asyncio.ensure_future(pool.run(block))
+        queued = asyncio.ensure_future(pool.run(lambda: None))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        assert pool.stats()["active"] == 1
+        assert pool.stats()["queued"] == 1
+
+        release.set()
+        await asyncio.gather(blocked, queued)
+        assert pool.stats()["completed"] == 2
+
+    async def test_context_carries_over(self):
+        pool = executor.BoundedExecutor(1, "test")
+        session = Mock()
+        token = user.request_session.set(session)
+        try:
+            assert await pool.run(user.request_session.get) is session
+        finally:
+            user.request_session.reset(token)
+
+
+class TestAppRequests(BaseDatabaseTest):
+    """Test the request handling of the app."""
+
+    def setUp(self):
+        super().setUp()
+        self.get_db_session = app.extra["get_db_session"]
+        self.sessions = []
+
+        def get_db_session():
+            session = self.Session()
+            self.sessions.append(session)
+            return session
+
+        app.extra["get_db_session"] = get_db_session
+        self.client = TestClient(app)
+
+    def tearDown(self):
+        app.extra["get_db_session"] = self.get_db_session
+        super().tearDown()
+
+    def test_session_created_lazily(self):
+        response = self.client.get("/metrics")
+        assert response.status_code == 200
+        assert set(response.json()) == {"cache", "resolver_pool", "password_pool"}
+        assert self.sessions == []
+
+        response = self.client.get("/health")
+        assert response.status_code == 200
+        assert response.text == "Org"
+        assert len(self.sessions) == 1
+
+    def test_graphql_query(self):
+        token = get_valid_token("fastapi-users:auth", user_id=str(self.member.id))
+        response = self.client.post(
+            "/graphql/",
+            json={
+                "query": "query GetDataset($id: ID!) { dataset(id: $id) { name } }",
+                "variables": {"id": str(self.datasets[0].id)},
+            },
+            cookies={"rtauth": token},
+        )
+        assert response.status_code == 200
+        assert response.json() == {"data": {"dataset": {"name": "Dataset 0"}}}
+        # The user lookup and the resolvers share the request's session.
+        assert len(self.sessions) == 1
+
+    def test_graphql_not_authenticated(self):
+        response = self.client.post(
+            "/graphql/",
+            json={"query": '{ dataset(id: "%s") { name } }' % self.datasets[0].id},
+        )
+        assert response.json()["errors"][0]["message"].startswith("Lacking permission")
+
+    def test_graphql_mutation_on_pool(self):
+        completed = executor.resolver_executor.stats()["completed"]
+        response = self.client.post(
+            "/graphql/",
+            json={
+                "query": 'mutation { deleteDataset(id: "%s") }' % self.datasets[0].id,
+            },
+        )
+        assert response.json()["errors"][0]["message"].startswith("Lacking permission")
+        # The request's user is loaded on the pool as well.
+        assert executor.resolver_executor.stats()["completed"] == completed + 2
+
+    def test_needs_event_loop(self):
+        assert not needs_event_loop({"query": "{ dataset(id: 1) { name } }"})
+        assert not needs_event_loop({"query": "mutation { deleteDataset(id: 1) }"})
+        assert needs_event_loop({"query": "mutation { configureApp(input: {}) }"})
+        assert needs_event_loop(
+            {
+                "query": "mutation A { deleteDataset(id: 1) } "
+                "mutation B { configureApp(input: {}) }",
+                "operationName": "B",
+            }
+        )
+        assert needs_event_loop(
+            {"query": "mutation { ...F } fragment F on Mutation { deleteDataset }"}
+        )
+        assert not needs_event_loop({"query": "mutation {"})
+
+
+class TestPasswords(BaseDatabaseTest):
+    """Test hashing and verifying passwords on the password pool."""
+
+    async def asyncSetUp(self):
+        self.member.hashed_password = await user.hash_password("password")
+        self.session.commit()
+        self.user_db = user.SQLAlchemyORMUserDatabase(self.Session)
+
+    async def authenticate(self, email, password):
+        return await self.user_db.authenticate(Mock(username=email, password=password))
+
+    async def test_hash_password(self):
+        completed = executor.password_executor.stats()["completed"]
+        hashed_password = await user.hash_password("secret")
+        assert hashed_password != "secret"
+        assert await user.verify_and_update_password("secret", hashed_password) == (
+            True,
+            None,
+        )
+        verified, _ = await user.verify_and_update_password("wrong", hashed_password)
+        assert not verified
+        assert executor.password_executor.stats()["completed"] == completed + 3
+
+    async def test_authenticate(self):
+        member = await self.authenticate("member@notrealemail.info", "password")
+        assert member.id == self.member.id
+
+        self.session.expire_all()
+        assert self.session.get(User, self.member.id).last_login is not None
+
+    async def test_authenticate_invalid(self):
+        completed = executor.password_executor.stats()["completed"]
+        assert await self.authenticate("member@notrealemail.info", "wrong") is None
+        # Unknown emails are hashed anyway.
+        assert await self.authenticate("nobody@notrealemail.info", "password") is None
+        assert executor.password_executor.stats()["completed"] == completed + 2
+
+
+class SyncAsyncSession:
+    """Async session interface over a sync session, standing in for an
+    `AsyncSession` since the tests don't have an async database driver."""
+
+    def __init__(self, session):
+        self.session = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.session.close()
+
+    async def run_sync(self, func):
+        return func(self.session)
+
+    async def get(self, *args, **kwargs):
+        return self.session.get(*args, **kwargs)
+
+
+class TestAsyncUserDatabase(BaseDatabaseTest):
+    """Test the user lookups through an async session factory."""
+
+    def setUp(self):
+        super().setUp()
+        self.user_db = user.SQLAlchemyORMUserDatabase(
+            Mock(side_effect=AssertionError("Used the sync session factory")),
+            lambda: SyncAsyncSession(self.Session()),
+        )
+
+    async def test_get(self):
+        member = await self.user_db.get(self.member.id)
+        assert member.email == "member@notrealemail.info"
+        assert [team.name for team in member.teams] == ["Team"]
+
+        admin = await self.user_db.get_by_email("ADMIN@notrealemail.info")
+        assert admin.is_superuser
+
+    async def test_get_orm_user(self):
+        session = self.Session()
+        dbuser = await self.user_db.get_orm_user(session, self.member.id)
+        assert dbuser in session
+
+        queries = self.count_queries()
+        assert [team.name for team in dbuser.teams] == ["Team"]
+        assert queries == []
+        assert await self.user_db.get_orm_user(session, uuid4()) is None
+        session.close()
+
+
+def has_aiosqlite():
+    """Check whether SQLAlchemy can connect to SQLite through aiosqlite."""
+    try:
+        create_async_engine("sqlite+aiosqlite://")
+    except (ImportError, sqlalchemy.exc.NoSuchModuleError):
+        return False
+    return True
+
+
+@unittest.skipUnless(has_aiosqlite(), "needs aiosqlite and SQLAlchemy's dialect for it")
+class TestAsyncSessionUserDatabase(unittest.IsolatedAsyncioTestCase):
+    """Test the user lookups through a real `AsyncSession`, on aiosqlite."""
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{self.directory.name}/test.db"
+        self.engine = create_engine(url)
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        self.member_id = uuid4()
+        with self.Session() as session:
+            team = Team(name="Team", organization=Organization(name="Org"))
+            session.add(
+                User(
+                    id=self.member_id,
+                    email="member@notrealemail.info",
+                    username="member",
+                    hashed_password="x",
+                    first_name="member",
+                    last_name="member",
+                    teams=[team],
+                )
+            )
+            session.commit()
+
+        self.async_engine = create_async_engine(
+            url.replace("sqlite", "sqlite+aiosqlite", 1)
+        )
+        self.user_db = user.SQLAlchemyORMUserDatabase(
+            Mock(side_effect=AssertionError("Used the sync session factory")),
+            sessionmaker(bind=self.async_engine, class_=AsyncSession),
+        )
+        user.user_cache.clear()
+
+    async def asyncTearDown(self):
+        await self.async_engine.dispose()
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    async def test_get(self):
+        member = await self.user_db.get(self.member_id)
+        assert member.email == "member@notrealemail.info"
+        assert [team.name for team in member.teams] == ["Team"]
+
+        member = await self.user_db.get_by_email("MEMBER@notrealemail.info")
+        assert member.id == self.member_id
+        assert not member.is_superuser
+
+    async def test_get_orm_user(self):
+        with self.Session() as session:
+            dbuser = await self.user_db.get_orm_user(session, self.member_id)
+            assert dbuser in session
+            assert [team.name for team in dbuser.teams] == ["Team"]
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,20 +1,361 @@
-from database import Cache
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+import asyncio
+import datetime
 import logging
+import threading
+import time
+
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from database import Cache, CacheGeneration, advisory_xact_lock
+from settings import settings
+
+
+class LRUCache:
+    """Thread-safe, size-bounded in-memory cache with expiring entries."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        """Create an empty cache.
+
+        :param maxsize: Maximum number of entries to keep
+        :param ttl: Number of seconds after which an entry expires
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None) -> Any:
+        """Get an entry, if it exists and has not expired.
+
+        :param key: Cache key
+        :param default: Value to return on a miss
+        :returns: Cached value, or the default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        """Add or replace an entry, evicting the least recently used one if the
+        cache is full.
+
+        :param key: Cache key
+        :param value: Value to cache
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        """Remove an entry, if it exists.
+
+        :param key: Cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        """Get the size and hit/miss counters of the cache.
+
+        :returns: Dictionary of statistics
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# Per-worker tier in front of the `cache` table. Invalidations only clear the
+# tier of the worker that made them, so other workers can serve stale objects
+# for up to `cache_lru_ttl` seconds.
+local_cache = LRUCache(settings.cache_lru_size, settings.cache_lru_ttl)
+
+
+# Key of the `Session.info` flag marking transactions that invalidated the
+# cached objects.
+_INVALIDATED = "invalidated_cached_objects"
+
+
+@event.listens_for(Session, "after_commit")
+def _clear_local_cache_after_invalidation(session):
+    if session.info.pop(_INVALIDATED, False):
+        local_cache.clear()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_invalidation(session):
+    session.info.pop(_INVALIDATED, None)
+
+
+def get_cache_generation(session) -> int:
+    """Get the current generation of the cached objects.
+
+    :param session: Database session
+    :returns: Generation number
+    """
+    generation = session.get(CacheGeneration, CacheGeneration.DEFAULT)
+    return generation.generation if generation else 0
+
+
+def invalidate_cached_objects(session):
+    """Bump the cache generation so that cached objects get recomputed.
+
+    Call this from mutations that change the inputs of cached objects, before
+    committing, so the invalidation is part of the same transaction.
+
+    :param session: Database session
+    """
+    updated = (
+        session.query(CacheGeneration)
+        .filter(CacheGeneration.id == CacheGeneration.DEFAULT)
+        .update(
+            {CacheGeneration.generation: CacheGeneration.generation + 1},
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        session.add(CacheGeneration(id=CacheGeneration.DEFAULT, generation=1))
+    # Until the new generation is committed, other threads still read the
+    # previous one and may put its objects back in memory, so the tier is
+    # only cleared once the transaction commits.
+    session.info[_INVALIDATED] = True
+
+
+def _get_document(session, key, generation):
+    """Get the document cached for a key in the database, if there is one.
+
+    :param session: Database session
+    :param key: Cache key
+    :param generation: Cache generation
+    :returns: Cached document, or None
+    """
+    return session.scalar(
+        select(Cache.document).where(Cache.id == Cache.make_id(key, generation))
+    )
+
+
+def _get_previous_document(session, key, generation):
+    """Get the most recent document cached for a key in an older generation.
+
+    :param session: Database session
+    :param key: Cache key
+    :param generation: Current cache generation
+    :returns: Stale cached document, or None
+    """
+    return session.scalar(
+        select(Cache.document)
+        .where(Cache.key == key, Cache.generation < generation)
+        .order_by(Cache.generation.desc())
+        .limit(1)
+    )
+
+
+def _lock(session, key, generation, wait: bool) -> bool:
+    """Take the lock for computing a cached object.
+
+    It is held until the end of the transaction, so that only one worker
+    computes a missing object at a time.
+
+    :param session: Database session
+    :param key: Cache key
+    :param generation: Cache generation
+    :param wait: Whether to wait for the lock if it is taken
+    :returns: True if the lock was taken
+    """
+    return advisory_xact_lock(session, Cache.make_id(key, generation), wait)
+
+
+def _store_document(session, key, generation, document):
+    """Add or replace the document cached for a key in the database.
+
+    :param session: Database session
+    :param key: Cache key
+    :param generation: Cache generation
+    :param document: Document to cache
+    """
+    session.merge(
+        Cache(
+            id=Cache.make_id(key, generation),
+            key=key,
+            generation=generation,
+            document=document,
+            created=func.now(),
+        )
+    )
 
 
 def get_or_create_cached_object(session, key, new_func):
+    """Get a cached object, computing it if it is not cached yet.
+
+    Objects are looked up in the in-memory tier first, then in the database.
+    On a miss, only one worker computes the object. Workers that miss the
+    same object in the meantime serve the previous generation's object if
+    there is one, or else wait for the computation to finish.
+
+    The database work runs in a session of its own, so the caller's session
+    (e.g. a request's) is neither committed nor rolled back.
+
+    :param session: Database session, whose engine is used for the cache
+    :param key: Cache key
+    :param new_func: Function computing the object given a session
+    :returns: Cached object
+    """
+    cached_object = local_cache.get(key)
+    if cached_object is not None:
+        return cached_object
 
     cached_object = {}
 
+    cache_session = Session(bind=session.get_bind())
     try:
-        db_cached_object = session.get(Cache, key)
-        if not db_cached_object:
-            cached_object = new_func(session)
-            session.add(Cache(id=key, document=cached_object))
-            session.commit()
-        else:
-            cached_object = db_cached_object.document
+        generation = get_cache_generation(cache_session)
+        document = _get_document(cache_session, key, generation)
+
+        if document is None and not _lock(
+            cache_session, key, generation, wait=False
+        ):
+            previous_document = _get_previous_document(
+                cache_session, key, generation
+            )
+            if previous_document is not None:
+                # Don't wait for the new object, and don't keep the stale
+                # object in memory.
+                return previous_document
+            _lock(cache_session, key, generation, wait=True)
+
+        if document is None:
+            # Check again, in case the object was computed while waiting.
+            document = _get_document(cache_session, key, generation)
+
+        if document is None:
+            document = new_func(cache_session)
+            _store_document(cache_session, key, generation, document)
+
+        # Commit to store the object and release the lock.
+        cache_session.commit()
+        local_cache.set(key, document)
+        cached_object = document
     except Exception as ex:
+        cache_session.rollback()
         logging.error(ex)
+    finally:
+        cache_session.close()
 
     return cached_object
+
+
+def refresh_cached_object(session, key, new_func, max_age: int) -> bool:
+    """Recompute a cached object if it is missing or older than `max_age`.
+
+    Unlike `get_or_create_cached_object`, this never waits: if another worker
+    is already computing the object it is left alone.
+
+    :param session: Database session
+    :param key: Cache key
+    :param new_func: Function computing the object given a session
+    :param max_age: Number of seconds after which the object is recomputed
+    :returns: True if the object was recomputed
+    """
+
+    def is_fresh(generation):
+        cutoff = session.scalar(select(func.now())) - datetime.timedelta(
+            seconds=max_age
+        )
+        return session.scalar(
+            select(Cache.id).where(
+                Cache.id == Cache.make_id(key, generation), Cache.created >= cutoff
+            )
+        )
+
+    generation = get_cache_generation(session)
+    if is_fresh(generation) or not _lock(session, key, generation, wait=False):
+        session.commit()
+        return False
+
+    # Check again, in case the object was computed before taking the lock.
+    if is_fresh(generation):
+        session.commit()
+        return False
+
+    _store_document(session, key, generation, new_func(session))
+    session.commit()
+    local_cache.delete(key)
+    return True
+
+
+def sweep_cached_objects(session, max_age: int):
+    """Evict cached objects from previous generations, and objects older than
+    `max_age` (e.g. objects keyed by a date that has passed).
+
+    :param session: Database session
+    :param max_age: Number of seconds after which objects are evicted
+    :returns: Number of evicted objects
+    """
+    generation = get_cache_generation(session)
+    cutoff = session.scalar(select(func.now())) - datetime.timedelta(seconds=max_age)
+    count = (
+        session.query(Cache)
+        .filter(
+            or_(
+                Cache.generation < generation,
+                Cache.generation == None,
+                Cache.created < cutoff,
+            )
+        )
+        .delete(synchronize_session=False)
+    )
+    session.commit()
+    return count
+
+
+async def sweep_cached_objects_periodically(
+    session_factory, interval: int, max_age: int
+):
+    """Evict stale cached objects every `interval` seconds.
+
+    :param session_factory: Function returning a new database session
+    :param interval: Number of seconds between sweeps
+    :param max_age: Number of seconds after which objects are evicted
+    """
+
+    def sweep():
+        session = session_factory()
+        try:
+            return sweep_cached_objects(session, max_age)
+        finally:
+            session.close()
+
+    while True:
+        try:
+            count = await run_in_threadpool(sweep)
+            if count:
+                logging.info(f"Evicted {count} stale cached objects")
+        except Exception as ex:
+            logging.error(ex)
+        await asyncio.sleep(interval)
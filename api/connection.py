@@ -1 +1 @@
-from seed import connection
+from seed import async_connection, connection
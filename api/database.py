@@ -1,7 +1,7 @@
 # Define and manage database schema.
 
 from email.message import EmailMessage
-from typing import Optional
+from typing import Dict, FrozenSet, List, Optional
 import uuid
 from sqlalchemy import (
     Table,
@@ -12,10 +12,16 @@ from sqlalchemy import (
     DateTime,
     Text,
     ForeignKey,
+    Index,
     UniqueConstraint,
     func,
+    literal,
+    select,
+    text,
+    union_all,
 )
 from sqlalchemy.orm import (
+    object_session,
     relationship,
     selectinload,
     validates,
@@ -72,6 +78,26 @@ dataset_person_types = Table(
 )
 
 
+def advisory_xact_lock(session, name: str, wait: bool = True) -> bool:
+    """Take a named lock held until the end of the session's transaction.
+
+    This is a Postgres advisory lock. Other databases (e.g. SQLite in tests)
+    don't support it, so the lock is always granted there.
+
+    :param session: Database session
+    :param name: Name of the lock, e.g. "dataset_consistency:<id>:2021"
+    :param wait: Whether to wait for the lock if it is taken
+    :returns: True if the lock was taken
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return True
+    lock_id = func.hashtext(name)
+    if wait:
+        session.execute(select(func.pg_advisory_xact_lock(lock_id)))
+        return True
+    return session.scalar(select(func.pg_try_advisory_xact_lock(lock_id)))
+
+
 class PermissionsMixin:
     """Base class defining some common permissions checks."""
 
@@ -83,6 +109,106 @@ class PermissionsMixin:
         """
         return False
 
+    def in_team_membership(self, membership: "TeamMembership") -> bool:
+        """Check whether an object is accessible through a user's teams.
+
+        This is equivalent to `user_is_team_member`, but only tests the IDs
+        of the object against the precomputed memberships of the user, instead
+        of loading the relationships up to the team.
+
+        :param membership: Team memberships of the user
+        :returns: True if user's team has permission to see the object
+        """
+        return False
+
+
+class TeamMembership:
+    """IDs of the teams of a user, and of the objects that belong to them."""
+
+    def __init__(
+        self,
+        team_ids: FrozenSet[uuid.UUID] = frozenset(),
+        program_ids: FrozenSet[uuid.UUID] = frozenset(),
+        dataset_ids: FrozenSet[uuid.UUID] = frozenset(),
+        target_ids: FrozenSet[uuid.UUID] = frozenset(),
+    ):
+        self.team_ids = team_ids
+        self.program_ids = program_ids
+        self.dataset_ids = dataset_ids
+        self.target_ids = target_ids
+        # Dataset IDs of the records looked up so far, by record ID.
+        self.record_dataset_ids: Dict[uuid.UUID, Optional[uuid.UUID]] = {}
+
+    def get_record_dataset_id(
+        self, session, record_id: uuid.UUID
+    ) -> Optional[uuid.UUID]:
+        """Get the ID of the dataset of a record.
+
+        A record that wasn't looked up yet is looked up together with the
+        records of all the entries in the session, so that checking the entries
+        being resolved takes a single query rather than one per entry.
+
+        :param session: Database session
+        :param record_id: Record ID
+        :returns: Dataset ID, if the record exists
+        """
+        if record_id not in self.record_dataset_ids:
+            record_ids = {record_id}
+            for obj in session.identity_map.values():
+                if isinstance(obj, Entry):
+                    # Don't refresh expired entries for this.
+                    record_ids.add(obj.__dict__.get("record_id"))
+            record_ids -= self.record_dataset_ids.keys() | {None}
+            self.record_dataset_ids.update(dict.fromkeys(record_ids))
+            self.record_dataset_ids.update(
+                session.execute(
+                    select(Record.id, Record.dataset_id).where(
+                        Record.id.in_(record_ids)
+                    )
+                ).all()
+            )
+        return self.record_dataset_ids[record_id]
+
+    @classmethod
+    def for_user(cls, session, user: "Optional[User]") -> "TeamMembership":
+        """Look up the team memberships of a user with a single query.
+
+        :param session: Database session
+        :param user: User object (could be None)
+        :returns: Team memberships of the user
+        """
+        if not user:
+            return cls()
+
+        teams = select(user_teams.c.team_id).where(user_teams.c.user_id == user.id)
+        programs = select(Program.id).where(Program.team_id.in_(teams))
+        rows = session.execute(
+            union_all(
+                select(literal("team"), user_teams.c.team_id).where(
+                    user_teams.c.user_id == user.id
+                ),
+                select(literal("program"), Program.id).where(
+                    Program.team_id.in_(teams)
+                ),
+                select(literal("dataset"), Dataset.id).where(
+                    Dataset.program_id.in_(programs)
+                ),
+                select(literal("target"), Target.id).where(
+                    Target.program_id.in_(programs)
+                ),
+            )
+        )
+
+        ids = {"team": set(), "program": set(), "dataset": set(), "target": set()}
+        for kind, id_ in rows:
+            ids[kind].add(id_)
+        return cls(
+            team_ids=frozenset(ids["team"]),
+            program_ids=frozenset(ids["program"]),
+            dataset_ids=frozenset(ids["dataset"]),
+            target_ids=frozenset(ids["target"]),
+        )
+
 
 class Organization(Base):
     __tablename__ = "organization"
@@ -117,6 +243,9 @@ class Team(Base, PermissionsMixin):
             return False
         return self in user.teams
 
+    def in_team_membership(self, membership):
+        return self.id in membership.team_ids
+
 
 class User(Base, SQLAlchemyBaseUserTable):
     __tablename__ = "user"
@@ -137,6 +266,16 @@ class User(Base, SQLAlchemyBaseUserTable):
     def get_full_name(user):
         return f"{user.first_name} {user.last_name}"
 
+    def get_role_names(self) -> FrozenSet[str]:
+        """Get the names of the roles of the user.
+
+        This loads the roles of the user. Callers that check roles repeatedly
+        should keep the result, e.g. for the duration of a request.
+
+        :returns: Immutable set of role names
+        """
+        return frozenset(role.name for role in self.roles)
+
     @classmethod
     def get_by_email(cls, session, email: str) -> "Optional[User]":
         """Get a user by their email address.
@@ -247,6 +386,9 @@ class Program(Base, PermissionsMixin):
     def user_is_team_member(self, user):
         return self.team.user_is_team_member(user)
 
+    def in_team_membership(self, membership):
+        return self.id in membership.program_ids
+
     def soft_delete(self, session):
         self.deleted = func.now()
         session.add(self)
@@ -340,6 +482,9 @@ class Target(Base, PermissionsMixin):
     def user_is_team_member(self, user):
         return self.program.user_is_team_member(user)
 
+    def in_team_membership(self, membership):
+        return self.id in membership.target_ids
+
     @classmethod
     def get_by_programme_category(self, session, prog_id, category_id):
         return (
@@ -378,7 +523,10 @@ class Track(Base, PermissionsMixin):
     deleted = Column(TIMESTAMP)
 
     def user_is_team_member(self, user):
-        return self.program.user_is_team_member(user)
+        return self.target.user_is_team_member(user)
+
+    def in_team_membership(self, membership):
+        return self.target_id in membership.target_ids
 
     @classmethod
     def get_by_target_category_value(self, session, target_id, category_value_id):
@@ -587,6 +735,9 @@ class Dataset(Base, PermissionsMixin):
     program = relationship("Program", back_populates="datasets")
     program_id = Column(GUID, ForeignKey("program.id"), index=True)
     records = relationship("Record")
+    # Date of the last update to a record of the dataset that isn't deleted,
+    # kept up to date by `refresh_last_record_update` when records change.
+    last_record_update = Column(TIMESTAMP)
     published_record_sets = relationship("PublishedRecordSet")
     tags = relationship("Tag", secondary=dataset_tags, back_populates="datasets")
     custom_columns = relationship(
@@ -610,12 +761,10 @@ class Dataset(Base, PermissionsMixin):
 
     @classmethod
     def get_not_deleted(cls, session, id_):
+        # Records are not loaded here, since this is also used for permission
+        # checks. The `records` field of the GraphQL type loads them on demand.
         return (
             session.query(Dataset)
-            .options(
-                selectinload(Dataset.records),
-                with_loader_criteria(Record, Record.deleted == None),
-            )
             .filter(Dataset.id == id_, Dataset.deleted == None)
             .scalar()
         )
@@ -623,12 +772,36 @@ class Dataset(Base, PermissionsMixin):
     def user_is_team_member(self, user):
         return self.program.user_is_team_member(user)
 
+    def in_team_membership(self, membership):
+        return self.id in membership.dataset_ids
+
     def soft_delete(self, session):
         self.deleted = func.now()
         session.add(self)
         records = session.query(Record).filter(Record.dataset_id == self.id).all()
         for record in records:
             record.soft_delete(session)
+        session.flush()
+        Dataset.refresh_last_record_update(session, self.id)
+
+    @classmethod
+    def refresh_last_record_update(cls, session, dataset_id):
+        """Recompute the date of the last update to a record of a dataset.
+
+        Call this after flushing changes to the records of the dataset.
+
+        :param session: Database session
+        :param dataset_id: ID of the dataset
+        """
+        last_record_update = (
+            select(func.max(Record.updated))
+            .where(Record.dataset_id == dataset_id, Record.deleted == None)
+            .scalar_subquery()
+        )
+        session.query(Dataset).filter(Dataset.id == dataset_id).update(
+            {Dataset.last_record_update: last_record_update},
+            synchronize_session="fetch",
+        )
 
     @classmethod
     def upsert_datasets(cls, session, dataset_dicts):
@@ -774,6 +947,9 @@ class Record(Base, PermissionsMixin):
     def user_is_team_member(self, user):
         return self.dataset.user_is_team_member(user)
 
+    def in_team_membership(self, membership):
+        return self.dataset_id in membership.dataset_ids
+
     def soft_delete(self, session):
         self.deleted = func.now()
         session.add(self)
@@ -814,6 +990,12 @@ class Entry(Base, PermissionsMixin):
     def user_is_team_member(self, user):
         return self.record.user_is_team_member(user)
 
+    def in_team_membership(self, membership):
+        dataset_id = membership.get_record_dataset_id(
+            object_session(self), self.record_id
+        )
+        return dataset_id in membership.dataset_ids
+
     def soft_delete(self, session):
         self.deleted = func.now()
         session.add(self)
@@ -875,7 +1057,7 @@ class PublishedRecordSet(Base, PermissionsMixin):
     id = Column(GUID, primary_key=True, index=True, default=uuid.uuid4)
 
     begin = Column(DateTime, nullable=False)
-    end = Column(DateTime, nullable=False)
+    end = Column(DateTime, nullable=False, index=True)
 
     document = Column(MutableDict.as_mutable(JSONB))
 
@@ -887,9 +1069,33 @@ class PublishedRecordSet(Base, PermissionsMixin):
     # TODO(jnu): clarify why this is removed
     # __table_args__ = (UniqueConstraint("reporting_period_id"),)
 
+    # Serve the filters of the published record sets, which match the team,
+    # dataset group and tags stored in the document.
+    __table_args__ = (
+        Index(
+            "ix_published_record_set_team_name", text("(document ->> 'teamName')")
+        ),
+        Index(
+            "ix_published_record_set_dataset_group",
+            text("(document ->> 'datasetGroup')"),
+        ),
+        Index(
+            "ix_published_record_set_dataset_group_tags",
+            text("(document -> 'datasetGroupTags')"),
+            postgresql_using="gin",
+        ),
+    )
+
     dataset = relationship("Dataset", back_populates="published_record_sets")
     dataset_id = Column(GUID, ForeignKey("dataset.id"), index=True, nullable=False)
 
+    metrics = relationship(
+        "PublishedRecordSetMetric",
+        back_populates="published_record_set",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
     created = Column(TIMESTAMP, server_default=func.now(), nullable=False)
     updated = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     deleted = Column(TIMESTAMP)
@@ -897,6 +1103,19 @@ class PublishedRecordSet(Base, PermissionsMixin):
     def soft_delete(self, session):
         self.deleted = func.now()
 
+    def refresh_metrics(self, session):
+        """Re-extract the per-category metrics from the published document.
+
+        :param session: Database session
+        """
+        if self.metrics:
+            # Delete the old metrics first: the unit of work would otherwise
+            # insert the new ones before deleting the orphans, which breaks
+            # the unique constraint on the metrics.
+            self.metrics = []
+            session.flush()
+        self.metrics = PublishedRecordSetMetric.from_document(self.document)
+
     @classmethod
     def get_not_deleted(cls, session, id_):
         return (
@@ -906,6 +1125,142 @@ class PublishedRecordSet(Base, PermissionsMixin):
         )
 
 
+class PublishedRecordSetMetric(Base):
+    """Per-category percentages extracted from a published record set.
+
+    The published documents are broken down into one row per category and
+    segment when they are published, so that the dashboard statistics can be
+    aggregated without parsing the JSONB documents at read time.
+    """
+
+    __tablename__ = "published_record_set_metric"
+
+    # Segment name used for the overall (non-segmented) record.
+    EVERYONE = "Everyone"
+
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
+
+    published_record_set = relationship(
+        "PublishedRecordSet", back_populates="metrics"
+    )
+    published_record_set_id = Column(
+        GUID,
+        ForeignKey("published_record_set.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+
+    # Whether the row comes from the `segmentedRecord` (by person type) rather
+    # than the overall `record` of the document.
+    segmented = Column(Boolean, nullable=False)
+    # Either "Everyone" or the person type of a segmented record.
+    segment = Column(String(255), nullable=False)
+    category = Column(String(255), nullable=False)
+
+    target_member_percent = Column(Float, nullable=False)
+    non_target_member_percent = Column(Float, nullable=False)
+    target = Column(Float)
+
+    __table_args__ = (
+        UniqueConstraint(
+            "published_record_set_id",
+            "segmented",
+            "segment",
+            "category",
+            name="uix_published_record_set_metric",
+        ),
+        Index(
+            "ix_published_record_set_metric_category",
+            "category",
+            "segmented",
+            "segment",
+        ),
+    )
+
+    @classmethod
+    def from_document(cls, document) -> "List[PublishedRecordSetMetric]":
+        """Extract the metrics from a published record set document.
+
+        Only percentages that are zero or positive are counted, and entries
+        that don't say whether they are target members are ignored.
+
+        :param document: Published record set document
+        :returns: List of (unsaved) metric objects
+        """
+        if not document:
+            return []
+
+        targets = {}
+        for target in document.get("targets") or []:
+            if isinstance(target, dict):
+                targets.setdefault(target.get("category"), target.get("target"))
+
+        metrics = []
+        for source, segmented in [("record", False), ("segmentedRecord", True)]:
+            for segment, categories in (document.get(source) or {}).items():
+                if not isinstance(categories, dict):
+                    continue
+                for category, values in categories.items():
+                    if not isinstance(values, dict) or not isinstance(
+                        values.get("entries"), dict
+                    ):
+                        continue
+
+                    percents = {True: 0.0, False: 0.0}
+                    for entry in values["entries"].values():
+                        percent = entry.get("percent")
+                        target_member = entry.get("targetMember")
+                        if (
+                            not isinstance(percent, (int, float))
+                            or percent < 0
+                            or not isinstance(target_member, bool)
+                        ):
+                            continue
+                        percents[target_member] += percent
+
+                    metrics.append(
+                        cls(
+                            segmented=segmented,
+                            segment=segment,
+                            category=category,
+                            target_member_percent=percents[True],
+                            non_target_member_percent=percents[False],
+                            target=targets.get(category),
+                        )
+                    )
+
+        return metrics
+
+
+class DatasetConsistency(Base):
+    """Whether a dataset consistently met its target for a category in a year.
+
+    This is kept up to date incrementally when record sets are published or
+    deleted, since the record sets of past years rarely change.
+    """
+
+    __tablename__ = "dataset_consistency"
+
+    id = Column(GUID, primary_key=True, default=uuid.uuid4)
+
+    dataset_id = Column(
+        GUID,
+        ForeignKey("dataset.id", ondelete="CASCADE"),
+        index=True,
+        nullable=False,
+    )
+    year = Column(Integer, nullable=False)
+    category = Column(String(255), nullable=False)
+    consistent = Column(Boolean, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            "dataset_id", "year", "category", name="uix_dataset_consistency"
+        ),
+        Index("ix_dataset_consistency_category", "category", "year"),
+    )
+
+
 class SentItem(Base, PermissionsMixin):
     __tablename__ = "sent_item"
 
@@ -947,4 +1302,32 @@ class Cache(Base, PermissionsMixin):
     __tablename__ = "cache"
 
     id = Column(String(255), primary_key=True, index=True)
+    key = Column(String(255), index=True)
+    generation = Column(Integer, index=True)
     document = Column(JSONB)
+
+    created = Column(TIMESTAMP, server_default=func.now())
+
+    @classmethod
+    def make_id(cls, key: str, generation: int) -> str:
+        """Get the ID of the cached object for a key in a cache generation.
+
+        :param key: Cache key, e.g. "headline_totals"
+        :param generation: Cache generation
+        :returns: Cache ID
+        """
+        return f"{key}@{generation}"
+
+
+class CacheGeneration(Base):
+    """Counter that is bumped whenever cached objects become stale."""
+
+    __tablename__ = "cache_generation"
+
+    # ID of the generation counter shared by all cached objects.
+    DEFAULT = "default"
+
+    id = Column(String(255), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+
+    updated = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
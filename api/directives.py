@@ -4,10 +4,10 @@ from graphql.type import (
     GraphQLField,
     GraphQLObjectType,
 )
-from database import PermissionsMixin, User, Dataset, Record
+from database import PermissionsMixin, User, Dataset, Record, TeamMembership
 from seed import is_blank_slate
 
-from typing import List, Iterable
+from typing import Dict, FrozenSet, Hashable, List, Iterable, Tuple
 
 
 class NotAuthorizedError(Exception):
@@ -22,6 +22,42 @@ class InvalidPermissionError(Exception):
     pass
 
 
+def get_team_membership(info) -> TeamMembership:
+    """Get the team memberships of the current user.
+
+    They are looked up on first use and kept for the rest of the request.
+
+    :param info: GraphQL context
+    :returns: Team memberships of the current user
+    """
+    membership = info.context.get("team_membership")
+    if membership is None:
+        membership = info.context["team_membership"] = TeamMembership.for_user(
+            info.context["dbsession"], info.context.get("current_user")
+        )
+    return membership
+
+
+def get_current_user_roles(info) -> FrozenSet[str]:
+    """Get the role names of the current user.
+
+    `app.get_request_user` loads them once per request (in
+    `app.load_request_user`, with `User.get_role_names` on the request's
+    session) into the request scope's `dbuser_roles`, which `app.get_context`
+    passes on as `current_user_roles`. They are loaded on first use if the
+    context doesn't have them (e.g. in tests).
+
+    :param info: GraphQL context
+    :returns: Immutable set of role names
+    """
+    roles = info.context.get("current_user_roles")
+    if roles is None:
+        current_user = info.context.get("current_user")
+        roles = current_user.get_role_names() if current_user else frozenset()
+        info.context["current_user_roles"] = roles
+    return roles
+
+
 def user_has_permission(permissions: Iterable[str], obj, info) -> bool:
     """Test if a user has permission to access this resolver.
 
@@ -54,11 +90,11 @@ def user_has_permission(permissions: Iterable[str], obj, info) -> bool:
         return False
 
     if "ADMIN" in permissions:
-        if any(role.name == "admin" for role in current_user.roles):
+        if "admin" in get_current_user_roles(info):
             return True
 
     if "PUBLISHER" in permissions:
-        if any(role.name == "publisher" for role in current_user.roles):
+        if "publisher" in get_current_user_roles(info):
             return True
 
     if "CURRENT_USER" in permissions:
@@ -75,10 +111,11 @@ def user_has_permission(permissions: Iterable[str], obj, info) -> bool:
         # the directive being configured incorrectly / the right check not
         # being implemented yet).
         checked = False
+        membership = get_team_membership(info)
         # This one's tricky because the exact procedure of the check depends on
         # what we're trying to resolve.
         if isinstance(obj, PermissionsMixin):
-            if obj.user_is_team_member(current_user):
+            if obj.in_team_membership(membership):
                 return True
             checked = True
 
@@ -92,21 +129,21 @@ def user_has_permission(permissions: Iterable[str], obj, info) -> bool:
                 checked = True
                 id_ = info.variable_values["input"]["datasetId"]
                 dataset = Dataset.get_not_deleted(session, id_)
-                if dataset and dataset.user_is_team_member(current_user):
+                if dataset and dataset.in_team_membership(membership):
                     return True
 
             if info.field_name == "updateRecord":
                 checked = True
                 id_ = info.variable_values["input"]["id"]
                 record = Record.get_not_deleted(session, id_)
-                if record and record.user_is_team_member(current_user):
+                if record and record.in_team_membership(membership):
                     return True
 
             if info.field_name == "deleteRecord":
                 checked = True
                 id_ = info.variable_values["id"]
                 record = Record.get_not_deleted(session, id_)
-                if record and record.user_is_team_member(current_user):
+                if record and record.in_team_membership(membership):
                     return True
 
         if not checked:
@@ -117,6 +154,39 @@ def user_has_permission(permissions: Iterable[str], obj, info) -> bool:
     return False
 
 
+def _permission_decision_key(permissions: frozenset, obj, info) -> Hashable:
+    """Get the key of a permission decision in the per-request memo.
+
+    Decisions only depend on the permissions, the object being resolved and
+    the current user, except on root fields where the object is missing and
+    the TEAM_MEMBER check looks at the field and its arguments instead. Those
+    are not memoized.
+
+    :param permissions: Frozen set of permissions
+    :param obj: GraphQL node the resolver is checking
+    :param info: GraphQL context
+    :returns: Memo key, or None if the decision can't be memoized
+    """
+    if obj is None:
+        return None
+    current_user = info.context.get("current_user")
+    user_id = current_user.id if current_user else None
+    return (permissions, type(obj), id(obj), user_id)
+
+
+def get_permission_decisions(info) -> Dict[Hashable, Tuple[object, bool]]:
+    """Get the memo of the permission decisions made during the request.
+
+    Decisions are stored with the object they were made for, which keeps the
+    object alive so that its `id` can't be reused by another object during the
+    request.
+
+    :param info: GraphQL context
+    :returns: Dictionary of (object, decision) by memo key
+    """
+    return info.context.setdefault("permission_decisions", {})
+
+
 class NeedsPermissionDirective(SchemaDirectiveVisitor):
     """Enforce a permissions for an object or a field.
 
@@ -159,7 +229,7 @@ class NeedsPermissionDirective(SchemaDirectiveVisitor):
         :param type_: GraphQL object type definition
         :returns: The updated type
         """
-        permissions = self.args[self.PERM_ARG]
+        permissions = frozenset(self.args[self.PERM_ARG])
 
         # For all the fields in this type, add the object-level permissions if
         # the field does not define its own. If the field has permissions set
@@ -183,7 +253,7 @@ class NeedsPermissionDirective(SchemaDirectiveVisitor):
         :returns: Modified field
         """
         # Set permissions, overriding anything previously set.
-        setattr(field, self.PERM_KEY, self.args[self.PERM_ARG])
+        setattr(field, self.PERM_KEY, frozenset(self.args[self.PERM_ARG]))
         self.resolve_field_with_permissions_check(field)
         return field
 
@@ -203,10 +273,22 @@ class NeedsPermissionDirective(SchemaDirectiveVisitor):
         original_resolver = field.resolve or default_field_resolver
 
         def resolve_field_with_permissions(obj, info, **kwargs):
-            permissions = set(getattr(field, self.PERM_KEY))
-            if not user_has_permission(permissions, obj, info):
+            permissions = getattr(field, self.PERM_KEY)
+
+            # The same decision applies to every field of an object that needs
+            # the same permissions, so it is only made once per request.
+            key = _permission_decision_key(permissions, obj, info)
+            if key is None:
+                allowed = user_has_permission(permissions, obj, info)
+            else:
+                decisions = get_permission_decisions(info)
+                if key not in decisions:
+                    decisions[key] = (obj, user_has_permission(permissions, obj, info))
+                allowed = decisions[key][1]
+
+            if not allowed:
                 raise NotAuthorizedError(
-                    "Lacking permission: " + ", ".join(permissions)
+                    "Lacking permission: " + ", ".join(sorted(permissions))
                 )
             return original_resolver(obj, info, **kwargs)
 
@@ -0,0 +1,101 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict
+import asyncio
+import contextvars
+import threading
+import time
+
+from settings import settings
+
+
+class BoundedExecutor:
+    """Fixed-size thread pool that keeps count and time of its tasks.
+
+    Blocking work (synchronous database queries in particular) runs here so
+    that it doesn't stall the event loop, and so that at most `max_workers`
+    of it runs at the same time in a worker process.
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str = ""):
+        """Create a thread pool.
+
+        :param max_workers: Number of threads
+        :param thread_name_prefix: Prefix of the names of the threads
+        """
+        self.max_workers = max_workers
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        # Total seconds tasks spent waiting for a thread, and running.
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix)
+        self._lock = threading.Lock()
+
+    def submit(self, func: Callable[..., Any], *args) -> Future:
+        """Submit a function to the pool.
+
+        :param func: Function to call
+        :param args: Arguments of the function
+        :returns: Future of the value returned by the function
+        """
+
+        def call():
+            started = time.monotonic()
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_seconds += started - submitted
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self.run_seconds += time.monotonic() - started
+
+        def forget_cancelled(future):
+            # Tasks cancelled before they started never ran `call`.
+            if future.cancelled():
+                with self._lock:
+                    self.queued -= 1
+
+        with self._lock:
+            self.queued += 1
+        submitted = time.monotonic()
+        # Like `asyncio.to_thread`, run in a copy of the caller's context so
+        # that context variables (e.g. the request's session) carry over.
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, call)
+        future.add_done_callback(forget_cancelled)
+        return future
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """Run a function on the pool and wait for its result.
+
+        :param func: Function to call
+        :param args: Arguments of the function
+        :returns: Value returned by the function
+        """
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    def stats(self) -> Dict[str, float]:
+        """Get the size, load and timings of the pool.
+
+        :returns: Dictionary of statistics
+        """
+        with self._lock:
+            return {
+                "size": self.max_workers,
+                "active": self.active,
+                "queued": self.queued,
+                "completed": self.completed,
+                "wait_seconds": self.wait_seconds,
+                "run_seconds": self.run_seconds,
+            }
+
+
+# Pool running the GraphQL resolvers and the user lookups of requests.
+resolver_executor = BoundedExecutor(settings.resolver_threads, "resolver")
+# Pool hashing and verifying passwords, which takes bcrypt a while on purpose.
+password_executor = BoundedExecutor(settings.password_hash_threads, "password")
@@ -0,0 +1,182 @@
+from typing import Any, Callable, Dict, Hashable, List, Union
+import asyncio
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import CategoryValue, Dataset, Entry, Program, Record, Team
+
+
+class DataLoader:
+    """Batch the loads of keys requested together into a single call.
+
+    Keys requested while resolving one level of a GraphQL query are collected
+    and loaded with one call to `batch_load` on the next turn of the event
+    loop, which avoids running one query per parent object (N+1 queries).
+    Loaded values are kept for the lifetime of the loader, which should be a
+    single request.
+
+    Outside of an event loop (e.g. with `graphql_sync`), keys are loaded right
+    away, one at a time.
+    """
+
+    def __init__(
+        self,
+        batch_load: Callable[[List[Hashable]], Dict[Hashable, Any]],
+        default: Callable[[], Any] = lambda: None,
+    ):
+        """Create a loader.
+
+        :param batch_load: Function returning a dictionary of values by key
+            given a list of keys
+        :param default: Function returning the value of keys that were not
+            found
+        """
+        self.batch_load = batch_load
+        self.default = default
+        self._values = {}
+        self._queue = []
+
+    def load(self, key: Hashable) -> Union[asyncio.Future, Any]:
+        """Load the value of a key.
+
+        :param key: Key to load
+        :returns: Future of the value, or the value itself outside of an
+            event loop
+        """
+        if key in self._values:
+            return self._values[key]
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            value = self.batch_load([key]).get(key, self.default())
+            self._values[key] = value
+            return value
+
+        future = loop.create_future()
+        self._values[key] = future
+        if not self._queue:
+            loop.call_soon(self._dispatch)
+        self._queue.append(key)
+        return future
+
+    def _dispatch(self):
+        """Load all the queued keys and resolve their futures."""
+        keys, self._queue = self._queue, []
+        try:
+            values = self.batch_load(keys)
+        except Exception as ex:
+            for key in keys:
+                # Forget the failed keys so that they can be loaded again.
+                self._values.pop(key).set_exception(ex)
+            return
+
+        for key in keys:
+            self._values[key].set_result(values.get(key, self.default()))
+
+
+def _group_by(rows, key: Callable[[Any], Hashable]) -> Dict[Hashable, List[Any]]:
+    """Group rows into lists by key.
+
+    :param rows: Iterable of rows
+    :param key: Function returning the key of a row
+    :returns: Dictionary of lists of rows by key
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row)
+    return groups
+
+
+class Loaders:
+    """Registry of the data loaders available to resolvers during a request."""
+
+    def __init__(self, session: Session):
+        """Create the loaders of a request.
+
+        :param session: Database session of the request
+        """
+        self.session = session
+
+        # Objects by ID, regardless of whether they were soft-deleted.
+        self.category_value = self._by_id(CategoryValue)
+        self.program = self._by_id(Program)
+        self.team = self._by_id(Team)
+
+        # Objects by ID, if they were not soft-deleted.
+        self.not_deleted_dataset = self._by_id(Dataset, Dataset.deleted == None)
+        self.not_deleted_category_value = self._by_id(
+            CategoryValue, CategoryValue.deleted == None
+        )
+
+        # Records of a dataset that are not deleted, by dataset ID.
+        self.dataset_records = DataLoader(self._load_dataset_records, default=list)
+        # Entries of a record, by record ID.
+        self.record_entries = DataLoader(self._load_record_entries, default=list)
+        # Sums of the entries of a dataset by category value, by dataset ID.
+        self.dataset_category_value_sums = DataLoader(
+            self._load_dataset_category_value_sums, default=list
+        )
+
+    def _by_id(self, model, *criteria) -> DataLoader:
+        """Create a loader of objects by ID.
+
+        :param model: Model class
+        :param criteria: Additional conditions on the objects
+        :returns: Data loader
+        """
+
+        def batch_load(ids):
+            objs = self.session.query(model).filter(model.id.in_(ids), *criteria)
+            return {obj.id: obj for obj in objs}
+
+        return DataLoader(batch_load)
+
+    def _load_dataset_records(self, dataset_ids):
+        records = (
+            self.session.query(Record)
+            .filter(Record.dataset_id.in_(dataset_ids), Record.deleted == None)
+            .order_by(Record.publication_date)
+        )
+        return _group_by(records, lambda record: record.dataset_id)
+
+    def _load_record_entries(self, record_ids):
+        entries = self.session.query(Entry).filter(Entry.record_id.in_(record_ids))
+        return _group_by(entries, lambda entry: entry.record_id)
+
+    def _load_dataset_category_value_sums(self, dataset_ids):
+        rows = (
+            self.session.query(
+                Record.dataset_id,
+                Entry.category_value_id,
+                func.sum(Entry.count).label("sum_of_counts"),
+            )
+            .join(Entry.record)
+            .filter(Record.dataset_id.in_(dataset_ids), Record.deleted == None)
+            .group_by(Record.dataset_id, Entry.category_value_id)
+        )
+        sums = [
+            {
+                "dataset_id": dataset_id,
+                "category_value_id": category_value_id,
+                "sum_of_counts": sum_of_counts,
+            }
+            for [dataset_id, category_value_id, sum_of_counts] in rows
+        ]
+        return _group_by(sums, lambda sum_: sum_["dataset_id"])
+
+
+def get_loaders(info) -> Loaders:
+    """Get the data loaders of the current request.
+
+    The loaders are created in `app.get_context`, but are created on first use
+    if the context doesn't have them (e.g. in tests).
+
+    :param info: GraphQL resolve info
+    :returns: Data loaders
+    """
+    loaders = info.context.get("loaders")
+    if loaders is None:
+        loaders = info.context["loaders"] = Loaders(info.context["dbsession"])
+    return loaders
@@ -3,6 +3,15 @@ import secrets
 
 from sqlalchemy import or_
 import mailer
+from cache import invalidate_cached_objects
+from user import (
+    UserCreateModel,
+    UserRole,
+    fastapi_users,
+    get_valid_token,
+    invalidate_cached_users,
+)
+from stats import refresh_dataset_consistency
 from more_itertools import chunked
 from ariadne import convert_kwargs_to_snake_case, ObjectType
 from settings import settings
@@ -68,6 +77,7 @@ def resolve_create_dataset(obj, info, input):
             session.add(new_tag)
     dataset = Dataset(tags=tags, **input)
     session.add(dataset)
+    invalidate_cached_objects(session)
     session.commit()
 
     return dataset
@@ -83,6 +93,7 @@ def resolve_delete_dataset(obj, info, id):
     dataset = Dataset.get_not_deleted(session, id)
     if dataset is not None:
         dataset.soft_delete(session)
+        invalidate_cached_objects(session)
     session.commit()
 
     return id
@@ -134,6 +145,8 @@ def resolve_create_record(obj, info, input):
         n_entries.append(Entry(inputter=current_user, **entry))
     record = Record(entries=n_entries, **input)
     session.add(record)
+    session.flush()
+    Dataset.refresh_last_record_update(session, record.dataset_id)
     session.commit()
 
     return record
@@ -189,6 +202,8 @@ def resolve_update_record(obj, info, input):
     for param in input:
         setattr(record, param, input[param])
     session.add(record)
+    session.flush()
+    Dataset.refresh_last_record_update(session, record.dataset_id)
     session.commit()
 
     return record
@@ -204,6 +219,8 @@ def resolve_delete_record(obj, info, id):
     record = Record.get_not_deleted(session, id)
     if record is not None:
         record.soft_delete(session)
+        session.flush()
+        Dataset.refresh_last_record_update(session, record.dataset_id)
     session.commit()
 
     return id
@@ -339,7 +356,9 @@ def resolve_create_team(obj, info, input):
     team.users += [session.merge(User(id=user_id)) for user_id in users]
 
     session.add(team)
+    invalidate_cached_objects(session)
     session.commit()
+    invalidate_cached_users(*users)
 
     return team
 
@@ -354,8 +373,12 @@ def resolve_update_team(obj, info, input):
 
     session = info.context["dbsession"]
     team = session.query(Team).get(input["id"])
+    # Users who join or leave the team must not be served from the user cache.
+    changed_user_ids = set()
     if "user_ids" in input:
         users = input.pop("user_ids")
+        changed_user_ids.update(user.id for user in team.users)
+        changed_user_ids.update(users)
         team.users = [session.merge(User(id=user_id)) for user_id in users]
     if "program_ids" in input:
         programs = input.pop("program_ids")
@@ -366,6 +389,7 @@ def resolve_update_team(obj, info, input):
         setattr(team, param, input[param])
     session.add(team)
     session.commit()
+    invalidate_cached_users(*changed_user_ids)
 
     return team
 
@@ -390,6 +414,7 @@ def resolve_delete_team(obj, info, id):
     if team.programs or team.users:
         raise Exception("Cannot delete non-empty team")
     session.query(Team).filter(Team.id == id).delete()
+    invalidate_cached_objects(session)
     session.commit()
 
     return id
@@ -435,6 +460,7 @@ def resolve_create_program(obj, info, input):
         program.targets.append(target)
 
     session.add(program)
+    invalidate_cached_objects(session)
     session.commit()
 
     return program
@@ -502,6 +528,7 @@ def resolve_update_program(obj, info, input):
         setattr(program, key, value)
 
     session.add(program)
+    invalidate_cached_objects(session)
     session.commit()
     return program
 
@@ -516,6 +543,7 @@ def resolve_delete_program(obj, info, id):
     program = Program.get_not_deleted(session, id)
     if program is not None:
         program.soft_delete(session)
+        invalidate_cached_objects(session)
     session.commit()
 
     return id
@@ -539,6 +567,10 @@ def resolve_restore_program(obj, info, id):
                     entry.deleted = None
         for target in program.targets:
             target.deleted = None
+        session.flush()
+        for dataset in program.datasets:
+            Dataset.refresh_last_record_update(session, dataset.id)
+        invalidate_cached_objects(session)
 
     session.commit()
 
@@ -596,7 +628,11 @@ def resolve_create_published_record_set(obj, info, input):
     if "document" in input:
         input["document"] = json.loads(input["document"])
     record = PublishedRecordSet(**input)
+    record.refresh_metrics(session)
     session.add(record)
+    session.flush()
+    refresh_dataset_consistency(session, record.dataset_id, record.end.year)
+    invalidate_cached_objects(session)
     session.commit()
 
     return record
@@ -619,6 +655,9 @@ def resolve_delete_published_record_set(obj, info, id):
     prs = session.query(PublishedRecordSet).get(id)
     if prs:
         session.delete(prs)
+        session.flush()
+        refresh_dataset_consistency(session, prs.dataset_id, prs.end.year)
+        invalidate_cached_objects(session)
         session.commit()
         return id
     raise Exception("Published record set not found")
@@ -630,6 +669,7 @@ def resolve_update_tag(obj, info, input):
     session = info.context["dbsession"]
     tag = Tag(**input)
     session.add(tag)
+    invalidate_cached_objects(session)
     session.commit()
     return tag
 
@@ -653,6 +693,7 @@ def resolve_update_tag(obj, info, id):
     tag = session.query(Tag).get(id)
     if tag:
         session.delete(tag)
+        invalidate_cached_objects(session)
         session.commit()
     return id
 
@@ -0,0 +1,104 @@
+"""Precompute the dashboard statistics in the background.
+
+The statistics are stored in the cache, so that resolvers only read them and
+never have to compute them during a request. They are recomputed when the
+cache is invalidated (e.g. after a record set is published) and at least
+every `precompute_interval` seconds.
+
+This runs as a single process of its own, next to the API, with
+
+    python -m precompute
+
+or inside each API process when `precompute_in_process` is set.
+"""
+import asyncio
+import logging
+
+import click
+from starlette.concurrency import run_in_threadpool
+
+from cache import refresh_cached_object
+from connection import connection
+from settings import settings
+from stats import (
+    get_basic_stats,
+    get_consistencies,
+    get_headline_totals,
+    get_overviews,
+)
+
+
+# Cache keys of the precomputed statistics, and the functions computing them.
+PRECOMPUTED = {
+    "headline_totals": get_headline_totals,
+    "basic_stats": get_basic_stats,
+    "consistencies": get_consistencies,
+    "overviews": get_overviews,
+}
+
+
+def refresh_precomputed_objects(session_factory, max_age: int):
+    """Recompute the precomputed statistics that are stale.
+
+    :param session_factory: Function returning a new database session
+    :param max_age: Number of seconds after which statistics are recomputed
+    :returns: Keys of the recomputed statistics
+    """
+    refreshed = []
+    for key, new_func in PRECOMPUTED.items():
+        session = session_factory()
+        try:
+            if refresh_cached_object(session, key, new_func, max_age):
+                refreshed.append(key)
+        except Exception as ex:
+            session.rollback()
+            logging.error(ex)
+        finally:
+            session.close()
+    return refreshed
+
+
+async def refresh_precomputed_objects_periodically(
+    session_factory, max_age: int, poll_interval: int
+):
+    """Check for stale statistics every `poll_interval` seconds.
+
+    Invalidating the cache makes all statistics stale, so they are recomputed
+    at most `poll_interval` seconds after a publish.
+
+    :param session_factory: Function returning a new database session
+    :param max_age: Number of seconds after which statistics are recomputed
+    :param poll_interval: Number of seconds between checks
+    """
+    while True:
+        try:
+            refreshed = await run_in_threadpool(
+                refresh_precomputed_objects, session_factory, max_age
+            )
+            if refreshed:
+                logging.info(f"Precomputed {', '.join(refreshed)}")
+        except Exception as ex:
+            logging.error(ex)
+        await asyncio.sleep(poll_interval)
+
+
+@click.command()
+@click.option("--once", is_flag=True, help="Refresh once and exit.")
+def run(once: bool):
+    """Keep the precomputed dashboard statistics up to date."""
+    if once:
+        refreshed = refresh_precomputed_objects(connection, 0)
+        print(f"✅ precomputed {', '.join(refreshed) or 'nothing'}")
+        return
+
+    asyncio.run(
+        refresh_precomputed_objects_periodically(
+            connection,
+            settings.precompute_interval,
+            settings.precompute_poll_interval,
+        )
+    )
+
+
+if __name__ == "__main__":
+    run()
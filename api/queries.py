@@ -1,21 +1,22 @@
-import time
 import logging
+from datetime import datetime
 from typing import cast
 from ariadne import convert_kwargs_to_snake_case, ObjectType
 from sqlalchemy.orm import Session
-from sqlalchemy import func, select
+from sqlalchemy import and_, func, or_, select
 from cache import get_or_create_cached_object
+from loaders import get_loaders
 from database import (
     CustomColumn,
     Dataset,
     PublishedRecordSet,
+    PublishedRecordSetMetric,
     ReportingPeriod,
     Target,
     User,
     Record,
     Category,
     CategoryValue,
-    Entry,
     Team,
     Role,
     PersonType,
@@ -26,13 +27,15 @@ from database import (
 )
 
 from stats import (
-    get_admin_needs_attention,
-    get_admin_overdue,
+    ADMIN_STATS_DURATIONS,
+    get_admin_stats,
+    get_admin_stats_key,
     get_basic_stats,
+    get_chart_data,
     get_consistencies,
     get_headline_totals,
-    get_admin_overview,
     get_overviews,
+    get_published_record_set_filter_options,
 )
 
 
@@ -40,8 +43,19 @@ query = ObjectType("Query")
 dataset = ObjectType("Dataset")
 user = ObjectType("User")
 sum_entries_by_category_value = ObjectType("SumEntriesByCategoryValue")
-
-queries = [query, dataset, user, sum_entries_by_category_value]
+program = ObjectType("Program")
+record = ObjectType("Record")
+entry = ObjectType("Entry")
+
+queries = [
+    query,
+    dataset,
+    user,
+    sum_entries_by_category_value,
+    program,
+    record,
+    entry,
+]
 
 """GraphQL query to find a user based on user ID.
     :param obj: obj is a value returned by a parent resolver
@@ -112,43 +126,115 @@ def resolve_datasets(obj, info, only_unassigned):
 @convert_kwargs_to_snake_case
 def resolve_dataset_last_updated(dataset, info):
     """GraphQL query to find the date a dataset was last updated.
-    :param dataset: Dataset object to filter by its ID
+    :param dataset: Dataset object
     :returns: Datetime scalar
     """
-    session = info.context["dbsession"]
-    return (
-        session.query(func.max(Record.updated))
-        .filter(Record.dataset_id == dataset.id, Record.deleted == None)
-        .scalar()
-    )
+    return dataset.last_record_update
 
 
-# TODO: We may want to move the dataset/category relationship resolvers in the future
-# to the statement in the following fuction so we can limit the number of queries
-# run per object and avoid N+1 query problem.
-# Consider batch queries: https://github.com/graphql/dataloader
+# The relationship resolvers below go through the data loaders of the request,
+# so that they run one query per level of the GraphQL query rather than one
+# per object (N+1 query problem).
 @dataset.field("sumOfCategoryValueCounts")
 def resolve_sums_of_category_values(dataset, info):
     """GraphQL query to sum the counts in an entry by category value
     :param dataset: Dataset object to filter records by dataset ID
     :returns: Dictionary
     """
+    return get_loaders(info).dataset_category_value_sums.load(dataset.id)
+
+
+@dataset.field("records")
+@convert_kwargs_to_snake_case
+def resolve_dataset_records(
+    dataset, info, from_date=None, to_date=None, first=None, after=None
+):
+    """GraphQL query to find the records of a dataset.
+
+    Records are ordered by publication date, so that a page can be continued
+    after the last record of the previous page.
+
+    :param dataset: Dataset object
+    :param from_date: Earliest publication date of the records, inclusive
+    :param to_date: Latest publication date of the records, inclusive
+    :param first: Maximum number of records to return
+    :param after: ID of the record to continue after
+    :returns: List of records that were not soft-deleted
+    """
+    if from_date is None and to_date is None and first is None and after is None:
+        return get_loaders(info).dataset_records.load(dataset.id)
+
     session = info.context["dbsession"]
+    query = session.query(Record).filter(
+        Record.dataset_id == dataset.id, Record.deleted == None
+    )
 
-    stmt = (
-        session.query(
-            Entry.category_value_id, func.sum(Entry.count).label("sum_of_counts")
+    if from_date is not None:
+        query = query.filter(Record.publication_date >= from_date)
+
+    if to_date is not None:
+        query = query.filter(Record.publication_date <= to_date)
+
+    if after:
+        cursor = session.query(Record).get(after)
+        if not cursor:
+            raise Exception("Record not found")
+        query = query.filter(
+            or_(
+                Record.publication_date > cursor.publication_date,
+                and_(
+                    Record.publication_date == cursor.publication_date,
+                    Record.id > cursor.id,
+                ),
+            )
         )
-        .join(Entry.record)
-        .filter(Record.dataset_id == dataset.id, Record.deleted == None)
-        .group_by(Entry.category_value_id)
-        .all()
-    )
 
-    return [
-        {"dataset_id": dataset.id, "category_value_id": row[0], "sum_of_counts": row[1]}
-        for row in stmt
-    ]
+    query = query.order_by(Record.publication_date, Record.id)
+
+    if first is not None:
+        query = query.limit(first)
+
+    return query.all()
+
+
+@dataset.field("program")
+def resolve_dataset_program(dataset, info):
+    """GraphQL query to find the program of a dataset.
+    :param dataset: Dataset object
+    :returns: Program OR None if the dataset is not in a program
+    """
+    if dataset.program_id is None:
+        return None
+    return get_loaders(info).program.load(dataset.program_id)
+
+
+@program.field("team")
+def resolve_program_team(program, info):
+    """GraphQL query to find the team of a program.
+    :param program: Program object
+    :returns: Team OR None if the program is not in a team
+    """
+    if program.team_id is None:
+        return None
+    return get_loaders(info).team.load(program.team_id)
+
+
+@record.field("entries")
+def resolve_record_entries(record, info):
+    """GraphQL query to find the entries of a record.
+    :param record: Record object
+    :returns: List of entries
+    """
+    return get_loaders(info).record_entries.load(record.id)
+
+
+@entry.field("categoryValue")
+def resolve_entry_category_value(entry, info):
+    """GraphQL query to find the category value of an entry.
+    :param entry: Entry object
+    :returns: CategoryValue
+    """
+    return get_loaders(info).category_value.load(entry.category_value_id)
 
 
 @sum_entries_by_category_value.field("dataset")
@@ -157,9 +243,7 @@ def resolve_sums_dataset_relationship(count_obj, info):
     :param count_obj: Object in sumOfCategoryValueCounts dataset field array
     :returns: Dataset dictionary OR None if Dataset was soft-deleted
     """
-    session = info.context["dbsession"]
-    dataset_rel = Dataset.get_not_deleted(session, count_obj["dataset_id"])
-    return dataset_rel
+    return get_loaders(info).not_deleted_dataset.load(count_obj["dataset_id"])
 
 
 @sum_entries_by_category_value.field("categoryValue")
@@ -168,11 +252,9 @@ def resolve_sums_category_relationship(count_obj, info):
     :param count_obj: Object in sumOfCategoryValueCounts dataset field array
     :returns: Category dictionary OR None if Category was soft-deleted
     """
-    session = info.context["dbsession"]
-    category_value_rel = CategoryValue.get_not_deleted(
-        session, count_obj["category_value_id"]
+    return get_loaders(info).not_deleted_category_value.load(
+        count_obj["category_value_id"]
     )
-    return category_value_rel
 
 
 @query.field("record")
@@ -370,11 +452,174 @@ def resolve_published_record_set(obj, info, id):
     return record_set
 
 
+def filter_published_record_sets(query, input):
+    """Filter a query of published record sets.
+
+    Empty filters match all record sets.
+
+    The teams, dataset groups and tags are matched against the snapshot of
+    them in the document, which is what the record sets show, rather than the
+    current names of the program's team and tags. The expression indexes on
+    these document paths serve the filters.
+
+    :param query: Query of published record sets, or of some of their columns
+    :param input: Categories, teams, dataset groups (programs), tags and year,
+        with snake case keys
+    :returns: Filtered query
+    """
+    if input.get("year"):
+        query = query.filter(
+            PublishedRecordSet.end >= datetime(input["year"], 1, 1),
+            PublishedRecordSet.end < datetime(input["year"] + 1, 1, 1),
+        )
+
+    if input.get("categories"):
+        query = query.filter(
+            PublishedRecordSet.metrics.any(
+                and_(
+                    PublishedRecordSetMetric.segmented == False,
+                    PublishedRecordSetMetric.category.in_(input["categories"]),
+                )
+            )
+        )
+
+    document = PublishedRecordSet.document
+    if input.get("teams"):
+        query = query.filter(document["teamName"].astext.in_(input["teams"]))
+
+    if input.get("dataset_groups"):
+        query = query.filter(
+            document["datasetGroup"].astext.in_(input["dataset_groups"])
+        )
+
+    if input.get("tags"):
+        query = query.filter(
+            or_(
+                *[
+                    document["datasetGroupTags"].contains([{"name": tag}])
+                    for tag in input["tags"]
+                ]
+            )
+        )
+
+    return query
+
+
 @query.field("publishedRecordSets")
-def resolve_published_record_sets(obj, info, input):
+@convert_kwargs_to_snake_case
+def resolve_published_record_sets(
+    obj, info, input=None, first=None, after=None, first_of_each_dataset=False
+):
+    """GraphQL query to find published record sets matching some filters.
+
+    Record sets are ordered by end date, so that a page can be continued after
+    the last record set of the previous page.
+
+    :param input: Categories, teams, dataset groups (programs), tags and year
+    :param first: Maximum number of record sets to return
+    :param after: ID of the record set to continue after
+    :param first_of_each_dataset: Whether to only return the record set that
+        begins first in each dataset, among the ones matching the filters
+    :returns: List of published record sets
+    """
+    session = info.context["dbsession"]
+    query = filter_published_record_sets(
+        session.query(PublishedRecordSet), input or {}
+    )
+
+    if first_of_each_dataset:
+        ranked = query.with_entities(
+            PublishedRecordSet.id,
+            func.row_number()
+            .over(
+                partition_by=PublishedRecordSet.dataset_id,
+                order_by=(PublishedRecordSet.begin, PublishedRecordSet.id),
+            )
+            .label("rank"),
+        ).subquery()
+        firsts = select(ranked.c.id).where(ranked.c.rank == 1)
+        query = session.query(PublishedRecordSet).filter(
+            PublishedRecordSet.id.in_(firsts)
+        )
+
+    if after:
+        cursor = session.query(PublishedRecordSet).get(after)
+        if not cursor:
+            raise Exception("Published record set not found")
+        query = query.filter(
+            or_(
+                PublishedRecordSet.end > cursor.end,
+                and_(
+                    PublishedRecordSet.end == cursor.end,
+                    PublishedRecordSet.id > cursor.id,
+                ),
+            )
+        )
+
+    query = query.order_by(PublishedRecordSet.end, PublishedRecordSet.id)
+
+    if first is not None:
+        query = query.limit(first)
+
+    return query.all()
+
+
+@query.field("publishedRecordSetsFilterOptions")
+def resolve_published_record_sets_filter_options(obj, info):
+    """GraphQL query to list the values the published record sets can be
+    filtered by, across all years.
+
+    :returns: Dictionary of the categories, teams, dataset groups and tags
+    """
+    session = cast(Session, info.context["dbsession"])
+    return get_or_create_cached_object(
+        session,
+        "published_record_set_filter_options",
+        get_published_record_set_filter_options,
+    )
+
+
+@query.field("publishedRecordSetsChartData")
+@convert_kwargs_to_snake_case
+def resolve_published_record_sets_chart_data(obj, info, input=None, period="MONTH"):
+    """GraphQL query to chart the percentages of published record sets.
+
+    :param input: Categories, teams, dataset groups (programs), tags and year
+    :param period: Period to group the record sets by, MONTH or YEAR
+    :returns: List of chart data points
+    """
     session = info.context["dbsession"]
-    record_sets = session.query(PublishedRecordSet).all()
-    return record_sets
+    input = input or {}
+    # The overall percentages of each record set and category, summed over
+    # the segments of the overall record.
+    query = session.query(
+        PublishedRecordSet.end,
+        PublishedRecordSetMetric.category,
+        func.sum(PublishedRecordSetMetric.target_member_percent).label(
+            "target_member_percent"
+        ),
+        func.sum(PublishedRecordSetMetric.non_target_member_percent).label(
+            "non_target_member_percent"
+        ),
+    ).join(
+        PublishedRecordSetMetric,
+        and_(
+            PublishedRecordSetMetric.published_record_set_id == PublishedRecordSet.id,
+            PublishedRecordSetMetric.segmented == False,
+        ),
+    )
+    if input.get("categories"):
+        query = query.filter(PublishedRecordSetMetric.category.in_(input["categories"]))
+    record_set_metrics = (
+        filter_published_record_sets(query, input)
+        .group_by(
+            PublishedRecordSet.id,
+            PublishedRecordSet.end,
+            PublishedRecordSetMetric.category,
+        )
+        .subquery()
+    )
+    return get_chart_data(session, record_set_metrics, by_month=period == "MONTH")
 
 
 @query.field("reportingPeriod")
@@ -431,9 +676,9 @@ def resolve_headline_totals(obj, info):
     # to get intellisense
     session = cast(Session, info.context["dbsession"])
 
-    key = f"{time.strftime('%Y-%m-%d')}_headline_totals"
-
-    headline_totals = get_or_create_cached_object(session, key, get_headline_totals)
+    headline_totals = get_or_create_cached_object(
+        session, "headline_totals", get_headline_totals
+    )
 
     return headline_totals
 
@@ -442,37 +687,40 @@ def resolve_headline_totals(obj, info):
 def resolve_basic_stats(obj, info):
     # to get intellisense
     session = cast(Session, info.context["dbsession"])
-    key = f"{time.strftime('%Y-%m-%d')}_basic_stats"
-    return get_or_create_cached_object(session, key, get_basic_stats)
+    return get_or_create_cached_object(session, "basic_stats", get_basic_stats)
 
 
 @query.field("consistencies")
 def resolve_consistencies(obj, info):
     # to get intellisense
     session = cast(Session, info.context["dbsession"])
-    key = f"{time.strftime('%Y-%m-%d')}_consistencies"
 
-    return get_or_create_cached_object(session, key, get_consistencies)
+    return get_or_create_cached_object(session, "consistencies", get_consistencies)
 
 
 @query.field("overviews")
 def resolve_overviews(obj, info):
     # to get intellisense
     session = cast(Session, info.context["dbsession"])
-    key = f"{time.strftime('%Y-%m-%d')}_overviews"
 
-    return get_or_create_cached_object(session, key, get_overviews)
+    return get_or_create_cached_object(session, "overviews", get_overviews)
 
 
 @query.field("adminStats")
 def resolve_admin_stats(obj, info, input):
     # to get intellisense
     session = cast(Session, info.context["dbsession"])
-    stats = {}
-    get_admin_overview(stats, session, input["duration"])
-    get_admin_overdue(stats, session)
-    get_admin_needs_attention(stats, session)
-    return stats
+    duration = input["duration"]
+    if duration not in ADMIN_STATS_DURATIONS:
+        raise Exception(
+            f"Duration must be one of {', '.join(map(str, ADMIN_STATS_DURATIONS))}"
+        )
+
+    return get_or_create_cached_object(
+        session,
+        get_admin_stats_key(duration),
+        lambda session: get_admin_stats(session, duration),
+    )
 
 
 @query.field("adUsers")
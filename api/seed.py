@@ -11,6 +11,7 @@ from settings import settings
 from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 import click
 from datetime import datetime
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
@@ -93,13 +94,33 @@ def init_db():
     return SessionLocal
 
 
+def init_async_db():
+    """Get an async connection to the database.
+
+    Unlike `init_db`, this doesn't create the database or its tables, which
+    is left to the sync connection.
+
+    :returns: Async session factory
+    """
+    db_url_tpl = f"{settings.db_user}:{settings.db_pw}@{settings.db_host}/%s"
+    engine = create_async_engine(
+        "postgresql+asyncpg://" + db_url_tpl % settings.db_name, pool_pre_ping=True
+    )
+    return sessionmaker(
+        autocommit=False, autoflush=False, bind=engine, class_=AsyncSession
+    )
+
+
 # Get a connection to the database. This connection is lazily initialized the
 # first time it's needed, and will ensure the existence of the database and
 # tables.
-# TODO: upgrade to use async database:
-# https://app.clubhouse.io/stanford-computational-policy-lab/story/302/use-async-db-calls
 connection = Proxy(init_db)
 
+# Get an async connection to the database, used with `settings.db_async` for
+# the database work done on the event loop. Most resolvers still use the sync
+# connection.
+async_connection = Proxy(init_async_db)
+
 
 _blank_slate = True
 
@@ -455,6 +476,8 @@ def create_dummy_data(session):
 
     session.add(category_value_white)
     session.add(org)
+    session.flush()
+    Dataset.refresh_last_record_update(session, ds1.id)
     session.commit()
 
 
@@ -129,6 +129,10 @@ class Settings(BaseSettings):
     db_pw: str = "postgres"
     db_host: str = "localhost"
     db_name: str = "rt"
+    # Whether to also connect with asyncpg, so that the database work done
+    # directly on the event loop (user lookups and authentication) doesn't
+    # block it. This needs the asyncpg package.
+    db_async: bool = False
     debug: bool = True
 
     app_account_pw: str = ""
@@ -147,6 +151,43 @@ class Settings(BaseSettings):
 
     email: EmailSettings = EmailSettings()
 
+    # Number of seconds between evictions of stale cached statistics.
+    cache_sweep_interval: int = 3600
+    # Number of seconds after which cached statistics are evicted even if
+    # nothing changed, e.g. admin stats of past days.
+    cache_max_age: int = 86400
+    # Maximum number of cached statistics each worker keeps in memory.
+    cache_lru_size: int = 128
+    # Number of seconds a worker serves cached statistics from memory before
+    # checking the database again. This bounds how long a worker can serve
+    # statistics that another worker has invalidated.
+    cache_lru_ttl: int = 60
+    # Whether each API process keeps the dashboard statistics precomputed in
+    # the background. Off by default, since every worker would poll the
+    # database for it; run `python -m precompute` as a single separate service
+    # instead.
+    precompute_in_process: bool = False
+    # Number of seconds after which precomputed statistics are recomputed even
+    # if nothing was published.
+    precompute_interval: int = 900
+    # Number of seconds between checks for stale precomputed statistics. This
+    # bounds how long after a publish the statistics are recomputed.
+    precompute_poll_interval: int = 10
+    # Number of threads each API process runs GraphQL queries and user
+    # lookups on, so that they don't block its event loop. This also bounds
+    # how many database sessions a process uses at the same time.
+    resolver_threads: int = 8
+    # Number of threads of each API process hashing and verifying passwords.
+    # Logins beyond this wait their turn instead of starving other requests.
+    password_hash_threads: int = 2
+    # Maximum number of recently authenticated users each API process keeps
+    # in memory, so their requests don't load them from the database again.
+    user_cache_size: int = 1024
+    # Number of seconds a process keeps an authenticated user in memory. This
+    # bounds how long changes to a user made through another process (e.g.
+    # new roles) take to apply.
+    user_cache_ttl: int = 30
+
     class Config:
         secrets_dir = os.getenv("RT_SECRETS_DIR", "/run/secrets")
         env_file = ".env"
@@ -1,12 +1,38 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Dict
 from unicodedata import category
-from sqlalchemy import and_, column, func, select, subquery, text
+from sqlalchemy import (
+    and_,
+    extract,
+    func,
+    or_,
+    select,
+    subquery,
+    text,
+    true,
+)
 from sqlalchemy.orm import Session
-from database import Dataset, Program, PublishedRecordSet, ReportingPeriod, Tag, Team
+from cache import invalidate_cached_objects
+from connection import connection
+from database import (
+    Dataset,
+    DatasetConsistency,
+    Program,
+    PublishedRecordSet,
+    PublishedRecordSetMetric,
+    ReportingPeriod,
+    Tag,
+    Team,
+    advisory_xact_lock,
+)
+from executor import resolver_executor
 from enum import Enum
 import logging
 
+import click
+from fastapi.encoders import jsonable_encoder
+from more_itertools import chunked
+
 
 def get_basic_stats(session: Session):
     stats = {}
@@ -26,9 +52,23 @@ def get_basic_stats(session: Session):
     return stats
 
 
+def _everyone_metrics(*criteria):
+    """Join condition for the overall metrics of a published record set.
+
+    :param criteria: Additional conditions on the metrics
+    :returns: SQL expression
+    """
+    return and_(
+        PublishedRecordSetMetric.published_record_set_id == PublishedRecordSet.id,
+        PublishedRecordSetMetric.segmented == False,
+        PublishedRecordSetMetric.segment == PublishedRecordSetMetric.EVERYONE,
+        *criteria,
+    )
+
+
 def get_overviews(session: Session):
     categories = ["Gender", "Ethnicity", "Disability"]
-    filters = [{"name": "Everyone", "filter": True}]
+    filters = [{"name": "Everyone", "filter": true()}]
 
     """
     additional filters
@@ -58,131 +98,123 @@ def get_overviews(session: Session):
     },
     """
 
-    overviews = []
+    # so not in comparison with the individual dataset's target but the BBC
+    # global targets
+    global_targets = {"Gender": 50, "Ethnicity": 20, "Disability": 12}
 
-    for category in categories:
-        for filter in filters:
+    date_poss = ["min", "max"]
 
-            date_poss = ["min", "max"]
+    target_state = Enum("target_state", "exceeds lt5 lt10 gt10 fails")
 
-            for date_pos in date_poss:
-                funk = (
-                    func.min(PublishedRecordSet.begin).label("date_pos")
-                    if date_pos == "min"
-                    else func.max(PublishedRecordSet.begin).label("date_pos")
-                )
-                sbqry = (
-                    select(
-                        PublishedRecordSet.dataset_id.label("did"),
-                        funk,
-                    )
-                    .select_from(PublishedRecordSet)
-                    .group_by("did")
-                    .subquery()
-                )
-
-                stmt = (
-                    select(
-                        Dataset.id,
-                        Dataset.name,
-                        PublishedRecordSet.id,
-                        func.jsonb_path_query_array(
-                            PublishedRecordSet.document,
-                            f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == true)."percent"',
-                        ),
-                        func.jsonb_path_query_array(
-                            PublishedRecordSet.document,
-                            f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == false)."percent"',
-                        ),
-                        func.jsonb_path_query_first(
-                            PublishedRecordSet.document,
-                            f'$.targets[*] ? (@.category == "{category}")."target"',
-                        ),
-                    )
-                    .select_from(PublishedRecordSet)
-                    .filter(filter["filter"])
-                    .join(
-                        sbqry,
-                        and_(
-                            sbqry.c.did == PublishedRecordSet.dataset_id,
-                            PublishedRecordSet.begin == sbqry.c.date_pos,
-                        ),
-                    )
-                    .join(Dataset, PublishedRecordSet.dataset_id == Dataset.id)
-                    .filter(Dataset.deleted == None)
-                )
+    # The first and latest published record set of each dataset are fetched in
+    # a single scan, together with every category's metrics and every
+    # filter's outcome, and then bucketed in memory.
+    sbqry = (
+        select(
+            PublishedRecordSet.dataset_id.label("did"),
+            func.min(PublishedRecordSet.begin).label("min"),
+            func.max(PublishedRecordSet.begin).label("max"),
+        )
+        .select_from(PublishedRecordSet)
+        .group_by("did")
+        .subquery()
+    )
 
-                res = session.execute(stmt)
+    stmt = (
+        select(
+            (PublishedRecordSet.begin == sbqry.c.min).label("min"),
+            (PublishedRecordSet.begin == sbqry.c.max).label("max"),
+            *[
+                filter["filter"].label(f"filter_{i}")
+                for i, filter in enumerate(filters)
+            ],
+            PublishedRecordSetMetric.category,
+            PublishedRecordSetMetric.target_member_percent,
+            PublishedRecordSetMetric.non_target_member_percent,
+        )
+        .select_from(PublishedRecordSet)
+        .join(
+            sbqry,
+            and_(
+                sbqry.c.did == PublishedRecordSet.dataset_id,
+                or_(
+                    PublishedRecordSet.begin == sbqry.c.min,
+                    PublishedRecordSet.begin == sbqry.c.max,
+                ),
+            ),
+        )
+        .join(Dataset, PublishedRecordSet.dataset_id == Dataset.id)
+        .join(
+            PublishedRecordSetMetric,
+            _everyone_metrics(PublishedRecordSetMetric.category.in_(categories)),
+        )
+        .filter(Dataset.deleted == None)
+    )
 
-                target_state = Enum("target_state", "exceeds lt5 lt10 gt10 fails")
+    scores = {
+        (category, filter["name"], date_pos): {
+            target_state.exceeds: 0,
+            target_state.lt5: 0,
+            target_state.lt10: 0,
+            target_state.gt10: 0,
+        }
+        for category in categories
+        for filter in filters
+        for date_pos in date_poss
+    }
+
+    for row in session.execute(stmt):
+        row = row._mapping
+        category = row["category"]
+        global_target = global_targets[category]
+
+        target_members_sum = row["target_member_percent"]
+        oot_target_members_sum = row["non_target_member_percent"]
+
+        if target_members_sum >= global_target:
+            state = target_state.exceeds
+        elif target_members_sum >= global_target - 5:
+            state = target_state.lt5
+        elif target_members_sum >= global_target - 10:
+            state = target_state.lt10
+        elif target_members_sum > 0 or oot_target_members_sum > 0:
+            state = target_state.gt10
+        else:
+            # if these are both zero, then nothing was recorded for the category
+            continue
 
-                scores = {
-                    target_state.exceeds: 0,
-                    target_state.lt5: 0,
-                    target_state.lt10: 0,
-                    target_state.gt10: 0,
-                }
+        for i, filter in enumerate(filters):
+            if not row[f"filter_{i}"]:
+                continue
+            for date_pos in date_poss:
+                if row[date_pos]:
+                    scores[(category, filter["name"], date_pos)][state] += 1
 
-                for [
-                    dataset_id,
-                    dataset_name,
-                    prs_id,
-                    percents,
-                    oot_percents,
-                    target,
-                ] in res:
-
-                    if category == "Gender":
-                        global_target = 50  # so not in comparison with the individual dataset's target but the BBC global target of 50
-                    elif category == "Ethnicity":
-                        global_target = 20
-                    elif category == "Disability":
-                        global_target = 12
-                    else:
-                        global_target == target
-
-                    target_members_sum = sum(percents)
-                    oot_target_members_sum = sum(oot_percents)
-
-                    if target_members_sum >= global_target:
-                        scores[target_state.exceeds] += 1
-                    elif target_members_sum >= global_target - 5:
-                        scores[target_state.lt5] += 1
-                    elif target_members_sum >= global_target - 10:
-                        scores[target_state.lt10] += 1
-                    elif target_members_sum > 0 or oot_target_members_sum > 0:
-                        # if these are both zero, then nothing was recorded for gender
-                        scores[target_state.gt10] += 1
+    overviews = []
 
+    for category in categories:
+        for filter in filters:
+            for date_pos in date_poss:
                 proto = {
                     "date": date_pos,
                     "category": category,
-                    "target_state": target_state.exceeds.name,
-                    "value": scores[target_state.exceeds],
                     "filter": filter["name"],
                 }
-                overviews.append(proto)
-                overviews.append(
-                    {
-                        **proto,
-                        "target_state": target_state.lt5.name,
-                        "value": scores[target_state.lt5],
-                    }
-                )
-                overviews.append(
-                    {
-                        **proto,
-                        "target_state": target_state.lt10.name,
-                        "value": scores[target_state.lt10],
-                    }
-                )
-                overviews.append(
-                    {
-                        **proto,
-                        "target_state": target_state.gt10.name,
-                        "value": scores[target_state.gt10],
-                    }
-                )
+                for state in [
+                    target_state.exceeds,
+                    target_state.lt5,
+                    target_state.lt10,
+                    target_state.gt10,
+                ]:
+                    overviews.append(
+                        {
+                            **proto,
+                            "target_state": state.name,
+                            "value": scores[(category, filter["name"], date_pos)][
+                                state
+                            ],
+                        }
+                    )
 
     return overviews
 
@@ -198,18 +230,9 @@ def get_admin_overview(stats: Dict, session: Session, duration: int):
                 Dataset.name,
                 PublishedRecordSet.id,
                 PublishedRecordSet.end,
-                func.jsonb_path_query_array(
-                    PublishedRecordSet.document,
-                    f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == true)."percent"',
-                ),
-                func.jsonb_path_query_array(
-                    PublishedRecordSet.document,
-                    f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == false)."percent"',
-                ),
-                func.jsonb_path_query_first(
-                    PublishedRecordSet.document,
-                    f'$.targets[*] ? (@.category == "{category}")."target"',
-                ),
+                PublishedRecordSetMetric.target_member_percent,
+                PublishedRecordSetMetric.non_target_member_percent,
+                PublishedRecordSetMetric.target,
             )
             .select_from(PublishedRecordSet)
             .filter(
@@ -220,6 +243,10 @@ def get_admin_overview(stats: Dict, session: Session, duration: int):
                 )
             )
             .join(Dataset, PublishedRecordSet.dataset_id == Dataset.id)
+            .join(
+                PublishedRecordSetMetric,
+                _everyone_metrics(PublishedRecordSetMetric.category == category),
+            )
             .filter(Dataset.deleted == None)
         )
 
@@ -232,14 +259,11 @@ def get_admin_overview(stats: Dict, session: Session, duration: int):
             dataset_name,
             prs_id,
             date_end,
-            percents,
-            oot_percents,
+            target_members_sum,
+            oot_target_members_sum,
             target,
         ] in res:
 
-            target_members_sum = sum(percents)
-            oot_target_members_sum = sum(oot_percents)
-
             if not target_members_sum or not target:
                 continue
 
@@ -271,17 +295,24 @@ def get_admin_needs_attention(stats: Dict, session: Session):
     first = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     end_of_last_month = first - timedelta(microseconds=1)
 
-    stmt = (
+    # The last 3 finished reporting periods of each dataset, with the record
+    # set published for it in that period (if any).
+    periods = (
         select(
-            Dataset.id,
-            Dataset.name,
-            ReportingPeriod.id,
-            ReportingPeriod.program_id,
-            ReportingPeriod.description,
-            ReportingPeriod.end,
-            PublishedRecordSet.id,
-            PublishedRecordSet.created,
-            PublishedRecordSet.document,
+            Dataset.id.label("dataset_id"),
+            Dataset.name.label("dataset_name"),
+            ReportingPeriod.description.label("description"),
+            ReportingPeriod.end.label("end"),
+            PublishedRecordSet.id.label("published_record_set_id"),
+            func.row_number()
+            .over(
+                partition_by=Dataset.id,
+                order_by=(
+                    ReportingPeriod.end.desc(),
+                    PublishedRecordSet.created.desc(),
+                ),
+            )
+            .label("rank"),
         )
         .select_from(ReportingPeriod)
         .join(
@@ -291,146 +322,122 @@ def get_admin_needs_attention(stats: Dict, session: Session):
                 ReportingPeriod.end <= end_of_last_month,
             ),
         )
-        .outerjoin(ReportingPeriod.published_record_set)
-        .order_by(ReportingPeriod.end.desc())
+        .outerjoin(
+            PublishedRecordSet,
+            and_(
+                PublishedRecordSet.reporting_period_id == ReportingPeriod.id,
+                PublishedRecordSet.dataset_id == Dataset.id,
+            ),
+        )
+        .subquery()
     )
 
-    res = session.execute(stmt)
-
-    result_list = [x for x in res]
-
-    dataset_ids = set([x[0] for x in result_list])
-
-    datasets_needing_attention = {}
-
-    for dataset_id in dataset_ids:
+    stmt = (
+        select(
+            periods.c.dataset_id,
+            periods.c.dataset_name,
+            periods.c.description,
+            periods.c.end,
+            periods.c.published_record_set_id,
+            periods.c.rank,
+            PublishedRecordSetMetric.category,
+            PublishedRecordSetMetric.target,
+            PublishedRecordSetMetric.target_member_percent,
+            PublishedRecordSetMetric.non_target_member_percent,
+        )
+        .select_from(periods)
+        .outerjoin(
+            PublishedRecordSetMetric,
+            and_(
+                PublishedRecordSetMetric.published_record_set_id
+                == periods.c.published_record_set_id,
+                PublishedRecordSetMetric.segmented == False,
+                PublishedRecordSetMetric.segment == PublishedRecordSetMetric.EVERYONE,
+            ),
+        )
+        .where(periods.c.rank <= 3)
+        .order_by(
+            periods.c.dataset_id, periods.c.rank, PublishedRecordSetMetric.category
+        )
+    )
 
-        dataset_rps = [x for x in result_list if x[0] == dataset_id]
+    datasets = {}
+
+    for row in session.execute(stmt):
+        if row.dataset_id not in datasets:
+            # Rows are ordered by rank, so this is the last period.
+            datasets[row.dataset_id] = {
+                "proto": {
+                    "dataset_id": row.dataset_id,
+                    "reporting_period_end": row.end,
+                    "reporting_period_name": row.description,
+                    "name": row.dataset_name,
+                    "count": 0,
+                },
+                "periods": set(),
+                "published_periods": set(),
+                "targets_missed": {},
+                "needs_attention_types": [],
+            }
+        dataset = datasets[row.dataset_id]
+        needs_attention_types = dataset["needs_attention_types"]
 
-        if not len(dataset_rps):
+        dataset["periods"].add(row.rank)
+        if row.published_record_set_id is None:
             continue
+        dataset["published_periods"].add(row.rank)
 
-        proto = {
-            "dataset_id": dataset_id,
-            "reporting_period_end": dataset_rps[0][5],
-            "reporting_period_name": dataset_rps[0][4],
-            "name": dataset_rps[0][1],
-            "count": 0,
-        }
-
-        targets_missed = {}
-
-        for i, dataset_rp in enumerate(dataset_rps):
-
-            if i > 2:
-                break
-
-            document = dataset_rp[8]
-
-            if not document:
-                continue
-
-            if not "targets" in document:
-                continue
-
-            targets = document["targets"]
-
-            if not "record" in document or not "Everyone" in document["record"]:
-                continue
+        if row.category is None:
+            continue
 
-            categories = document["record"]["Everyone"]
+        if row.target is None:
+            logging.error(
+                f"Category {row.category} has no targets, possibly due to nothing in the published record set. Dateset Id is {row.dataset_id}"
+            )
+            continue
 
-            for category, entries in categories.items():
-                if "entries" not in entries:
-                    continue
+        if not row.target:
+            continue
 
-                targets_int = [
-                    x["target"] for x in targets if x["category"] == category
-                ]
+        target_member_count = row.target_member_percent
+        total_count = target_member_count + row.non_target_member_percent
 
-                if not targets_int:
-                    logging.error(
-                        f"Category {category} has no targets, possibly due to nothing in the published record set. Dateset Id is {dataset_id}"
-                    )
-                    continue
-
-                [target, *_] = targets_int
-
-                if not target:
-                    continue
-
-                if category not in targets_missed:
-                    targets_missed[category] = 0
-                target_member_count = 0
-                total_count = 0
-                for attribute, entry in entries["entries"].items():
-                    if not entry["percent"]:
-                        continue
-                    total_count += entry["percent"]
-                    if entry["targetMember"]:
-                        target_member_count += entry["percent"]
-
-                if not total_count:
-                    # everything was 0, so nothing recorded
-                    continue
-
-                if target_member_count < target:
-                    targets_missed[category] += 1
-                    if targets_missed[category] == 3:
-                        if dataset_id in datasets_needing_attention:
-                            if (
-                                "MissedATargetInAllLast3Periods"
-                                not in datasets_needing_attention[dataset_id][
-                                    "needs_attention_types"
-                                ]
-                            ):
-                                datasets_needing_attention[dataset_id][
-                                    "needs_attention_types"
-                                ].append("MissedATargetInAllLast3Periods")
-                        else:
-                            datasets_needing_attention[dataset_id] = {
-                                **proto,
-                                "needs_attention_types": [
-                                    "MissedATargetInAllLast3Periods"
-                                ],
-                            }
-                    target_delta = target - target_member_count
-                    if target_delta >= 10:
-                        if dataset_id in datasets_needing_attention:
-                            if (
-                                "MoreThan10PercentBelowATargetLastPeriod"
-                                not in datasets_needing_attention[dataset_id][
-                                    "needs_attention_types"
-                                ]
-                            ):
-                                datasets_needing_attention[dataset_id][
-                                    "needs_attention_types"
-                                ].append("MoreThan10PercentBelowATargetLastPeriod")
-                        else:
-                            datasets_needing_attention[dataset_id] = {
-                                **proto,
-                                "needs_attention_types": [
-                                    "MoreThan10PercentBelowATargetLastPeriod"
-                                ],
-                            }
-
-        if len(dataset_rps) < 3:
+        if not total_count:
+            # everything was 0, so nothing recorded
             continue
 
-        last_3 = [x for x in dataset_rps][:3]
-
-        if all([x[6] == None for x in last_3]):
-            if dataset_id in datasets_needing_attention:
-                datasets_needing_attention[dataset_id]["needs_attention_types"].append(
-                    "NothingPublishedLast3Periods"
-                )
-            else:
-                datasets_needing_attention[dataset_id] = {
-                    **proto,
-                    "needs_attention_types": ["NothingPublishedLast3Periods"],
+        if target_member_count < row.target:
+            targets_missed = dataset["targets_missed"]
+            targets_missed[row.category] = targets_missed.get(row.category, 0) + 1
+            if (
+                targets_missed[row.category] == 3
+                and "MissedATargetInAllLast3Periods" not in needs_attention_types
+            ):
+                needs_attention_types.append("MissedATargetInAllLast3Periods")
+            if (
+                row.target - target_member_count >= 10
+                and "MoreThan10PercentBelowATargetLastPeriod"
+                not in needs_attention_types
+            ):
+                needs_attention_types.append("MoreThan10PercentBelowATargetLastPeriod")
+
+    datasets_needing_attention = []
+
+    for dataset in datasets.values():
+        needs_attention_types = dataset["needs_attention_types"]
+
+        if len(dataset["periods"]) == 3 and not dataset["published_periods"]:
+            needs_attention_types.append("NothingPublishedLast3Periods")
+
+        if needs_attention_types:
+            datasets_needing_attention.append(
+                {
+                    **dataset["proto"],
+                    "needs_attention_types": needs_attention_types,
                 }
+            )
 
-    stats["needs_attention"] = datasets_needing_attention.values()
+    stats["needs_attention"] = datasets_needing_attention
 
 
 def get_admin_overdue(stats: Dict, session: Session):
@@ -491,6 +498,142 @@ def get_admin_overdue(stats: Dict, session: Session):
             stats["overdue"].append(dataset_details)
 
 
+def get_published_record_set_filter_options(session: Session):
+    """List the values the published record sets can be filtered by.
+
+    The teams, dataset groups and tags come from the documents, since that is
+    what the filters match. Only their distinct values are read.
+
+    :param session: Database session
+    :returns: Dictionary of the sorted categories, teams, dataset groups and
+        tags
+    """
+    document = PublishedRecordSet.document
+
+    def distinct(expression, *criteria):
+        return (
+            session.execute(
+                select(expression).where(expression != None, *criteria).distinct()
+            )
+            .scalars()
+            .all()
+        )
+
+    tags = set()
+    # Few programs have distinct tag lists, so this is short.
+    for dataset_group_tags in distinct(document["datasetGroupTags"]):
+        tags.update(tag["name"] for tag in dataset_group_tags)
+
+    return {
+        "categories": sorted(
+            distinct(
+                PublishedRecordSetMetric.category,
+                PublishedRecordSetMetric.segmented == False,
+            )
+        ),
+        "teams": sorted(distinct(document["teamName"].astext)),
+        "dataset_groups": sorted(distinct(document["datasetGroup"].astext)),
+        "tags": sorted(tags),
+    }
+
+
+def get_chart_data(session: Session, record_set_metrics, by_month: bool):
+    """Average the percentages of published record sets over time.
+
+    The percentages of the overall record of each record set are averaged by
+    category over the record sets of each month or year.
+
+    :param session: Database session
+    :param record_set_metrics: Subquery of the `end`, `category`,
+        `target_member_percent` and `non_target_member_percent` of each
+        record set and category
+    :param by_month: Whether to group by month rather than by year
+    :returns: List of chart data points
+    """
+    periods = [extract("year", record_set_metrics.c.end).label("year")]
+    if by_month:
+        periods.append(extract("month", record_set_metrics.c.end).label("month"))
+
+    stmt = (
+        select(
+            *periods,
+            record_set_metrics.c.category,
+            func.avg(record_set_metrics.c.target_member_percent),
+            func.avg(record_set_metrics.c.non_target_member_percent),
+            func.count(),
+        )
+        .group_by(*periods, record_set_metrics.c.category)
+        .order_by(*periods, record_set_metrics.c.category)
+    )
+
+    points = []
+    for row in session.execute(stmt):
+        date = datetime(int(row.year), int(row.month) if by_month else 1, 1)
+        for target_member, percent in [(True, row[-3]), (False, row[-2])]:
+            points.append(
+                {
+                    "date": date,
+                    "category": row.category,
+                    "target_member": target_member,
+                    "percent": percent,
+                    "count": row[-1],
+                }
+            )
+    return points
+
+
+# Number of days the admin UI offers to cover in the overview of the stats.
+ADMIN_STATS_DURATIONS = (31, 62, 93)
+
+
+def get_admin_stats_key(duration: int) -> str:
+    """Get the cache key of the admin stats.
+
+    The admin stats depend on the current date, so the key changes daily.
+
+    :param duration: Number of days covered by the overview
+    :returns: Cache key
+    """
+    return f"admin_stats:{duration}:{date.today().isoformat()}"
+
+
+def get_admin_stats(session: Session, duration: int):
+    """Compute the admin stats.
+
+    The overview, overdue datasets and datasets needing attention are
+    independent. The overview is computed in the given session while the other
+    two run on the resolver pool, each in its own session, so the stats take at
+    most two more connections. A part the pool hasn't started by the time the
+    overview is done is computed in the given session instead, so that a busy
+    pool doesn't hold the stats up.
+
+    :param session: Database session, whose engine is used for the new sessions
+    :param duration: Number of days covered by the overview
+    :returns: JSON-serializable admin stats
+    """
+    engine = session.get_bind()
+
+    def compute(func):
+        stats = {}
+        with Session(bind=engine) as sub_session:
+            func(stats, sub_session)
+        return stats
+
+    futures = {
+        func: resolver_executor.submit(compute, func)
+        for func in (get_admin_overdue, get_admin_needs_attention)
+    }
+    stats = {}
+    get_admin_overview(stats, session, duration)
+    for func, future in futures.items():
+        if future.cancel():
+            func(stats, session)
+        else:
+            stats.update(future.result())
+
+    return jsonable_encoder(stats)
+
+
 def get_headline_totals(session: Session):
 
     headline_totals = {}
@@ -505,14 +648,15 @@ def get_headline_totals(session: Session):
         .subquery()
     )
 
+    # Average the target member percentages of the latest record set of each
+    # dataset, for all categories at once. Record sets where everything was
+    # zero have nothing actually recorded and are left out.
     stmt = (
         select(
-            func.jsonb_object_keys(
-                func.jsonb_path_query(
-                    PublishedRecordSet.document,
-                    "$.record.*",
-                )
-            )
+            PublishedRecordSetMetric.category,
+            func.sum(PublishedRecordSetMetric.target_member_percent),
+            func.count(),
+            func.count(PublishedRecordSet.dataset_id.distinct()),
         )
         .select_from(PublishedRecordSet)
         .join(
@@ -522,138 +666,207 @@ def get_headline_totals(session: Session):
                 PublishedRecordSet.end == sbqry.c.date_pos,
             ),
         )
-        .distinct()
-    )
-
-    cats = session.execute(stmt)
-
-    for [category] in cats:
-        grouped_by_dataset_year = {}
-        stmt = (
-            select(
-                func.jsonb_path_query_array(
-                    PublishedRecordSet.document,
-                    f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == true)."percent"',
-                ),
-                func.jsonb_path_query_array(
-                    PublishedRecordSet.document,
-                    f'$.record.Everyone.{category}.*.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == false)."percent"',
-                ),
-                func.jsonb_path_query_first(
-                    PublishedRecordSet.document,
-                    f'$.targets[*] ? (@.category == "{category}")."target"',
-                ),
-                column("dataset_id"),
-                column("end"),
-            )
-            .select_from(PublishedRecordSet)
-            .join(
-                sbqry,
-                and_(
-                    sbqry.c.did == PublishedRecordSet.dataset_id,
-                    PublishedRecordSet.end == sbqry.c.date_pos,
-                ),
-            )
+        .join(
+            PublishedRecordSetMetric,
+            _everyone_metrics(
+                PublishedRecordSetMetric.target_member_percent
+                + PublishedRecordSetMetric.non_target_member_percent
+                != 0
+            ),
         )
+        .group_by(PublishedRecordSetMetric.category)
+    )
 
-        percents = session.execute(stmt)
-
-        total = 0
-        count = 0
-        dataset_set = set()
-
-        for [
-            target_member_percent,
-            oot_member_percent,
-            target,
-            dataset_id,
-            end,
-        ] in percents:
-
-            this_total_in_target = sum(target_member_percent)
-            this_total_oot = sum(oot_member_percent)
+    for [category, total, count, no_of_datasets] in session.execute(stmt):
+        headline_totals[category.lower()] = {
+            "percent": total / count,
+            "no_of_datasets": no_of_datasets,
+        }
 
-            if this_total_in_target + this_total_oot == 0:
-                # eveything was zero so nothing actually recorded
-                continue
+    return headline_totals
 
-            dataset_set.add(dataset_id)
 
-            total += this_total_in_target
-            count += 1
+# Category whose consistency is tracked.
+CONSISTENCY_CATEGORY = "Gender"
 
-        if count > 0:
-            headline_totals[category.lower()] = {
-                "percent": total / count,
-                "no_of_datasets": len(dataset_set),
-            }
 
-    return headline_totals
+def _get_dataset_year_consistencies(session: Session, *criteria):
+    """Compute whether datasets met their target consistently in a year.
 
+    A dataset is consistent in a year when it met its target in at least 3 of
+    its record sets published that year, and came within 5% of it in the
+    others.
 
-def get_consistencies(session: Session):
-    category = "Gender"
+    :param session: Database session
+    :param criteria: Conditions on the published record sets to consider
+    :returns: Dictionary of consistency by (dataset ID, year)
+    """
     consistency_state = Enum("consistency_state", "met almost failed")
     consistency_threshold = 5
 
-    consistencies_obj = []
-
-    consistency_counts = {}
-
     grouped_by_dataset_year = {}
-    stmt = select(
-        func.jsonb_path_query_array(
-            PublishedRecordSet.document,
-            f'$.segmentedRecord.*.{category}.entries.* ? ((@.percent > 0 || @.percent == 0) && @.targetMember == true)."percent"',
-        ),
-        func.jsonb_path_query_first(
-            PublishedRecordSet.document,
-            f'$.targets[*] ? (@.category == "{category}")."target"',
-        ),
-        column("dataset_id"),
-        column("end"),
-    ).select_from(PublishedRecordSet)
 
-    percents = session.execute(stmt)
+    # Sum the target member percentages of every segment of each published
+    # record set. Record sets without any segmented metrics for the category
+    # have nothing recorded and count as failed.
+    sbqry = (
+        select(
+            PublishedRecordSetMetric.published_record_set_id.label("prs_id"),
+            func.sum(PublishedRecordSetMetric.target_member_percent).label(
+                "percent"
+            ),
+            func.max(PublishedRecordSetMetric.target).label("target"),
+        )
+        .filter(
+            PublishedRecordSetMetric.segmented == True,
+            PublishedRecordSetMetric.category == CONSISTENCY_CATEGORY,
+        )
+        .group_by(PublishedRecordSetMetric.published_record_set_id)
+        .subquery()
+    )
 
-    for [percent, target, dataset_id, end] in percents:
-        this_total = sum(percent)
+    stmt = (
+        select(
+            sbqry.c.percent,
+            sbqry.c.target,
+            PublishedRecordSet.dataset_id,
+            PublishedRecordSet.end,
+        )
+        .select_from(PublishedRecordSet)
+        .outerjoin(sbqry, sbqry.c.prs_id == PublishedRecordSet.id)
+        .filter(*criteria)
+    )
 
-        year = end.year
-        if dataset_id not in grouped_by_dataset_year:
-            grouped_by_dataset_year[dataset_id] = {}
+    percents = session.execute(stmt)
 
-        if year not in grouped_by_dataset_year[dataset_id]:
-            grouped_by_dataset_year[dataset_id][year] = []
+    for [this_total, target, dataset_id, end] in percents:
+        key = (dataset_id, end.year)
+        if key not in grouped_by_dataset_year:
+            grouped_by_dataset_year[key] = []
 
         if this_total == None or target == None:
-            grouped_by_dataset_year[dataset_id][year].append(consistency_state.failed)
+            grouped_by_dataset_year[key].append(consistency_state.failed)
         elif this_total >= target:
-            grouped_by_dataset_year[dataset_id][year].append(consistency_state.met)
+            grouped_by_dataset_year[key].append(consistency_state.met)
         elif (this_total + consistency_threshold) >= target:
-            grouped_by_dataset_year[dataset_id][year].append(consistency_state.almost)
+            grouped_by_dataset_year[key].append(consistency_state.almost)
         else:
-            grouped_by_dataset_year[dataset_id][year].append(consistency_state.failed)
-
-    for [dataset, years] in grouped_by_dataset_year.items():
-        for [year, consistencies] in years.items():
-            if year not in consistency_counts:
-                consistency_counts[year] = {}
-                consistency_counts[year]["consistent"] = 0
-                consistency_counts[year]["failed"] = 0
-            met = len(
-                [True for x in consistencies if x == consistency_state.met]
-            ) >= 3 and all(
-                [
-                    x == consistency_state.met or x == consistency_state.almost
-                    for x in consistencies
-                ]
+            grouped_by_dataset_year[key].append(consistency_state.failed)
+
+    return {
+        key: len([True for x in consistencies if x == consistency_state.met]) >= 3
+        and all(
+            [
+                x == consistency_state.met or x == consistency_state.almost
+                for x in consistencies
+            ]
+        )
+        for [key, consistencies] in grouped_by_dataset_year.items()
+    }
+
+
+def _lock_dataset_consistency(session: Session, dataset_id, year: int):
+    """Wait for other transactions refreshing the same dataset consistency.
+
+    Concurrent publishes would otherwise both insert the consistency and
+    violate its unique constraint, or save a consistency computed without the
+    other's record set.
+
+    :param session: Database session
+    :param dataset_id: Dataset ID
+    :param year: Year of the consistency
+    """
+    advisory_xact_lock(session, f"dataset_consistency:{dataset_id}:{year}")
+
+
+def refresh_dataset_consistency(session: Session, dataset_id, year: int):
+    """Recompute the consistency of a dataset in a year.
+
+    Call this when a record set of the dataset is published or deleted, after
+    flushing the change.
+
+    :param session: Database session
+    :param dataset_id: Dataset ID
+    :param year: Year of the end of the record set
+    """
+    _lock_dataset_consistency(session, dataset_id, year)
+    consistencies = _get_dataset_year_consistencies(
+        session,
+        PublishedRecordSet.dataset_id == dataset_id,
+        extract("year", PublishedRecordSet.end) == year,
+    )
+    consistency = (
+        session.query(DatasetConsistency)
+        .filter(
+            DatasetConsistency.dataset_id == dataset_id,
+            DatasetConsistency.year == year,
+            DatasetConsistency.category == CONSISTENCY_CATEGORY,
+        )
+        .one_or_none()
+    )
+
+    if (dataset_id, year) not in consistencies:
+        if consistency:
+            session.delete(consistency)
+        return
+
+    if not consistency:
+        consistency = DatasetConsistency(
+            dataset_id=dataset_id, year=year, category=CONSISTENCY_CATEGORY
+        )
+        session.add(consistency)
+    consistency.consistent = consistencies[(dataset_id, year)]
+
+
+def rebuild_dataset_consistencies(session: Session):
+    """Recompute the consistency of every dataset in every year.
+
+    :param session: Database session
+    """
+    consistencies = _get_dataset_year_consistencies(session)
+
+    session.query(DatasetConsistency).filter(
+        DatasetConsistency.category == CONSISTENCY_CATEGORY
+    ).delete(synchronize_session=False)
+    session.add_all(
+        [
+            DatasetConsistency(
+                dataset_id=dataset_id,
+                year=year,
+                category=CONSISTENCY_CATEGORY,
+                consistent=consistent,
             )
+            for [(dataset_id, year), consistent] in consistencies.items()
+        ]
+    )
+    session.commit()
 
-            if met:
-                consistency_counts[year]["consistent"] += 1
-            else:
-                consistency_counts[year]["failed"] += 1
+
+def get_consistencies(session: Session):
+    category = CONSISTENCY_CATEGORY
+
+    consistencies_obj = []
+
+    consistency_counts = {}
+
+    stmt = (
+        select(
+            DatasetConsistency.year,
+            DatasetConsistency.consistent,
+            func.count(),
+        )
+        .filter(DatasetConsistency.category == category)
+        .group_by(DatasetConsistency.year, DatasetConsistency.consistent)
+        .order_by(DatasetConsistency.year)
+    )
+
+    for [year, consistent, count] in session.execute(stmt):
+        if year not in consistency_counts:
+            consistency_counts[year] = {}
+            consistency_counts[year]["consistent"] = 0
+            consistency_counts[year]["failed"] = 0
+
+        consistency_counts[year]["consistent" if consistent else "failed"] += count
 
     # this suits antd charts
     consistencies_obj.extend(
@@ -680,3 +893,48 @@ def get_consistencies(session: Session):
     )
 
     return consistencies_obj
+
+
+def rebuild_published_record_set_metrics(session: Session):
+    """Re-extract the metrics of every published record set from its document.
+
+    Metrics are extracted when a record set is published, so this only needs
+    to be run to backfill record sets published before the metrics existed.
+
+    :param session: Database session
+    """
+    ids = [id_ for [id_] in session.execute(select(PublishedRecordSet.id))]
+
+    for chunk in chunked(ids, 100):
+        record_sets = (
+            session.query(PublishedRecordSet)
+            .filter(PublishedRecordSet.id.in_(chunk))
+            .all()
+        )
+        for record_set in record_sets:
+            record_set.refresh_metrics(session)
+        session.commit()
+        session.expunge_all()
+
+    # Cached statistics were computed from the previous metrics.
+    invalidate_cached_objects(session)
+    session.commit()
+
+
+@click.command()
+def run():
+    """Backfill the materialized statistics tables."""
+    session = connection()
+
+    print("📊 Extracting published record set metrics ...")
+    rebuild_published_record_set_metrics(session)
+
+    print("📊 Computing dataset consistencies ...")
+    rebuild_dataset_consistencies(session)
+
+    session.close()
+    print("✅ done!")
+
+
+if __name__ == "__main__":
+    run()
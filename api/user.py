@@ -1,20 +1,33 @@
 from pydantic import BaseModel, UUID4, EmailStr
+from uuid import UUID
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Callable, NamedTuple, Optional, List, Dict, Tuple, TypeVar
 
+import jwt
+from fastapi import APIRouter, Body, HTTPException, Request, status
 from fastapi_users.authentication import CookieAuthentication
 from fastapi_users import FastAPIUsers
 from fastapi_users import models
-from fastapi_users.utils import generate_jwt
+from fastapi_users import password as password_helper
+from fastapi_users.router.common import ErrorCode
+from fastapi_users.router.reset import RESET_PASSWORD_TOKEN_AUDIENCE
+from fastapi_users.user import UserAlreadyExists
+from fastapi_users.utils import JWT_ALGORITHM, generate_jwt
 from fastapi_users.db.base import BaseUserDatabase
 from fastapi_users.db.sqlalchemy import GUID
+from sqlalchemy.orm import Session, selectinload
 from sqlalchemy.sql import func
 
 from settings import settings
+from cache import LRUCache
+from executor import password_executor
 import database
-from connection import connection
+from connection import async_connection, connection
 
 
+T = TypeVar("T")
+
 
 class BaseUserCreateUpdate(BaseModel):
     id: Optional[UUID4]
@@ -93,6 +106,67 @@ class UserDBModel(UserModel, models.BaseUserDB):
     last_name: str
 
 
+class CachedUser(NamedTuple):
+    """Snapshot of a user that authenticated recently."""
+
+    # Model returned to fastapi-users.
+    model: UserDBModel
+    # Detached ORM object, with the user's roles and teams loaded.
+    orm_user: database.User
+
+
+# Database session of the request being handled, if any. It is set by the
+# `add_db_session` middleware so that the user database shares the request's
+# connection instead of taking another one from the pool.
+request_session: ContextVar[Optional[Session]] = ContextVar(
+    "request_session", default=None
+)
+
+
+# Per-worker cache of the users that authenticated recently, by ID (the
+# subject of their auth token). Updates made through another worker are seen
+# after at most `user_cache_ttl` seconds.
+user_cache = LRUCache(settings.user_cache_size, settings.user_cache_ttl)
+
+
+def invalidate_cached_users(*user_ids):
+    """Forget cached users, so their next request loads them again.
+
+    :param user_ids: IDs of the users to forget, as UUIDs or strings
+    """
+    for user_id in user_ids:
+        user_cache.delete(UUID(str(user_id)))
+
+
+async def hash_password(plain_password: str) -> str:
+    """Hash a password on the password pool.
+
+    bcrypt is slow on purpose, so hashing on the event loop would stall every
+    other request of the process meanwhile.
+
+    :param plain_password: Password to hash
+    :returns: Hash of the password
+    """
+    return await password_executor.run(
+        password_helper.get_password_hash, plain_password
+    )
+
+
+async def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> Tuple[bool, Optional[str]]:
+    """Verify a password against its hash on the password pool.
+
+    :param plain_password: Password to verify
+    :param hashed_password: Stored hash of the password
+    :returns: Whether the password matches, and a new hash to store if the
+        stored one uses outdated settings
+    """
+    return await password_executor.run(
+        password_helper.verify_and_update_password, plain_password, hashed_password
+    )
+
+
 class SQLAlchemyORMUserDatabase(BaseUserDatabase):
     """FastAPI-Users database integration for SQLAlchemy ORM.
 
@@ -105,143 +179,261 @@ class SQLAlchemyORMUserDatabase(BaseUserDatabase):
         if not ormuser:
             return None
         user = UserDBModel.from_orm(ormuser)
-        if any(r.name == "admin" for r in user.roles):
+        if "admin" in ormuser.get_role_names():
             user.is_superuser = True
         user.is_active = ormuser.deleted is None
         return user
 
-    def __init__(self, session_factory):
+    def __init__(self, session_factory, async_session_factory=None):
+        """Create the user database.
+
+        :param session_factory: Function returning a new database session
+        :param async_session_factory: Function returning a new async database
+            session. If given, queries run through it without blocking the
+            event loop.
+        """
         super().__init__(UserDBModel)
         self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+
+    async def _run_in_session(self, func: Callable[[Session], T]) -> T:
+        """Run a function with a database session.
+
+        With an async session factory, the function runs through
+        `AsyncSession.run_sync`, which waits for its queries without blocking
+        the event loop. Otherwise it runs with the session of the current
+        request if there is one, or with a new session that is closed after.
+
+        :param func: Function taking a sync session
+        :returns: Value returned by the function
+        """
+        if self.async_session_factory is not None:
+            async with self.async_session_factory() as session:
+                return await session.run_sync(func)
+
+        session = request_session.get()
+        if session is not None:
+            return func(session)
 
-    async def get(self, id: UUID4) -> UserDBModel:
-        # TODO! Use an async session
         session = self.session_factory()
-        dbuser = session.query(database.User).get(id)
-        user = self.format_orm_model(dbuser)
-        session.close()
+        try:
+            return func(session)
+        finally:
+            session.close()
+
+    async def get(self, id: UUID4) -> UserDBModel:
+        # This is how fastapi-users loads the user of an auth token, i.e. once
+        # per authenticated request. It also sets attributes on the returned
+        # user before saving it, so the cached model is never handed out.
+        cached_user = user_cache.get(id)
+        if cached_user is not None:
+            return cached_user.model.copy(deep=True)
+
+        def get(session):
+            dbuser = (
+                session.query(database.User)
+                .options(
+                    selectinload(database.User.roles),
+                    selectinload(database.User.teams),
+                )
+                .get(id)
+            )
+            # The cached user is shared between requests, so it must be a
+            # copy detached from this session, which may be the request's.
+            # Users with unsaved changes can't be copied, nor cached.
+            snapshot = None
+            if dbuser is not None and not session.dirty:
+                snapshot_session = Session()
+                snapshot = snapshot_session.merge(dbuser, load=False)
+                snapshot_session.close()
+            return snapshot, self.format_orm_model(dbuser)
+
+        snapshot, user = await self._run_in_session(get)
+        if snapshot is not None:
+            user_cache.set(
+                id, CachedUser(model=user.copy(deep=True), orm_user=snapshot)
+            )
         return user
 
     async def get_by_email(self, email: EmailStr) -> UserDBModel:
-        # TODO! Use an async session
-        session = self.session_factory()
-        dbuser = database.User.get_by_email(session, email)
-        user = self.format_orm_model(dbuser)
-        session.close()
-        return user
+        def get_by_email(session):
+            dbuser = database.User.get_by_email(session, email)
+            return self.format_orm_model(dbuser)
+
+        return await self._run_in_session(get_by_email)
 
     async def create(self, user: UserCreateModel) -> UserDBModel:
-        # TODO! Use an async session
-        session = self.session_factory()
-        d = user.dict()
-        roles = d.pop("roles", [])
-        teams = d.pop("teams", [])
-        dbuser = database.User(**d)
-        if roles:
+        def create(session):
+            d = user.dict()
+            roles = d.pop("roles", [])
+            teams = d.pop("teams", [])
+            dbuser = database.User(**d)
+            if roles:
+                dbuser.roles = (
+                    session.query(database.Role)
+                    .filter(database.Role.id.in_([r["id"] for r in roles]))
+                    .all()
+                )
+            if teams:
+                dbuser.teams = (
+                    session.query(database.Team)
+                    .filter(database.Team.id.in_([t["id"] for t in teams]))
+                    .all()
+                )
+            session.add(dbuser)
+            session.commit()
+            return self.format_orm_model(dbuser)
+
+        return await self._run_in_session(create)
+
+    async def update(self, user: UserUpdateModel) -> UserDBModel:
+        def update(session):
+            d = user.dict()
+
+            # Get the existing user from the DB
+            dbuser = session.query(database.User).get(user.id)
+
+            # Only allow updates of certain columns
+            for k in [
+                "first_name",
+                "last_name",
+                "email",
+                "is_active",
+                "is_verified",
+                "hashed_password",
+                "username",
+            ]:
+                if k in d:
+                    if k == "hashed_password" and dbuser.hashed_password != d[k]:
+                        dbuser.last_changed_password = func.now()
+                    setattr(dbuser, k, d[k])
+
+                    # Special handling for deletes, since we use the `deleted`
+                    # column while the fastapi-users library uses is_active. We
+                    # let queries set `is_active` if they want to delete or
+                    # restore and we will set `deleted` automatically.
+                    if k == "is_active":
+                        if d[k]:
+                            dbuser.deleted = None
+                        else:
+                            dbuser.deleted = func.now()
+
+            # Update roles and teams separately
             dbuser.roles = (
                 session.query(database.Role)
-                .filter(database.Role.id.in_([r["id"] for r in roles]))
+                .filter(
+                    database.Role.id.in_([r["id"] for r in d["roles"]]),
+                    database.Role.deleted == None,
+                )
                 .all()
+                if d["roles"]
+                else []
             )
-        if teams:
+
             dbuser.teams = (
                 session.query(database.Team)
-                .filter(database.Team.id.in_([t["id"] for t in teams]))
+                .filter(
+                    database.Team.id.in_([t["id"] for t in d["teams"]]),
+                    database.Team.deleted == None,
+                )
                 .all()
+                if d["teams"]
+                else []
             )
-        session.add(dbuser)
-        session.commit()
-        user = self.format_orm_model(dbuser)
-        session.close()
-        return user
 
-    async def update(self, user: UserUpdateModel) -> UserDBModel:
-        # TODO! Use an async session
-        session = self.session_factory()
-        d = user.dict()
-
-        # Get the existing user from the DB
-        dbuser = session.query(database.User).get(user.id)
-
-        # Only allow updates of certain columns
-        for k in [
-            "first_name",
-            "last_name",
-            "email",
-            "is_active",
-            "is_verified",
-            "hashed_password",
-            "username",
-        ]:
-            if k in d:
-                if k == "hashed_password" and dbuser.hashed_password != d[k]:
-                    dbuser.last_changed_password = func.now()
-                setattr(dbuser, k, d[k])
-
-                # Special handling for deletes, since we use the `deleted`
-                # column while the fastapi-users library uses is_active. We
-                # let queries set `is_active` if they want to delete or restore
-                # and we will set `deleted` automatically.
-                if k == "is_active":
-                    if d[k]:
-                        dbuser.deleted = None
-                    else:
-                        dbuser.deleted = func.now()
-
-        # Update roles and teams separately
-        dbuser.roles = (
-            session.query(database.Role)
-            .filter(
-                database.Role.id.in_([r["id"] for r in d["roles"]]),
-                database.Role.deleted == None,
-            )
-            .all()
-            if d["roles"]
-            else []
-        )
+            session.merge(dbuser)
+            session.commit()
+            return self.format_orm_model(dbuser)
 
-        dbuser.teams = (
-            session.query(database.Team)
-            .filter(
-                database.Team.id.in_([t["id"] for t in d["teams"]]),
-                database.Team.deleted == None,
-            )
-            .all()
-            if d["teams"]
-            else []
-        )
-
-        session.merge(dbuser)
-        session.commit()
-        user = self.format_orm_model(dbuser)
-        session.close()
+        user = await self._run_in_session(update)
+        invalidate_cached_users(user.id)
         return user
 
     async def delete(self, user: UserModel) -> None:
-        session = self.session_factory()
-        database.User.delete(session, user.id)
-        session.commit()
-        session.close()
+        def delete(session):
+            database.User.delete(session, user.id)
+            session.commit()
+
+        await self._run_in_session(delete)
+        invalidate_cached_users(user.id)
         return None
 
     async def authenticate(self, credentials) -> Optional[UserDBModel]:
-        user = await super().authenticate(credentials)
+        """Authenticate a user by email and password.
+
+        Same as fastapi-users' implementation, but with the password checked
+        on the password pool.
+
+        :param credentials: Login form, with the email as the username
+        :returns: User, if the credentials are valid
+        """
+        user = await self.get_by_email(credentials.username)
+        if user is None:
+            # Hash anyway so that unknown emails take as long to reject.
+            await hash_password(credentials.password)
+            return None
+
+        verified, updated_password_hash = await verify_and_update_password(
+            credentials.password, user.hashed_password
+        )
+        if not verified:
+            return None
+        if updated_password_hash is not None:
+            user.hashed_password = updated_password_hash
+            await self.update(user)
+
         # Mark this as the most recent login.
         # The user object we return will have the last login, not this one.
-        session = self.session_factory()
-        session.query(database.User).filter(database.User.id == user.id).update(
-            {
-                "last_login": func.now(),
-            },
-            synchronize_session=False,
-        )
-        session.commit()
-        session.close()
+        def mark_login(session):
+            session.query(database.User).filter(database.User.id == user.id).update(
+                {
+                    "last_login": func.now(),
+                },
+                synchronize_session=False,
+            )
+            session.commit()
+
+        await self._run_in_session(mark_login)
+        invalidate_cached_users(user.id)
 
         return user
 
+    async def get_orm_user(self, session: Session, id: UUID4) -> database.User:
+        """Get the ORM object of a user, in a request's session.
+
+        Users that authenticated recently are merged into the session from the
+        cache. Otherwise, with an async session factory, the user is loaded
+        with their roles and teams without blocking the event loop, and merged
+        into the request's session without querying it again.
+
+        :param session: Database session of the request
+        :param id: ID of the user
+        :returns: User object, if one was found
+        """
+        cached_user = user_cache.get(id)
+        if cached_user is not None:
+            return session.merge(cached_user.orm_user, load=False)
+
+        if self.async_session_factory is None:
+            return session.query(database.User).get(id)
+
+        async with self.async_session_factory() as async_session:
+            dbuser = await async_session.get(
+                database.User,
+                id,
+                options=[
+                    selectinload(database.User.roles),
+                    selectinload(database.User.teams),
+                ],
+            )
+        if dbuser is None:
+            return None
+        return session.merge(dbuser, load=False)
+
 
-user_db = SQLAlchemyORMUserDatabase(connection)
+user_db = SQLAlchemyORMUserDatabase(
+    connection, async_connection if settings.db_async else None
+)
 
 
 # remove cookie_secure=False later for production
@@ -263,6 +455,82 @@ fastapi_users = FastAPIUsers(
 )
 
 
+async def create_user(
+    user: UserCreateModel,
+    safe: bool = False,
+    is_active: bool = None,
+    is_verified: bool = None,
+) -> UserDBModel:
+    """Create a user, hashing their password on the password pool.
+
+    This replaces `fastapi_users.create_user`, which the register router and
+    the configureApp mutation use.
+
+    :param user: New user
+    :param safe: Whether to ignore privileged fields (e.g. is_superuser)
+    :param is_active: Unused, as in fastapi-users
+    :param is_verified: Unused, as in fastapi-users
+    :returns: Created user
+    """
+    if await user_db.get_by_email(user.email) is not None:
+        raise UserAlreadyExists()
+
+    hashed_password = await hash_password(user.password)
+    user_dict = (
+        user.create_update_dict() if safe else user.create_update_dict_superuser()
+    )
+    return await user_db.create(
+        UserDBModel(**user_dict, hashed_password=hashed_password)
+    )
+
+
+fastapi_users.create_user = create_user
+
+
+def get_reset_password_router(
+    reset_password_token_secret: str, after_forgot_password: Callable
+) -> APIRouter:
+    """Get fastapi-users' reset password router, hashing on the password pool.
+
+    :param reset_password_token_secret: Secret to sign reset tokens with
+    :param after_forgot_password: Handler sending the reset token to the user
+    :returns: Router with the forgot-password and reset-password routes
+    """
+    router = fastapi_users.get_reset_password_router(
+        reset_password_token_secret, after_forgot_password=after_forgot_password
+    )
+    # Keep forgot-password, and replace reset-password with the route below.
+    router.routes = [r for r in router.routes if r.path != "/reset-password"]
+
+    @router.post("/reset-password")
+    async def reset_password(
+        request: Request, token: str = Body(...), password: str = Body(...)
+    ):
+        bad_token = HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=ErrorCode.RESET_PASSWORD_BAD_TOKEN,
+        )
+        try:
+            data = jwt.decode(
+                token,
+                reset_password_token_secret,
+                audience=RESET_PASSWORD_TOKEN_AUDIENCE,
+                algorithms=[JWT_ALGORITHM],
+            )
+            user_id = UUID4(data["user_id"])
+        except (jwt.PyJWTError, KeyError, ValueError):
+            raise bad_token
+
+        user = await user_db.get(user_id)
+        if user is None or not user.is_active:
+            raise bad_token
+
+        user.hashed_password = await hash_password(password)
+        await user_db.update(user)
+
+    return router
+
+
 def get_valid_token(type_: str, **kwargs) -> str:
     """Get a valid JWT for fastapi-users.
 
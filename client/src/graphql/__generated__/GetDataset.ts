@@ -183,4 +183,6 @@ export interface GetDataset {
 
 export interface GetDatasetVariables {
   readonly id: string;
+  readonly fromDate?: any | null;
+  readonly toDate?: any | null;
 }
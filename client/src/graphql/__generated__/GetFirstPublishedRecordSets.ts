@@ -0,0 +1,56 @@
+/* tslint:disable */
+/* eslint-disable */
+// @generated
+// This file was automatically generated and should not be edited.
+
+import { PublishedRecordSetsInput } from "./globalTypes";
+
+// ====================================================
+// GraphQL query operation: GetFirstPublishedRecordSets
+// ====================================================
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_tags {
+  readonly __typename: "Tag";
+  readonly name: string;
+}
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_targets_category {
+  readonly __typename: "Category";
+  readonly name: string;
+}
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_targets {
+  readonly __typename: "Target";
+  readonly category: GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_targets_category;
+  readonly target: number;
+}
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets_dataset_program {
+  readonly __typename: "Program";
+  readonly importedId: number | null;
+  readonly tags: ReadonlyArray<GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_tags>;
+  readonly targets: ReadonlyArray<GetFirstPublishedRecordSets_publishedRecordSets_dataset_program_targets>;
+}
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets_dataset {
+  readonly __typename: "Dataset";
+  readonly program: GetFirstPublishedRecordSets_publishedRecordSets_dataset_program | null;
+}
+
+export interface GetFirstPublishedRecordSets_publishedRecordSets {
+  readonly __typename: "PublishedRecordSet";
+  readonly id: string;
+  readonly begin: any;
+  readonly end: any;
+  readonly document: any | null;
+  readonly datasetId: string;
+  readonly dataset: GetFirstPublishedRecordSets_publishedRecordSets_dataset | null;
+}
+
+export interface GetFirstPublishedRecordSets {
+  readonly publishedRecordSets: ReadonlyArray<GetFirstPublishedRecordSets_publishedRecordSets>;
+}
+
+export interface GetFirstPublishedRecordSetsVariables {
+  readonly input: PublishedRecordSetsInput;
+}
@@ -0,0 +1,28 @@
+/* tslint:disable */
+/* eslint-disable */
+// @generated
+// This file was automatically generated and should not be edited.
+
+import { PublishedRecordSetsInput, ChartDataPeriod } from "./globalTypes";
+
+// ====================================================
+// GraphQL query operation: GetPublishedRecordSetsChartData
+// ====================================================
+
+export interface GetPublishedRecordSetsChartData_publishedRecordSetsChartData {
+  readonly __typename: "ChartDataPoint";
+  readonly date: any;
+  readonly category: string;
+  readonly targetMember: boolean;
+  readonly percent: number;
+  readonly count: number;
+}
+
+export interface GetPublishedRecordSetsChartData {
+  readonly publishedRecordSetsChartData: ReadonlyArray<GetPublishedRecordSetsChartData_publishedRecordSetsChartData>;
+}
+
+export interface GetPublishedRecordSetsChartDataVariables {
+  readonly input: PublishedRecordSetsInput;
+  readonly period: ChartDataPeriod;
+}
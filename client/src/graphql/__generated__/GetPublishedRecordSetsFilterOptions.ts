@@ -0,0 +1,20 @@
+/* tslint:disable */
+/* eslint-disable */
+// @generated
+// This file was automatically generated and should not be edited.
+
+// ====================================================
+// GraphQL query operation: GetPublishedRecordSetsFilterOptions
+// ====================================================
+
+export interface GetPublishedRecordSetsFilterOptions_publishedRecordSetsFilterOptions {
+  readonly __typename: "PublishedRecordSetsFilterOptions";
+  readonly categories: ReadonlyArray<string>;
+  readonly teams: ReadonlyArray<string>;
+  readonly datasetGroups: ReadonlyArray<string>;
+  readonly tags: ReadonlyArray<string>;
+}
+
+export interface GetPublishedRecordSetsFilterOptions {
+  readonly publishedRecordSetsFilterOptions: GetPublishedRecordSetsFilterOptions_publishedRecordSetsFilterOptions;
+}
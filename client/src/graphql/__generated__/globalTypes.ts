@@ -7,6 +7,11 @@
 // START Enums and Input Objects
 //==============================================================
 
+export enum ChartDataPeriod {
+  MONTH = "MONTH",
+  YEAR = "YEAR",
+}
+
 export enum CustomColumnType {
   boolean = "boolean",
   datetime = "datetime",
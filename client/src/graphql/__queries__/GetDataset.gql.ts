@@ -1,7 +1,7 @@
 import { gql } from "@apollo/client";
 
 export const GET_DATASET = gql`
-  query GetDataset($id: ID!) {
+  query GetDataset($id: ID!, $fromDate: DateTime, $toDate: DateTime) {
     dataset(id: $id) {
       id
       name
@@ -55,7 +55,7 @@ export const GET_DATASET = gql`
           name
         }
       }
-      records {
+      records(fromDate: $fromDate, toDate: $toDate) {
         id
         publicationDate
         customColumnValues {
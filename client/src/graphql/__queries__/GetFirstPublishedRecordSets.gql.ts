@@ -0,0 +1,27 @@
+import { gql } from "@apollo/client";
+
+export const GET_FIRST_PUBLISHED_RECORD_SETS = gql`
+  query GetFirstPublishedRecordSets($input: PublishedRecordSetsInput!) {
+    publishedRecordSets(input: $input, firstOfEachDataset: true) {
+      id
+      begin
+      end
+      document
+      datasetId
+      dataset {
+        program {
+          importedId
+          tags {
+            name
+          }
+          targets {
+            category {
+              name
+            }
+            target
+          }
+        }
+      }
+    }
+  }
+`;
@@ -0,0 +1,16 @@
+import { gql } from "@apollo/client";
+
+export const GET_PUBLISHED_RECORD_SETS_CHART_DATA = gql`
+  query GetPublishedRecordSetsChartData(
+    $input: PublishedRecordSetsInput!
+    $period: ChartDataPeriod!
+  ) {
+    publishedRecordSetsChartData(input: $input, period: $period) {
+      date
+      category
+      targetMember
+      percent
+      count
+    }
+  }
+`;
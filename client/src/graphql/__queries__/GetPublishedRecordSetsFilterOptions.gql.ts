@@ -0,0 +1,12 @@
+import { gql } from "@apollo/client";
+
+export const GET_PUBLISHED_RECORD_SETS_FILTER_OPTIONS = gql`
+  query GetPublishedRecordSetsFilterOptions {
+    publishedRecordSetsFilterOptions {
+      categories
+      teams
+      datasetGroups
+      tags
+    }
+  }
+`;
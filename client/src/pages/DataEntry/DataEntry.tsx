@@ -19,6 +19,12 @@ import { DataEntryAggregateDataEntryForm } from "./DataEntryAggregateDataEntryFo
 
 const { Title } = Typography;
 
+// The form doesn't show the dataset's records, so ask for an empty window.
+const NO_RECORDS = {
+  fromDate: new Date(1).toISOString(),
+  toDate: new Date(0).toISOString(),
+};
+
 const DataEntry = (): JSX.Element => {
   const { t } = useTranslation();
 
@@ -33,7 +39,7 @@ const DataEntry = (): JSX.Element => {
     loading: datasetLoading,
     error: datasetError,
   } = useQuery<GetDataset, GetDatasetVariables>(GET_DATASET, {
-    variables: { id: datasetId ?? "" },
+    variables: { id: datasetId ?? "", ...NO_RECORDS },
   });
 
   const programAndDatasetPageTitle = `${datasetData?.dataset?.program?.name} | ${datasetData?.dataset.name}`;
@@ -5,6 +5,7 @@ import { useTranslation } from "react-i18next";
 
 import { GET_DATASET } from '../../graphql/__queries__/GetDataset.gql';
 import { UPDATE_RECORD } from '../../graphql/__mutations__/UpdateRecord.gql';
+import { evictDatasetRecords } from "./hooks";
 
 import {
     GetDataset, GetDataset_dataset_program_reportingPeriods, GetDataset_dataset_program_targets_category, GetDataset_dataset_records, GetDataset_dataset_records_entries_categoryValue
@@ -45,6 +46,8 @@ import { footerHeight } from "../../App";
 
 interface IProps {
     id: string;
+    fromDate?: string;
+    toDate?: string;
 }
 
 interface ITableRow {
@@ -86,56 +89,30 @@ export const DataEntryTable = (props: IProps) => {
         GET_DATASET,
         {
             variables: {
-                id: props.id
+                id: props.id,
+                fromDate: props.fromDate,
+                toDate: props.toDate
             }
         }
     );
     const [saveRecord,] = useMutation<UpdateRecordInput>(UPDATE_RECORD, {
-        refetchQueries: [
-            {
-                query: GET_DATASET,
-                variables: {
-                    id: props.id
-                }
-            }
-        ],
+        update: evictDatasetRecords(props.id),
     });
 
     const [createRecord, { loading: createRecordLoading }] = useMutation<CreateRecordInput>(CREATE_RECORD, {
-        refetchQueries: [
-            {
-                query: GET_DATASET,
-                variables: {
-                    id: props.id
-                }
-            }
-        ],
+        update: evictDatasetRecords(props.id),
         onError: () => { ; },
     });
 
     const [deleteRecord, { loading: deleteRecordLoading }] = useMutation(
         DELETE_RECORD,
         {
-            refetchQueries: [
-                {
-                    query: GET_DATASET,
-                    variables: {
-                        id: props.id
-                    }
-                }
-            ],
+            update: evictDatasetRecords(props.id),
         }
     );
 
     const [createPublishedRecordSet] = useMutation<CreatePublishedRecordSetInput>(CREATE_PUBLISHED_RECORD_SET, {
-        refetchQueries: [
-            {
-                query: GET_DATASET,
-                variables: {
-                    id: props.id
-                }
-            }
-        ],
+        refetchQueries: ["GetDataset"],
     });
 
     const [selectedForInput, setSelectedForInput] = useState<ITableEntry | undefined>();
@@ -1,12 +1,30 @@
-import { MutationFunction, MutationResult, useMutation } from "@apollo/client";
+import {
+  ApolloCache,
+  MutationFunction,
+  MutationResult,
+  useMutation,
+} from "@apollo/client";
 import { GetRecord } from "../../graphql/__generated__/GetRecord";
 import { UpdateRecord } from "../../graphql/__generated__/UpdateRecord";
 import { CREATE_RECORD } from "../../graphql/__mutations__/CreateRecord.gql";
 import { UPDATE_RECORD } from "../../graphql/__mutations__/UpdateRecord.gql";
-import { GET_DATASET } from "../../graphql/__queries__/GetDataset.gql";
 
 type CustomMutationHook<T, R extends MutationResult> = (input: T) => R;
 
+/**
+ * Cache update evicting the records of a dataset, whatever their window, so
+ * the queries showing them refetch
+ * @param datasetId string for dataset ID
+ */
+export const evictDatasetRecords =
+  (datasetId: string) =>
+  (cache: ApolloCache<unknown>): void => {
+    cache.evict({
+      id: cache.identify({ __typename: "Dataset", id: datasetId }),
+      fieldName: "records",
+    });
+  };
+
 interface CreateRecordMutationProps {
   datasetId: string;
 }
@@ -24,13 +42,7 @@ export const useCreateRecordMutation: CustomMutationHook<
   UseCreateRecordResult
 > = ({ datasetId }: CreateRecordMutationProps) => {
   const [createRecord, { ...rest }] = useMutation(CREATE_RECORD, {
-    awaitRefetchQueries: true,
-    refetchQueries: [
-      {
-        query: GET_DATASET,
-        variables: { id: datasetId },
-      },
-    ],
+    update: evictDatasetRecords(datasetId),
   });
 
   // Return mutation function and rest of mutation types
@@ -54,13 +66,7 @@ export const useUpdateRecordMutation: CustomMutationHook<
   UseUpdateRecordMutation
 > = ({ datasetId }: UpdateRecordMutationProps) => {
   const [updateRecord, { ...rest }] = useMutation(UPDATE_RECORD, {
-    awaitRefetchQueries: true,
-    refetchQueries: [
-      {
-        query: GET_DATASET,
-        variables: { id: datasetId },
-      },
-    ],
+    update: evictDatasetRecords(datasetId),
   });
 
   // Return mutation function and rest of mutation types
@@ -88,25 +88,24 @@ const DatasetDetails = (): JSX.Element => {
     defaultPresetDate
   );
 
+  // Only load the records of the selected date range.
+  const recordsWindow = useMemo(() => {
+    const [from, to] = selectedFilters.DateRange ?? [];
+    return from && to ? { fromDate: from.toISOString(), toDate: to.toISOString() } : {};
+  }, [selectedFilters.DateRange]);
+
   const {
     data: queryData,
     loading: queryLoading,
     error: queryError,
   } = useQuery<GetDataset, GetDatasetVariables>(GET_DATASET, {
-    variables: { id: datasetId },
+    variables: { id: datasetId, ...recordsWindow },
   });
 
   const [deletePublishedRecordSet, { loading: deleting }] = useMutation(
     DELETE_PUBLISHED_RECORD_SET,
     {
-      refetchQueries: [
-        {
-          query: GET_DATASET,
-          variables: {
-            id: datasetId
-          }
-        }
-      ],
+      refetchQueries: ["GetDataset"],
     }
   );
 
@@ -286,6 +285,7 @@ const DatasetDetails = (): JSX.Element => {
                 <Col span={24}>
                   <DataEntryTable
                     id={datasetId}
+                    {...recordsWindow}
                   />
                 </Col>
               </Row>
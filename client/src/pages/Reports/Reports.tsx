@@ -1,4 +1,4 @@
-import { useQuery } from "@apollo/client"
+import { useApolloClient, useQuery } from "@apollo/client"
 import { Button, Checkbox, Col, Collapse, DatePicker, PageHeader, Row, Space, Statistic, Tag } from "antd";
 import { ArrowUpOutlined, ArrowDownOutlined, DownloadOutlined } from '@ant-design/icons';
 import moment from "moment";
@@ -7,13 +7,19 @@ const { Panel } = Collapse;
 import { useMemo, useState } from "react";
 import { useTranslation } from "react-i18next";
 
-import { GetAllPublishedRecordSets, GetAllPublishedRecordSets_publishedRecordSets } from "../../graphql/__generated__/GetAllPublishedRecordSets"
-import { PublishedRecordSetsInput } from "../../graphql/__generated__/globalTypes";
+import { GetAllPublishedRecordSets, GetAllPublishedRecordSetsVariables } from "../../graphql/__generated__/GetAllPublishedRecordSets"
+import { ChartDataPeriod, PublishedRecordSetsInput } from "../../graphql/__generated__/globalTypes";
 import { GET_ALL_PUBLISHED_RECORD_SETS } from "../../graphql/__queries__/GetAllPublishedRecordSets.gql"
+import { GetFirstPublishedRecordSets, GetFirstPublishedRecordSetsVariables } from "../../graphql/__generated__/GetFirstPublishedRecordSets";
+import { GET_FIRST_PUBLISHED_RECORD_SETS } from "../../graphql/__queries__/GetFirstPublishedRecordSets.gql";
+import { GetPublishedRecordSetsFilterOptions } from "../../graphql/__generated__/GetPublishedRecordSetsFilterOptions";
+import { GET_PUBLISHED_RECORD_SETS_FILTER_OPTIONS } from "../../graphql/__queries__/GetPublishedRecordSetsFilterOptions.gql";
 import Pie5050 from "../Charts/Pie";
-import { exportCSVTwo, flattenPublishedDocumentEntries, IPublishedRecordSetDocument, mungedFilteredData } from "../DatasetDetails/PublishedRecordSet";
+import { exportCSVTwo, mungedFilteredData } from "../DatasetDetails/PublishedRecordSet";
 import { LineColumn } from "../Charts/LineColumn";
-import { flattenChartData, groupedByMonthYearCategory, groupedByYearCategory } from "../../selectors/ChartData";
+import { IChartData } from "../../selectors/ChartData";
+import { GetPublishedRecordSetsChartData, GetPublishedRecordSetsChartDataVariables } from "../../graphql/__generated__/GetPublishedRecordSetsChartData";
+import { GET_PUBLISHED_RECORD_SETS_CHART_DATA } from "../../graphql/__queries__/GetPublishedRecordSetsChartData.gql";
 import { useAuth } from "../../components/AuthProvider";
 import { GET_USER } from "../../graphql/__queries__/GetUser.gql";
 import { GetUser, GetUserVariables } from "../../graphql/__generated__/getUser";
@@ -38,96 +44,127 @@ export const Reports = () => {
 
 
 
-    const { data, loading } = useQuery<GetAllPublishedRecordSets>(GET_ALL_PUBLISHED_RECORD_SETS, {
+    // The filter options cover every year, not just the fetched ones.
+    const { data: filterOptions } = useQuery<GetPublishedRecordSetsFilterOptions>(GET_PUBLISHED_RECORD_SETS_FILTER_OPTIONS);
+
+    const apolloClient = useApolloClient();
+    const [exporting, setExporting] = useState(false);
+
+    // Full documents are only needed for the CSV export, so they are only
+    // fetched when exporting. Everything else on the page comes from the
+    // aggregated chart data.
+    const exportCSV = async () => {
+        setExporting(true);
+        try {
+            const [{ data }, { data: firstData }] = await Promise.all([
+                // All the filters are applied server side.
+                apolloClient.query<GetAllPublishedRecordSets, GetAllPublishedRecordSetsVariables>({
+                    query: GET_ALL_PUBLISHED_RECORD_SETS,
+                    variables: { input: filterState }
+                }),
+                // The first record set of every dataset, of any year, is the
+                // baseline.
+                apolloClient.query<GetFirstPublishedRecordSets, GetFirstPublishedRecordSetsVariables>({
+                    query: GET_FIRST_PUBLISHED_RECORD_SETS,
+                    variables: {
+                        input: {
+                            categories: [],
+                            teams: [],
+                            tags: [],
+                            datasetGroups: [],
+                            year: 0
+                        }
+                    }
+                })
+            ]);
+            exportCSVTwo(
+                mungedFilteredData([...firstData.publishedRecordSets], true)
+                    ?.concat(mungedFilteredData([...data.publishedRecordSets], false)),
+                `${Object.values(filterState).filter(x => x && x.length).map(x => x.toString()).join("_")}`
+            );
+        } finally {
+            setExporting(false);
+        }
+    };
+
+    // The charts are aggregated server side, with all the filters applied.
+    const { data: monthlyChartData, loading: monthlyChartLoading } = useQuery<GetPublishedRecordSetsChartData, GetPublishedRecordSetsChartDataVariables>(GET_PUBLISHED_RECORD_SETS_CHART_DATA, {
+        variables: {
+            input: filterState,
+            period: ChartDataPeriod.MONTH
+        }
+    });
+
+    // The yearly totals are shown for every category, so only the categories
+    // filter is left out.
+    const { data: yearlyChartData } = useQuery<GetPublishedRecordSetsChartData, GetPublishedRecordSetsChartDataVariables>(GET_PUBLISHED_RECORD_SETS_CHART_DATA, {
         variables: {
-            //for doing this server side later
-            input: {
-                categories: [],
-                teams: [],
-                tags: [],
-                datasetGroups: [],
-                year: new Date(Date.now()).getFullYear()
-            } as PublishedRecordSetsInput
+            input: { ...filterState, categories: [] },
+            period: ChartDataPeriod.YEAR
         }
     });
 
+    const { data: previousYearlyChartData } = useQuery<GetPublishedRecordSetsChartData, GetPublishedRecordSetsChartDataVariables>(GET_PUBLISHED_RECORD_SETS_CHART_DATA, {
+        variables: {
+            input: { ...filterState, categories: [], year: filterState.year - 1 },
+            period: ChartDataPeriod.YEAR
+        }
+    });
+
+    const loading = monthlyChartLoading;
+
     const { t } = useTranslation();
 
     const categories = useMemo(() => {
-        return Array.from(new Set(data?.publishedRecordSets
-            .flatMap(x => flattenPublishedDocumentEntries((x.document as IPublishedRecordSetDocument).record)
-                .map((r) => r.category))
-        ))
+        return [...(filterOptions?.publishedRecordSetsFilterOptions.categories ?? [])]
             .sort((a, b) => catSort(a, b));
-    }, [data]);
+    }, [filterOptions]);
 
     const teams = useMemo(() => {
-        return Array.from(new Set(data?.publishedRecordSets
-            .map(x => (x.document as IPublishedRecordSetDocument).teamName ?? "None")
-        ))
+        return [...(filterOptions?.publishedRecordSetsFilterOptions.teams ?? [])]
             .sort((a, b) => a.localeCompare(b));
-    }, [data]);
+    }, [filterOptions]);
 
     const tags = useMemo(() => {
-        return Array.from(new Set(data?.publishedRecordSets
-            .flatMap(x => (x.document as IPublishedRecordSetDocument).datasetGroupTags.map(y => y.name))
-        ))
+        return [...(filterOptions?.publishedRecordSetsFilterOptions.tags ?? [])]
             .sort((a, b) => a.localeCompare(b));
-    }, [data]);
+    }, [filterOptions]);
 
     const datasetGroups = useMemo(() => {
-        return Array.from(new Set(data?.publishedRecordSets
-            .map(x => (x.document as IPublishedRecordSetDocument).datasetGroup)
-        ))
+        return [...(filterOptions?.publishedRecordSetsFilterOptions.datasetGroups ?? [])]
             .sort((a, b) => a.localeCompare(b));
-    }, [data]);
-
-    const datasetGroupIds = useMemo(() => {
-        return Array.from(new Set(data?.publishedRecordSets
-            .map(x => x.datasetId)));
-    }, [data]);
-
-
-    const filteredByDateMinusOne = useMemo(() => {
-        return data?.publishedRecordSets
-            .filter(x => !filterState.year || filterState.year - 1 === new Date(x.end).getFullYear())
-    }, [data, filterState.year]);
-
-    const filteredByDate = useMemo(() => {
-        return data?.publishedRecordSets
-            .filter(x => !filterState.year || filterState.year === new Date(x.end).getFullYear())
-    }, [data, filterState.year]);
-
-
-    const filteredData = useMemo(() => {
-        return [filteredByDate, filteredByDateMinusOne]
-            .map((x) => x?.filter(x => !filterState.teams.length || filterState.teams.includes((x.document as IPublishedRecordSetDocument).teamName))
-                .filter(x => !filterState.tags.length || (x.document as IPublishedRecordSetDocument).datasetGroupTags.some(y => filterState.tags.includes(y.name)))
-                .filter(x => !filterState.datasetGroups.length || filterState.datasetGroups.includes((x.document as IPublishedRecordSetDocument).datasetGroup))
-            );
-    }, [filteredByDate, filteredByDateMinusOne, filterState.tags, filterState.teams, filterState.datasetGroups]);
-
-
-    const chartData = useMemo(() => {
-        return groupedByMonthYearCategory(filteredData[0], filterState.categories);
-    }, [filterState.categories, filteredData]);
-
-    const flattenedChartData = useMemo(() => { return flattenChartData(chartData) }, [chartData]);
+    }, [filterOptions]);
+
+
+    const flattenedChartData = useMemo(() => {
+        return (monthlyChartData?.publishedRecordSetsChartData ?? [])
+            .filter(x => x.targetMember)
+            .map(x => {
+                const date = new Date(x.date);
+                return {
+                    category: x.category,
+                    targetMember: x.targetMember,
+                    percent: x.percent,
+                    count: x.count,
+                    date,
+                    groupedDate: `${date.getFullYear()}-${date.getMonth() + 1}-1`,
+                    summedPercent: x.percent * x.count
+                } as IChartData;
+            });
+    }, [monthlyChartData]);
 
     const grouping = useMemo(() => {
-        return groupedByYearCategory(filteredData) ?? [[]];
-    }, [filteredData])
-
-
-    const filteredByIsFirst = () =>
-        datasetGroupIds
-            .flatMap(dg =>
-                data?.publishedRecordSets
-                    .filter(x => x.datasetId === dg)?.
-                    sort((a, b) => new Date(b.begin).valueOf() - new Date(a.begin).valueOf())
-                    .pop()
-            )
-            .filter((x): x is GetAllPublishedRecordSets_publishedRecordSets => x !== undefined);
+        return [yearlyChartData, previousYearlyChartData].map(x => (x?.publishedRecordSetsChartData ?? [])
+            .filter(x => x.targetMember)
+            .reduce((groupedRecords, x) => {
+                const year = new Date(x.date).getFullYear();
+                if (!(year in groupedRecords)) {
+                    groupedRecords[year] = {} as Record<string, { percent: number, count: number }>;
+                }
+                groupedRecords[year][x.category] = { percent: x.percent, count: x.count };
+                return groupedRecords;
+            }, {} as Record<string, Record<string, { percent: number, count: number }>>));
+    }, [yearlyChartData, previousYearlyChartData]);
 
 
 
@@ -138,10 +175,8 @@ export const Reports = () => {
                     title={t("reports.title")}
                     subTitle={t("reports.subtitle")}
                     extra={
-                        <Button onClick={
-                            () => filteredData[0] && filteredByIsFirst &&
-                                exportCSVTwo(mungedFilteredData(filteredByIsFirst(), true)?.concat(mungedFilteredData(filteredData[0], false)), `${Object.values(filterState).filter(x => x && x.length).map(x => x.toString()).join("_")}`)
-                        }
+                        <Button onClick={exportCSV}
+                            loading={exporting}
                             type="primary"
                             shape="circle"
                             icon={<DownloadOutlined />}